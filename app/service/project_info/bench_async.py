@@ -0,0 +1,87 @@
+"""
+    Benchmark : threaded vs asyncio collector
+
+    Runs the recursive crawl, transform and store of both entry points
+    against the in-process fakes in bench_fakes with a fixed per-RPC
+    latency, and reports wall time, throughput and RPC counts as JSON.
+
+    Usage : python bench_async.py [--folders N] [--projects N]
+                                  [--latency-ms MS] [--workers N ...]
+                                  [--rm-qps QPS]
+"""
+
+import argparse
+import json
+import time
+
+import bench_fakes
+import main
+
+
+def run_once(label, collect, fakes):
+    """Times one collection and flush against freshly installed fakes."""
+    resource_manager, bigquery, monitoring = fakes()
+    bench_fakes.install(resource_manager, bigquery, monitoring)
+    start_time = time.perf_counter()
+    count = collect()
+    seconds = time.perf_counter() - start_time
+    return {
+        "path": label,
+        "projects": count,
+        "seconds": round(seconds, 4),
+        "projects_per_second": round(count / seconds, 1),
+        "rpc_counts": dict(resource_manager.counter.counts),
+        "rows_stored": bigquery.rows,
+    }
+
+
+def run(folders, projects, latency, workers, rm_qps):
+    """Compares both paths for every crawl concurrency limit."""
+    tree = bench_fakes.folder_tree(folders)
+
+    def fakes():
+        return (bench_fakes.FakeResourceManager(tree, projects,
+                                                latency=latency),
+                bench_fakes.FakeBigQuery(latency=latency),
+                bench_fakes.FakeMonitoring(latency=latency))
+
+    main.FOLDER_ID = "root"
+    main.RECURSIVE_CRAWL = True
+    main.INCREMENTAL_MODE = False
+    results = []
+    for max_workers in workers:
+        main.CRAWL_MAX_WORKERS = max_workers
+        main.rm_limiter = main.RateLimiter(rm_qps, main.RM_MIN_QPS,
+                                           max_workers)
+        threaded = run_once("threaded", main.collect, fakes)
+        native = run_once(
+            "asyncio",
+            lambda: main.run_async(main.collect_async(main.collection_folders())),
+            fakes)
+        main.metrics_buffer.clear()
+        main.histograms.clear()
+        results.append({
+            "folders": folders,
+            "latency_ms": latency * 1000,
+            "max_workers": max_workers,
+            "rm_qps": rm_qps,
+            "threaded": threaded,
+            "asyncio": native,
+            "speedup": round(threaded["seconds"] / native["seconds"], 2),
+        })
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--folders", type=int, default=200)
+    parser.add_argument("--projects", type=int, default=10000)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--workers", type=int, nargs="+", default=[8, 64])
+    # the fakes have no quota; lower this to see the limiter's effect
+    parser.add_argument("--rm-qps", type=float, default=10000.0)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.folders, args.projects,
+                         args.latency_ms / 1000, args.workers, args.rm_qps),
+                     indent=2))
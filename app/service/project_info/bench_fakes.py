@@ -0,0 +1,271 @@
+"""
+    Benchmark support : in-process fake GCP services
+
+    Stand-ins for Resource Manager, BigQuery and Cloud Monitoring with
+    configurable page size and per-call latency. They count every RPC so
+    benchmarks can compare call volume as well as wall time, and expose
+    both the sync and the asyncio client surfaces used by main.
+"""
+
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+from google.protobuf.timestamp_pb2 import Timestamp  # pylint: disable=E0611
+
+import main
+
+
+class RpcCounter:
+    """Thread-safe per-method RPC counter."""
+
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def add(self, method):
+        """Counts one call of a method."""
+        with self.lock:
+            self.counts[method] = self.counts.get(method, 0) + 1
+
+    def total(self):
+        """Returns the number of calls across all methods."""
+        return sum(self.counts.values())
+
+
+class FakePager:
+    """Sync pager: fetching each page costs one RPC and its latency."""
+
+    def __init__(self, pages, field, latency, counter, method):
+        # [(items, next_page_token)]
+        self.page_items = pages
+        self.field = field
+        self.latency = latency
+        self.counter = counter
+        self.method = method
+
+    @property
+    def pages(self):
+        """Yields response pages, sleeping for each round trip."""
+        for items, next_page_token in self.page_items:
+            time.sleep(self.latency)
+            self.counter.add(self.method)
+            yield SimpleNamespace(**{self.field: items},
+                                  next_page_token=next_page_token)
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from getattr(page, self.field)
+
+
+class FakeAsyncPager(FakePager):
+    """Async pager: the same pages fetched with asyncio.sleep."""
+
+    @property
+    async def pages(self):  # pylint: disable=invalid-overridden-method
+        for items, next_page_token in self.page_items:
+            await asyncio.sleep(self.latency)
+            self.counter.add(self.method)
+            yield SimpleNamespace(**{self.field: items},
+                                  next_page_token=next_page_token)
+
+    async def __aiter__(self):
+        async for page in self.pages:
+            for item in getattr(page, self.field):
+                yield item
+
+
+def folder_tree(folder_count, fanout=4, root="root"):
+    """Builds a parent -> children map with folder_count folders in total."""
+    tree = {root: []}
+    frontier = [root]
+    while len(tree) < folder_count:
+        parent = frontier.pop(0)
+        for _ in range(fanout):
+            if len(tree) >= folder_count:
+                break
+            child = f"f{len(tree)}"
+            tree[parent].append(child)
+            tree[child] = []
+            frontier.append(child)
+    return tree
+
+
+def make_project(index, folder_id):
+    """Builds a Resource Manager Project message."""
+    project = main.resourcemanager_v3.Project
+    return project(
+        name=f"projects/{100000000000 + index}",
+        project_id=f"dfc-project-{index:06d}",
+        parent=f"folders/{folder_id}",
+        display_name=f"DFC Project {index}",
+        state=project.State.ACTIVE,
+        etag=f"W/\"{index:032x}\"",
+        create_time=Timestamp(seconds=1704067200),
+        update_time=Timestamp(seconds=1742299500 + index),
+        labels={"env": "bench", "team": f"team-{index % 7}"},
+    )
+
+
+class FakeResourceManager:
+    """Projects and Folders service over a synthetic folder tree."""
+
+    def __init__(self, tree, project_count, page_size=100, latency=0.0):
+        self.tree = tree
+        self.page_size = page_size
+        self.latency = latency
+        self.counter = RpcCounter()
+        folders = list(tree)
+        self.projects = {folder: [] for folder in folders}
+        for index in range(project_count):
+            folder = folders[index % len(folders)]
+            self.projects[folder].append(make_project(index, folder))
+
+    def paged(self, items, request):
+        """Splits items into pages from the request's page token onwards.
+
+        Page tokens are the page offsets, so a listing can be resumed.
+        """
+        size = request.page_size or self.page_size
+        first = int(request.page_token or 0)
+        offsets = range(first * size, len(items), size)
+        return [(items[offset:offset + size],
+                 str(first + number + 1)
+                 if offset + size < len(items) else "")
+                for number, offset in enumerate(offsets)] or [([], "")]
+
+    def project_pages(self, request):
+        """Pages of projects for a ListProjects or SearchProjects request."""
+        if hasattr(request, "query") and not request.query.startswith(
+                "parent:folders/"):
+            items = [project for projects in self.projects.values()
+                     for project in projects]
+        else:
+            parent = getattr(request, "parent", "") or request.query
+            items = self.projects.get(parent.split("/")[-1], [])
+        return self.paged(items, request)
+
+    def folder_pages(self, request):
+        """Pages of folders for a ListFolders request."""
+        children = self.tree.get(request.parent.split("/")[-1], [])
+        return self.paged(
+            [SimpleNamespace(name=f"folders/{child}") for child in children],
+            request)
+
+    # sync client surface
+    def list_projects(self, request):
+        """ProjectsClient.list_projects."""
+        return FakePager(self.project_pages(request), "projects",
+                         self.latency, self.counter, "list_projects")
+
+    def search_projects(self, request):
+        """ProjectsClient.search_projects."""
+        return FakePager(self.project_pages(request), "projects",
+                         self.latency, self.counter, "search_projects")
+
+    def list_folders(self, request):
+        """FoldersClient.list_folders."""
+        return FakePager(self.folder_pages(request), "folders",
+                         self.latency, self.counter, "list_folders")
+
+    def async_client(self):
+        """Returns the asyncio client surface over the same data."""
+        fake = self
+
+        class AsyncSurface:
+            """ProjectsAsyncClient / FoldersAsyncClient stand-in."""
+
+            async def list_projects(self, request):
+                """ProjectsAsyncClient.list_projects."""
+                return FakeAsyncPager(fake.project_pages(request), "projects",
+                                      fake.latency, fake.counter,
+                                      "list_projects")
+
+            async def search_projects(self, request):
+                """ProjectsAsyncClient.search_projects."""
+                return FakeAsyncPager(fake.project_pages(request), "projects",
+                                      fake.latency, fake.counter,
+                                      "search_projects")
+
+            async def list_folders(self, request):
+                """FoldersAsyncClient.list_folders."""
+                return FakeAsyncPager(fake.folder_pages(request), "folders",
+                                      fake.latency, fake.counter,
+                                      "list_folders")
+
+        return AsyncSurface()
+
+
+class FakeBigQuery:
+    """BigQuery client accepting inserts and load jobs after a delay."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.counter = RpcCounter()
+        self.rows = 0
+        self.lock = threading.Lock()
+
+    def insert_rows_json(self, _table, rows, **_):
+        """Client.insert_rows_json; every row succeeds."""
+        time.sleep(self.latency)
+        self.counter.add("insert_rows_json")
+        with self.lock:
+            self.rows += len(rows)
+        return []
+
+    def load_table_from_file(self, *_, **__):
+        """Client.load_table_from_file; returns a finished job."""
+        time.sleep(self.latency)
+        self.counter.add("load_table_from_file")
+        return SimpleNamespace(result=lambda: None)
+
+
+class FakeMonitoring:
+    """Cloud Monitoring client with sync and async create_time_series."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.counter = RpcCounter()
+        self.series = 0
+
+    def create_time_series(self, name, time_series):  # pylint: disable=W0613
+        """MetricServiceClient.create_time_series."""
+        time.sleep(self.latency)
+        self.counter.add("create_time_series")
+        self.series += len(time_series)
+
+    def async_client(self):
+        """Returns the asyncio client surface."""
+        fake = self
+
+        class AsyncSurface:  # pylint: disable=too-few-public-methods
+            """MetricServiceAsyncClient stand-in."""
+
+            async def create_time_series(self, name, time_series):  # noqa
+                """MetricServiceAsyncClient.create_time_series."""
+                del name
+                await asyncio.sleep(fake.latency)
+                fake.counter.add("create_time_series")
+                fake.series += len(time_series)
+
+        return AsyncSurface()
+
+
+def install(resource_manager, bigquery, monitoring):
+    """Points main's client registries at the fakes."""
+    main.CLIENT_FACTORIES.update({
+        "projects_client": lambda: resource_manager,
+        "folders_client": lambda: resource_manager,
+        "bq_client": lambda: bigquery,
+        "monitoring_client": lambda: monitoring,
+    })
+    main.ASYNC_CLIENT_FACTORIES.update({
+        "projects_client": resource_manager.async_client,
+        "folders_client": resource_manager.async_client,
+        "monitoring_client": monitoring.async_client,
+    })
+    for name in main.CLIENT_FACTORIES:
+        setattr(main, name, None)
+    main.async_clients.clear()
+    main.client_states.clear()
@@ -0,0 +1,64 @@
+"""
+    Benchmark : module import time (cold start)
+
+    Imports main in fresh interpreters with `python -X importtime` and
+    reports the median time spent in module init plus the slowest imports.
+    Results are printed as JSON; with --max-ms the exit code is non-zero
+    when the median exceeds the budget, so it can gate regressions.
+
+    Usage : python bench_import.py [--runs N] [--max-ms MS] [--top N]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+
+def import_times(module="main"):
+    """Imports a module in a fresh interpreter, returning per-module us."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True, check=True)
+
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, self_us, cumulative_us, name = (
+            part.strip() for part in line.replace(
+                "import time:", "|").split("|"))
+        times[name] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def run(runs, top):
+    """Measures import time of main over several cold interpreters."""
+    samples = [import_times() for _ in range(runs)]
+    totals = [sample["main"][1] for sample in samples]
+    own = [sample["main"][0] for sample in samples]
+    slowest = sorted(samples[-1].items(), key=lambda item: item[1][1],
+                     reverse=True)
+    return {
+        "runs": runs,
+        "main_cumulative_ms": statistics.median(totals) / 1000,
+        "main_self_ms": statistics.median(own) / 1000,
+        "slowest_imports_ms": {name: cumulative / 1000
+                               for name, (_, cumulative) in slowest[:top]},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--max-ms", type=float, default=None)
+    args = parser.parse_args()
+
+    report = run(args.runs, args.top)
+    print(json.dumps(report, indent=2))
+    if args.max_ms is not None and report["main_cumulative_ms"] > args.max_ms:
+        sys.exit(1)
@@ -0,0 +1,220 @@
+"""
+    Benchmark : end-to-end collector at several org sizes
+
+    Runs the real run_batch -> collect -> transform -> store -> flush
+    pipeline against the in-process fakes in bench_fakes, one fresh
+    interpreter per org size so peak RSS is that run's own. Reports
+    throughput, per-stage latency percentiles, peak RSS and RPC counts
+    as JSON. With --baseline the exit code is non-zero when throughput
+    drops by more than --max-regression against a previous report.
+
+    Usage : python bench_pipeline.py [--projects N ...] [--folders N]
+                                     [--page-size N] [--latency-ms MS]
+                                     [--mode batch|stream|overlapped]
+                                     [--output FILE] [--baseline FILE]
+                                     [--max-regression FRACTION]
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+import bench_fakes
+import main
+
+# stage -> the main functions whose calls are timed for it; "fetch" is
+# timed per page of rm_pages instead
+STAGES = {
+    "transform": ("transform",),
+    "store": ("insert_chunk", "load_parquet"),
+    "flush": ("flush_metrics",),
+}
+MODES = {
+    "batch": {"STREAMING_MODE": False, "OVERLAPPED_PIPELINE": False},
+    "stream": {"STREAMING_MODE": True, "OVERLAPPED_PIPELINE": False},
+    "overlapped": {"STREAMING_MODE": True, "OVERLAPPED_PIPELINE": True},
+}
+
+
+def timed(samples, function):
+    """Wraps a function so every call appends its duration to samples."""
+    def wrapper(*args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            samples.append(time.perf_counter() - start_time)
+    return wrapper
+
+
+def timed_pages(samples, function):
+    """Wraps a page generator so fetching each page is one sample."""
+    def wrapper(*args, **kwargs):
+        pages = function(*args, **kwargs)
+        while True:
+            start_time = time.perf_counter()
+            page = next(pages, None)
+            if page is None:
+                return
+            samples.append(time.perf_counter() - start_time)
+            yield page
+    return wrapper
+
+
+def percentiles(samples):
+    """Summarises durations in milliseconds."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pick(quantile):
+        index = min(len(ordered) - 1, int(quantile * len(ordered)))
+        return round(ordered[index] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "total_ms": round(sum(ordered) * 1000, 3),
+        "p50_ms": pick(0.5),
+        "p90_ms": pick(0.9),
+        "p99_ms": pick(0.99),
+        "max_ms": pick(1.0),
+    }
+
+
+def rss_mb():
+    """Returns the peak resident set size of this process in MiB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_size(projects, config):
+    """Runs one collection in this interpreter and reports on it.
+
+    config holds folders, page_size, latency (seconds), mode and rm_qps.
+    """
+    tree = bench_fakes.folder_tree(config["folders"])
+    resource_manager = bench_fakes.FakeResourceManager(
+        tree, projects, page_size=config["page_size"],
+        latency=config["latency"])
+    bigquery = bench_fakes.FakeBigQuery(latency=config["latency"])
+    monitoring = bench_fakes.FakeMonitoring(latency=config["latency"])
+    bench_fakes.install(resource_manager, bigquery, monitoring)
+
+    # every mode gets the folders as a flat list, so all of them fetch
+    # the same folders FOLDER_MAX_WORKERS at a time
+    main.FOLDER_ID = ",".join(tree)
+    main.RECURSIVE_CRAWL = False
+    main.INCREMENTAL_MODE = False
+    main.CHECKPOINT_URI = ""
+    main.CURRENT_TABLE = ""
+    main.FUNCTION_TIMEOUT_SECONDS = 3600
+    for name, value in MODES[config["mode"]].items():
+        setattr(main, name, value)
+    main.rm_limiter = main.RateLimiter(config["rm_qps"], main.RM_MIN_QPS,
+                                       main.CRAWL_MAX_WORKERS)
+    samples = {stage: [] for stage in ("fetch", *STAGES)}
+    main.rm_pages = timed_pages(samples["fetch"], main.rm_pages)
+    for stage, names in STAGES.items():
+        for name in names:
+            setattr(main, name, timed(samples[stage], getattr(main, name)))
+    # the logging handler is set up once per instance, not per run
+    main.setup_cloud_logging()
+
+    setup_rss = rss_mb()
+    start_time = time.perf_counter()
+    response = main.run_batch(
+        SimpleNamespace(method="POST", path="/bench", args={}),
+        main.collect, main.flush_metrics)
+    seconds = time.perf_counter() - start_time
+    return {
+        "projects": projects,
+        "folders": config["folders"],
+        "mode": config["mode"],
+        "response": response,
+        "rows_stored": bigquery.rows,
+        "seconds": round(seconds, 4),
+        "projects_per_second": round(projects / seconds, 1),
+        "stages": {stage: percentiles(durations)
+                   for stage, durations in samples.items()},
+        "setup_rss_mb": round(setup_rss, 1),
+        "peak_rss_mb": round(rss_mb(), 1),
+        "rpc_counts": {
+            **resource_manager.counter.counts,
+            **bigquery.counter.counts,
+            **monitoring.counter.counts,
+        },
+        "time_series": monitoring.series,
+    }
+
+
+def run(sizes, config):
+    """Runs every org size in its own interpreter."""
+    results = []
+    for projects in sizes:
+        call = f"run_size({projects}, {config!r})"
+        result = subprocess.run(
+            [sys.executable, "-c",
+             f"import json, bench_pipeline; "
+             f"print(json.dumps(bench_pipeline.{call}))"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True)
+        results.append(json.loads(result.stdout.splitlines()[-1]))
+    return results
+
+
+def regressions(results, baseline, max_regression):
+    """Lists the sizes whose throughput fell below the baseline's."""
+    previous = {(entry["projects"], entry["mode"]):
+                entry["projects_per_second"] for entry in baseline}
+    slower = []
+    for entry in results:
+        reference = previous.get((entry["projects"], entry["mode"]))
+        if reference and entry["projects_per_second"] < reference * (
+                1 - max_regression):
+            slower.append({"projects": entry["projects"],
+                           "mode": entry["mode"],
+                           "baseline": reference,
+                           "projects_per_second":
+                               entry["projects_per_second"]})
+    return slower
+
+
+def main_cli():
+    """Parses the command line, runs the benchmark and checks regressions."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--projects", type=int, nargs="+",
+                        default=[1000, 10000, 100000])
+    parser.add_argument("--folders", type=int, default=50)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--mode", choices=sorted(MODES), default="batch")
+    # the fakes have no quota; lower this to see the limiter's effect
+    parser.add_argument("--rm-qps", type=float, default=10000.0)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--baseline", default=None)
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    args = parser.parse_args()
+
+    config = {"folders": args.folders, "page_size": args.page_size,
+              "latency": args.latency_ms / 1000, "mode": args.mode,
+              "rm_qps": args.rm_qps}
+    report = {"results": run(args.projects, config)}
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            report["regressions"] = regressions(
+                report["results"], json.load(baseline_file)["results"],
+                args.max_regression)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(report, output_file, indent=2)
+    if report.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
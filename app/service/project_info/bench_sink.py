@@ -0,0 +1,85 @@
+"""
+    Benchmark : streaming insert (NDJSON) vs Parquet load sink
+
+    Compares serialisation time and upload bytes of the two store paths for
+    synthetic snapshots. No GCP calls are made; results are printed as JSON.
+
+    Usage : python bench_sink.py [--projects N ...]
+"""
+
+import argparse
+import json
+import time
+from datetime import datetime, timezone
+
+import main
+
+
+def synthetic_rows(count, label_count=8):
+    """Builds transformed rows shaped like a real project snapshot."""
+    now = datetime.now(timezone.utc).isoformat()
+    return [{
+        "project_id": f"dfc-project-{index:06d}",
+        "project_number": f"projects/{100000000000 + index}",
+        "folder_id": "folders/1062810406170",
+        "project_name": f"DFC Project {index}",
+        "state": "ACTIVE",
+        "create_time": "2024-01-01T00:00:00.123456Z",
+        "update_time": "2025-03-18T12:05:00.654321Z",
+        "ingestion_time": now,
+        "etag": f"W/\"{index:032x}\"",
+        "labels": [{"key": f"label-{n}", "value": f"value-{index % 17}-{n}"}
+                   for n in range(label_count)],
+    } for index in range(count)]
+
+
+def bench_stream(rows):
+    """Serialises rows as the insertAll request bodies store would send."""
+    start_time = time.perf_counter()
+    payload_bytes = 0
+    requests = 0
+    for chunk in main.chunk_rows(rows):
+        body = json.dumps({"rows": [{"json": row} for row in chunk]})
+        payload_bytes += len(body.encode("utf-8"))
+        requests += 1
+    return {
+        "seconds": time.perf_counter() - start_time,
+        "bytes": payload_bytes,
+        "requests": requests,
+    }
+
+
+def bench_load(rows):
+    """Serialises rows into the Parquet file the load sink would upload."""
+    start_time = time.perf_counter()
+    parquet = main.rows_to_parquet(rows)
+    return {
+        "seconds": time.perf_counter() - start_time,
+        "bytes": parquet.getbuffer().nbytes,
+        "requests": 1,
+    }
+
+
+def run(counts):
+    """Runs both sinks for every snapshot size."""
+    results = []
+    for count in counts:
+        rows = synthetic_rows(count)
+        stream = bench_stream(rows)
+        load = bench_load(rows)
+        results.append({
+            "projects": count,
+            "stream": stream,
+            "load": load,
+            "bytes_ratio": round(stream["bytes"] / load["bytes"], 2),
+        })
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--projects", type=int, nargs="+",
+                        default=[1000, 10000, 100000])
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.projects), indent=2))
@@ -0,0 +1,97 @@
+"""
+    Benchmark : transform cost per project
+
+    Compares the direct proto field access used by transform with the
+    previous MessageToDict round trip. Results are printed as JSON.
+
+    Usage : python bench_transform.py [--projects N ...]
+"""
+
+import argparse
+import json
+import time
+from datetime import datetime, timezone
+
+from google.protobuf.json_format import MessageToDict
+from google.protobuf.timestamp_pb2 import Timestamp  # pylint: disable=E0611
+
+import main
+
+
+def synthetic_projects(count, label_count=8):
+    """Builds Project messages shaped like a real folder listing."""
+    project = main.resourcemanager_v3.Project
+    return [project(
+        name=f"projects/{100000000000 + index}",
+        project_id=f"dfc-project-{index:06d}",
+        parent="folders/1062810406170",
+        display_name=f"DFC Project {index}",
+        state=project.State.ACTIVE,
+        etag=f"W/\"{index:032x}\"",
+        create_time=Timestamp(seconds=1704067200, nanos=123456000),
+        update_time=Timestamp(seconds=1742299500 + index),
+        labels={f"label-{n}": f"value-{index % 17}-{n}"
+                for n in range(label_count)},
+    ) for index in range(count)]
+
+
+def message_to_dict_row(project, ingestion_timestamp, run_id=None):
+    """The previous transform row mapping, via MessageToDict.
+
+    test_main checks transform against this same reference.
+    """
+    project_dict = MessageToDict(
+        project._pb,  # pylint: disable=W0212
+        preserving_proto_field_name=True)
+    labels = project_dict.get("labels", {})
+    return {
+        "project_id": project_dict.get("project_id"),
+        "project_number": project_dict.get("name"),
+        "folder_id": project_dict.get("parent"),
+        "project_name": project_dict.get("display_name"),
+        "state": project_dict.get("state"),
+        "create_time": project_dict.get("create_time"),
+        "update_time": project_dict.get("update_time"),
+        "ingestion_time": ingestion_timestamp,
+        "etag": project_dict.get("etag"),
+        "labels": [{"key": k, "value": v} for k, v in labels.items()],
+        "run_id": run_id,
+    }
+
+
+def time_rows(row_builder, projects):
+    """Returns total seconds and microseconds per project for a builder."""
+    ingestion_timestamp = datetime.now(timezone.utc).isoformat()
+    start_time = time.perf_counter()
+    for project in projects:
+        row_builder(project, ingestion_timestamp)
+    seconds = time.perf_counter() - start_time
+    return {
+        "seconds": seconds,
+        "us_per_project": seconds / len(projects) * 1e6,
+    }
+
+
+def run(counts):
+    """Times both row builders for every project count."""
+    results = []
+    for count in counts:
+        projects = synthetic_projects(count)
+        direct = time_rows(main.project_row, projects)
+        reference = time_rows(message_to_dict_row, projects)
+        results.append({
+            "projects": count,
+            "direct": direct,
+            "message_to_dict": reference,
+            "speedup": round(reference["seconds"] / direct["seconds"], 2),
+        })
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--projects", type=int, nargs="+",
+                        default=[10000, 100000])
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.projects), indent=2))
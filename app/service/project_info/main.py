@@ -7,263 +7,2432 @@
     Step 4 : Store Data in BigQuery
     Step 5 : Report Telemetry Metrics to GCP Monitoring
 """
+# pylint: disable=too-many-lines
 
+import asyncio
+import base64
+import hashlib
+import importlib.util
+import io
 import logging
+import logging.handlers
 import json
+import math
 import os
+import queue
+import random
+import sys
+import threading
 from datetime import datetime, timezone
+import functools
+from functools import lru_cache
 import time
-from google.cloud import resourcemanager_v3, bigquery, monitoring_v3
-from google.protobuf.json_format import MessageToDict
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from google.protobuf.timestamp_pb2 import Timestamp  # pylint: disable=E0611
 from google.api_core import exceptions
 import functions_framework
-import google.cloud.logging
+import grpc
 
-logging_client = google.cloud.logging.Client()
-logging_client.setup_logging()
-bq_client = bigquery.Client()
-monitoring_client = monitoring_v3.MetricServiceClient()
+
+def lazy_import(name):
+    """Imports a module on first attribute access instead of right away."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def lazy_class(module, name):
+    """Returns a factory for module.name that loads module when called."""
+    def create():
+        return getattr(module, name)()
+    return create
+
+
+# the client libraries dominate cold start; load them when first used
+resourcemanager_v3 = lazy_import("google.cloud.resourcemanager_v3")
+bigquery = lazy_import("google.cloud.bigquery")
+monitoring_v3 = lazy_import("google.cloud.monitoring_v3")
+
+# process-wide API clients, built on first use and reused by warm
+# invocations; None means the client has not been created yet
+projects_client = None  # pylint: disable=invalid-name
+folders_client = None  # pylint: disable=invalid-name
+bq_client = None  # pylint: disable=invalid-name
+monitoring_client = None  # pylint: disable=invalid-name
+client_states = {}
+cloud_logging_ready = False  # pylint: disable=invalid-name
+clients_lock = threading.Lock()
+logging_lock = threading.Lock()
 
 SERVICE_NAME = os.getenv("SERVICE_NAME", "project_info")
+# keepalive pings stop idle gRPC connections being dropped between runs
+GRPC_CHANNEL_OPTIONS = {
+    "grpc.keepalive_time_ms": int(os.getenv("GRPC_KEEPALIVE_MS", "30000")),
+    "grpc.keepalive_timeout_ms": 10000,
+}
+UNHEALTHY_CHANNEL_STATES = (
+    grpc.ChannelConnectivity.TRANSIENT_FAILURE,
+    grpc.ChannelConnectivity.SHUTDOWN,
+)
+
+
+def keepalive_transport(transport_class):
+    """Returns a transport factory whose channels use GRPC_CHANNEL_OPTIONS."""
+    def create_channel(host, **kwargs):
+        options = dict(kwargs.pop("options", None) or [])
+        options.update(GRPC_CHANNEL_OPTIONS)
+        return transport_class.create_channel(
+            host, options=list(options.items()), **kwargs)
+
+    return functools.partial(transport_class, channel=create_channel)
+
+
+def new_projects_client():
+    """Creates a Resource Manager Projects client on a keepalive channel."""
+    transports = resourcemanager_v3.services.projects.transports
+    return resourcemanager_v3.ProjectsClient(
+        transport=keepalive_transport(transports.ProjectsGrpcTransport))
+
+
+def new_folders_client():
+    """Creates a Resource Manager Folders client on a keepalive channel."""
+    transports = resourcemanager_v3.services.folders.transports
+    return resourcemanager_v3.FoldersClient(
+        transport=keepalive_transport(transports.FoldersGrpcTransport))
+
+
+def new_monitoring_client():
+    """Creates a Cloud Monitoring client on a keepalive channel."""
+    transports = monitoring_v3.services.metric_service.transports
+    return monitoring_v3.MetricServiceClient(
+        transport=keepalive_transport(
+            transports.MetricServiceGrpcTransport))
+
+
+CLIENT_FACTORIES = {
+    "projects_client": new_projects_client,
+    "folders_client": new_folders_client,
+    "bq_client": lazy_class(bigquery, "Client"),
+    "monitoring_client": new_monitoring_client,
+}
+
+
+def watch_channel(name, client):
+    """Tracks the connectivity of a client's gRPC channel, if it has one."""
+    channel = getattr(getattr(client, "transport", None), "grpc_channel", None)
+    if channel is None:
+        return
+
+    def on_state_change(state):
+        if globals()[name] is client:
+            client_states[name] = state
+
+    channel.subscribe(on_state_change, try_to_connect=False)
+
+
+def get_client(name):
+    """Returns a process-wide API client from the registry.
+
+    Clients are created on first use and then reused. A client whose
+    gRPC channel has failed or shut down is closed and rebuilt, so a
+    warm instance recovers from a dropped connection on its own.
+    """
+    with clients_lock:
+        client = globals()[name]
+        state = client_states.get(name)
+        reused = client is not None and state not in UNHEALTHY_CHANNEL_STATES
+        rebuilt = client is not None and not reused
+        if rebuilt:
+            try:
+                client.transport.close()
+            except Exception:  # pylint: disable=broad-except
+                pass
+        if not reused:
+            client = CLIENT_FACTORIES[name]()
+            globals()[name] = client
+            client_states.pop(name, None)
+            watch_channel(name, client)
+
+    # logging and metrics take locks of their own, so they are only
+    # reported once clients_lock is released
+    if reused:
+        monitor("dfc_client_reused", 1)
+        return client
+    if rebuilt:
+        log_event("warning", f"Rebuilt {name} after channel failure",
+                  "clients", state=str(state))
+        monitor("dfc_client_rebuilt", 1)
+    monitor("dfc_client_created", 1)
+    return client
+
+
+LOG_LEVELS = {"info": logging.INFO, "warning": logging.WARNING,
+              "error": logging.ERROR}
+# records wait in log_queue for the listener thread that writes them;
+# log_repeats holds [window start, entries written, entries suppressed]
+# for each (level, message)
+log_queue = None  # pylint: disable=invalid-name
+log_listener = None  # pylint: disable=invalid-name
+log_repeats = {}
+log_dropped = {"count": 0}
+log_lock = threading.Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as the JSON line Cloud Logging parses from stderr."""
+
+    def format(self, record):
+        return json.dumps({
+            "severity": record.levelname,
+            "message": record.getMessage(),
+            "time": datetime.fromtimestamp(
+                record.created, timezone.utc).isoformat(),
+            **getattr(record, "json_fields", {}),
+        }, default=str)
+
+
+# record attributes the Cloud Logging filter infers from the request,
+# and the ones it takes in preference to inferring them again
+REQUEST_FIELDS = {"trace": "_trace", "span_id": "_span_id",
+                  "trace_sampled": "_trace_sampled",
+                  "http_request": "_http_request"}
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Queues records unformatted; the listener thread formats them.
+
+    The request a record belongs to is only known on the calling thread,
+    so context_handler's filters resolve its trace and HTTP request
+    before it is queued. A full queue drops the record and counts it
+    rather than blocking the caller.
+    """
+
+    context_handler = None
+
+    def prepare(self, record):
+        if self.context_handler is not None:
+            self.context_handler.filter(record)
+            for name, inferred in REQUEST_FIELDS.items():
+                setattr(record, name, getattr(record, inferred, None))
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with log_lock:
+                log_dropped["count"] += 1
+
+
+def setup_cloud_logging():
+    """Routes logging through a queue to the Cloud Logging handler.
+
+    Set up on the first log of an instance. The handler runs on a
+    background listener thread, so a log call only queues a record.
+    """
+    global cloud_logging_ready, log_queue  # pylint: disable=W0603
+    global log_listener  # pylint: disable=global-statement
+    if cloud_logging_ready:
+        return
+    with logging_lock:
+        if cloud_logging_ready:
+            return
+        cloud_logging_ready = True
+        log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        queue_handler = LogQueueHandler(log_queue)
+        error = None
+        try:
+            # pylint: disable=import-outside-toplevel
+            import google.cloud.logging
+            from google.cloud.logging.handlers import setup_logging
+            handler = google.cloud.logging.Client().get_default_handler()
+            queue_handler.context_handler = handler
+            setup_logging(queue_handler)
+        except Exception as e:  # pylint: disable=broad-except
+            handler = logging.StreamHandler()
+            handler.setFormatter(JsonFormatter())
+            root = logging.getLogger()
+            if queue_handler not in root.handlers:
+                root.addHandler(queue_handler)
+            root.setLevel(logging.INFO)
+            error = e
+        log_listener = logging.handlers.QueueListener(log_queue, handler)
+        log_listener.start()
+    if error is not None:
+        log_event("warning", "Cloud Logging unavailable, using stderr",
+                  "logging", error=str(error))
+
+
+def repeats_suppressed(level, message):
+    """Counts an entry against its repeat limit.
+
+    Returns None when the entry should be dropped, otherwise how many
+    repeats of it were dropped since it was last written.
+    """
+    now = time.monotonic()
+    key = (level, message)
+    with log_lock:
+        window = log_repeats.get(key)
+        if window is None or now - window[0] >= LOG_REPEAT_WINDOW_SECONDS:
+            log_repeats[key] = [now, 1, 0]
+            return window[2] if window else 0
+        if window[1] < LOG_REPEAT_LIMIT:
+            window[1] += 1
+            return 0
+        window[2] += 1
+        return None
+
+
+def log_event(level, message, event, **kwargs):
+    """Structured log event.
+
+    Nothing is built for a disabled level. The event and keyword
+    arguments become the JSON payload of the entry. Past LOG_REPEAT_LIMIT
+    entries with one message within LOG_REPEAT_WINDOW_SECONDS, the rest
+    are counted instead of written, so a flood of per-project errors
+    cannot stall a run.
+    """
+    setup_cloud_logging()
+    log_level = LOG_LEVELS.get(level)
+    if log_level is None or not logging.getLogger().isEnabledFor(log_level):
+        return
+    suppressed = repeats_suppressed(level, message)
+    if suppressed is None:
+        return
+
+    fields = {"service_name": SERVICE_NAME, "event": event, **kwargs}
+    if suppressed:
+        fields["suppressed"] = suppressed
+    logging.log(log_level, message, extra={"service_name": SERVICE_NAME,
+                                           "json_fields": fields})
+
+
+def flush_logs(timeout=5.0):
+    """Reports dropped entries and waits for queued ones to be written.
+
+    Runs before an invocation returns, since an idle instance may not
+    get the CPU to drain the queue. Repeat windows that have ended are
+    dropped, as messages carrying IDs would otherwise pile up.
+    """
+    now = time.monotonic()
+    with log_lock:
+        suppressed = {message: window[2]
+                      for (_, message), window in log_repeats.items()
+                      if window[2]}
+        for key, window in list(log_repeats.items()):
+            window[2] = 0
+            if now - window[0] >= LOG_REPEAT_WINDOW_SECONDS:
+                del log_repeats[key]
+        dropped = log_dropped["count"]
+        log_dropped["count"] = 0
+    if suppressed or dropped:
+        log_event("warning", "Log entries suppressed", "logging",
+                  repeats=suppressed, queue_full=dropped)
+    if log_queue is None:
+        return
+    with log_queue.all_tasks_done:
+        log_queue.all_tasks_done.wait_for(
+            lambda: not log_queue.unfinished_tasks, timeout)
+    for handler in log_listener.handlers:
+        handler.flush()
+
+
+# variables
+BQ_TABLE = os.getenv("BQ_TABLE", "observability.project_info")
+# one folder, a comma-separated list, or the path of a file listing one
+# folder per line ("#" starts a comment); folders are collected in parallel
+FOLDER_ID = os.getenv("FOLDER_ID", "1062810406170")
+FOLDER_MAX_WORKERS = int(os.getenv("FOLDER_MAX_WORKERS", "4"))
+PROJECT_ID = os.getenv("GCP_PROJECT", "dev2-ea8f")
+STREAMING_MODE = os.getenv("STREAMING_MODE", "false").lower() == "true"
+# overlaps page fetch, transform and store; implies STREAMING_MODE
+OVERLAPPED_PIPELINE = os.getenv(
+    "OVERLAPPED_PIPELINE", "false").lower() == "true"
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "4"))
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "0"))
+RECURSIVE_CRAWL = os.getenv("RECURSIVE_CRAWL", "false").lower() == "true"
+CRAWL_MAX_WORKERS = int(os.getenv("CRAWL_MAX_WORKERS", "8"))
+# every Resource Manager call shares one adaptive token bucket: the rate
+# and calls in flight halve on 429/503 and creep back up while calls pass
+RM_MAX_QPS = float(os.getenv("RM_MAX_QPS", "10"))
+RM_MIN_QPS = float(os.getenv("RM_MIN_QPS", "0.5"))
+RM_MAX_CONCURRENCY = int(os.getenv("RM_MAX_CONCURRENCY", "8"))
+RM_MAX_ATTEMPTS = int(os.getenv("RM_MAX_ATTEMPTS", "5"))
+RM_BACKOFF_SECONDS = float(os.getenv("RM_BACKOFF_SECONDS", "0.5"))
+RM_BACKOFF_MAX_SECONDS = float(os.getenv("RM_BACKOFF_MAX_SECONDS", "8"))
+# "list" walks folders with ListProjects, "search" uses one SearchProjects
+# stream; SEARCH_QUERY overrides the default "parent:folders/<FOLDER_ID>"
+# and, as it is not scoped to a folder, runs once whatever FOLDER_ID lists
+COLLECTION_MODE = os.getenv("COLLECTION_MODE", "list").lower()
+SEARCH_QUERY = os.getenv("SEARCH_QUERY")
+# streaming insert batches stay below BigQuery's per-request limits
+INSERT_MAX_ROWS = int(os.getenv("INSERT_MAX_ROWS", "500"))
+INSERT_MAX_BYTES = int(os.getenv("INSERT_MAX_BYTES", "5000000"))
+STORE_MAX_WORKERS = int(os.getenv("STORE_MAX_WORKERS", "4"))
+INSERT_MAX_ATTEMPTS = int(os.getenv("INSERT_MAX_ATTEMPTS", "5"))
+INSERT_BACKOFF_SECONDS = float(os.getenv("INSERT_BACKOFF_SECONDS", "0.2"))
+INSERT_BACKOFF_MAX_SECONDS = float(
+    os.getenv("INSERT_BACKOFF_MAX_SECONDS", "5"))
+# rows that can never be inserted are logged and, if set, appended here
+DEAD_LETTER_PATH = os.getenv("DEAD_LETTER_PATH", "")
+# "stream" uses streaming inserts, "load" a Parquet batch load job;
+# LOAD_TARGET writes the Parquet file to a local path instead of BigQuery
+SINK_MODE = os.getenv("SINK_MODE", "stream").lower()
+LOAD_TARGET = os.getenv("LOAD_TARGET", "")
+# with CURRENT_TABLE set, snapshots also go to STAGING_TABLE and are
+# merged into one row per project; WRITE_HISTORY=false drops the
+# append-only history in BQ_TABLE
+CURRENT_TABLE = os.getenv("CURRENT_TABLE", "")
+STAGING_TABLE = os.getenv(
+    "STAGING_TABLE", f"{CURRENT_TABLE}_staging" if CURRENT_TABLE else "")
+WRITE_HISTORY = os.getenv("WRITE_HISTORY", "true").lower() == "true"
+# one row per invocation recording whether its run was complete or partial
+RUNS_TABLE = os.getenv("RUNS_TABLE", "")
+# incremental runs only write new, changed or deleted projects; the state
+# of the previous run lives in a local file or a gs://bucket/object
+INCREMENTAL_MODE = os.getenv("INCREMENTAL_MODE", "false").lower() == "true"
+STATE_URI = os.getenv("STATE_URI", "/tmp/project_info_state.json")
+# "?shards=N" fans a run out to N instances, each called with
+# "?shard=i&shards=N"; shards split the folder list, or project-id hash
+# ranges when there are fewer folders than shards ("auto")
+SHARD_BY = os.getenv("SHARD_BY", "auto").lower()
+SHARD_URL = os.getenv("SHARD_URL", "")
+SHARD_TIMEOUT_SECONDS = float(os.getenv("SHARD_TIMEOUT_SECONDS", "110"))
+# the most shards a request may ask for, each one an instance and a
+# coordinator thread; larger counts are rejected
+SHARD_MAX_COUNT = int(os.getenv("SHARD_MAX_COUNT", "32"))
+# progress of an unfinished run, so the next invocation resumes it;
+# implies STREAMING_MODE, since only stored pages count as progress
+CHECKPOINT_URI = os.getenv("CHECKPOINT_URI", "")
+CHECKPOINT_INTERVAL_SECONDS = float(
+    os.getenv("CHECKPOINT_INTERVAL_SECONDS", "5"))
+# page tokens expire, so an older checkpoint starts a new run instead
+CHECKPOINT_MAX_AGE_SECONDS = float(
+    os.getenv("CHECKPOINT_MAX_AGE_SECONDS", "3600"))
+# fetching stops DEADLINE_MARGIN_SECONDS before the function timeout, so
+# what was already fetched is still stored and metrics are flushed
+FUNCTION_TIMEOUT_SECONDS = float(os.getenv("FUNCTION_TIMEOUT_SECONDS", "120"))
+DEADLINE_MARGIN_SECONDS = float(os.getenv("DEADLINE_MARGIN_SECONDS", "20"))
+# lock object (local path or gs:// URI) that makes an overlapping trigger
+# on another instance skip; it expires with the function timeout
+RUN_LOCK_URI = os.getenv("RUN_LOCK_URI", "")
+# project change events arriving within EVENT_BATCH_SECONDS of the first
+# one are fetched and stored together by main_event
+EVENT_BATCH_SECONDS = float(os.getenv("EVENT_BATCH_SECONDS", "5"))
+# log entries queue for a background writer; past LOG_REPEAT_LIMIT
+# entries with the same message per LOG_REPEAT_WINDOW_SECONDS the rest
+# are counted and summarised instead of written
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_REPEAT_LIMIT = int(os.getenv("LOG_REPEAT_LIMIT", "10"))
+LOG_REPEAT_WINDOW_SECONDS = float(
+    os.getenv("LOG_REPEAT_WINDOW_SECONDS", "60"))
+# latency histograms use exponential buckets whose lower bounds are
+# HISTOGRAM_SCALE_SECONDS * HISTOGRAM_GROWTH_FACTOR ** (i - 1)
+HISTOGRAM_BUCKETS = int(os.getenv("HISTOGRAM_BUCKETS", "20"))
+HISTOGRAM_GROWTH_FACTOR = float(os.getenv("HISTOGRAM_GROWTH_FACTOR", "2"))
+HISTOGRAM_SCALE_SECONDS = float(
+    os.getenv("HISTOGRAM_SCALE_SECONDS", "0.001"))
+# PROFILE_SAMPLE_RATE=N profiles one invocation in N with cProfile and
+# tracemalloc (0 turns sampling off); a request whose X-Profile header
+# matches PROFILE_TOKEN is always profiled. Reports are logged and, with
+# PROFILE_URI, also written under that directory or gs:// prefix
+PROFILE_SAMPLE_RATE = int(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "20"))
+PROFILE_URI = os.getenv("PROFILE_URI", "")
+PROFILE_HEADER = "X-Profile"
+
+if not BQ_TABLE or not FOLDER_ID or not PROJECT_ID:
+    log_event("error", "Missing environment variables", "config_error")
+
+if COLLECTION_MODE not in ("list", "search"):
+    log_event("error", f"Unknown COLLECTION_MODE {COLLECTION_MODE}",
+              "config_error")
+
+if SINK_MODE not in ("stream", "load"):
+    log_event("error", f"Unknown SINK_MODE {SINK_MODE}", "config_error")
+
+
+LOAD_ERRORS = (
+    (exceptions.InvalidArgument, "Invalid folder ID"),
+    (exceptions.PermissionDenied, "Permission denied to access folder"),
+    (exceptions.NotFound, "Folder not found"),
+    (exceptions.ServiceUnavailable,
+     "Resource Manager API service unavailable"),
+    (exceptions.DeadlineExceeded, "Resource Manager API request timed out"),
+    (exceptions.GoogleAPICallError, "General Resource Manager API error"),
+    (KeyError, "Key error"),
+    (ValueError, "Value error"),
+    (TimeoutError, "Timeout error"),
+)
+
+
+# errors seen while collecting the current run; a run with errors is an
+# incomplete view of the folder, so missing projects are not deletions
+load_failures = []
+# tables a write of the current run failed for, or the errors of pages
+# the pipeline's store stage dropped
+store_failures = []
+
+
+def log_load_error(error):
+    """Logs a Resource Manager collection error with a readable message."""
+    load_failures.append(str(error))
+    message = next(
+        (text for error_type, text in LOAD_ERRORS
+         if isinstance(error, error_type)),
+        "Unexpected error")
+    log_event("error", f"{message}: {str(error)}", "load", error=str(error))
+
+
+# monotonic time by which the current run must stop fetching, and the
+# stages that stopped early because of it; such a run is partial
+run_deadline = float("inf")
+deadline_stops = []
+
+
+def start_deadline():
+    """Starts the time budget of a run from the function timeout."""
+    global run_deadline  # pylint: disable=global-statement
+    run_deadline = (time.monotonic() + FUNCTION_TIMEOUT_SECONDS
+                    - DEADLINE_MARGIN_SECONDS)
+
+
+def time_left():
+    """Returns the seconds left before the run must stop fetching."""
+    return run_deadline - time.monotonic()
+
+
+def out_of_time(stage, needed=0.0):
+    """Whether a stage must stop because the budget cannot cover needed."""
+    if time_left() > needed:
+        return False
+    if stage not in deadline_stops:
+        log_event("warning", f"Deadline reached, stopping {stage} early",
+                  "deadline", stage=stage, time_left=time_left())
+    deadline_stops.append(stage)
+    monitor("dfc_deadline_stops", 1, stage=stage)
+    return True
+
+
+def run_complete():
+    """Whether the current run saw every folder without errors or cutoffs
+    and stored everything it saw.
+    """
+    return not load_failures and not deadline_stops and not store_failures
+
+
+class RateLimiter:  # pylint: disable=too-many-instance-attributes
+    """Token bucket with an adaptive rate and limit on calls in flight.
+
+    Both shrink by half when the API throttles and grow additively while
+    calls succeed, so concurrent crawls settle just under the quota and
+    recover once throttling stops.
+    """
+
+    def __init__(self, max_rate, min_rate, max_concurrency):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.max_concurrency = max_concurrency
+        self.rate = max_rate
+        self.concurrency = max_concurrency
+        self.tokens = max(1.0, max_rate)
+        self.updated = time.monotonic()
+        self.in_flight = 0
+        self.successes = 0
+        self.throttled = 0
+        self.waited = 0.0
+        self.condition = threading.Condition()
+
+    def reserve(self):
+        """Takes a token and returns how long to wait before using it."""
+        with self.condition:
+            now = time.monotonic()
+            self.tokens = min(max(1.0, self.rate), self.tokens
+                              + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            delay = max(0.0, -self.tokens / self.rate)
+            self.waited += delay
+            return delay
+
+    def acquire(self):
+        """Blocks until a call may start: a slot in flight and a token."""
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.in_flight < self.concurrency)
+            self.in_flight += 1
+        time.sleep(self.reserve())
+
+    def take_slot(self):
+        """Takes a slot in flight if one is free, without waiting."""
+        with self.condition:
+            if self.in_flight >= self.concurrency:
+                return False
+            self.in_flight += 1
+            return True
+
+    async def acquire_async(self, poll_seconds=0.01):
+        """acquire for coroutines: polls for a slot so the loop never
+        blocks, since slots are also freed by threads it cannot await.
+        """
+        while not self.take_slot():
+            await asyncio.sleep(poll_seconds)
+        await asyncio.sleep(self.reserve())
+
+    def release(self, throttled=None):
+        """Frees the slot of a finished call and adapts to its outcome."""
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+        self.feedback(throttled)
+
+    def feedback(self, throttled):
+        """Halves rate and concurrency on throttling, grows them on success.
+
+        throttled is None for calls that failed for other reasons, which
+        leave the limits unchanged.
+        """
+        if throttled is None:
+            return
+        with self.condition:
+            if throttled:
+                self.throttled += 1
+                self.successes = 0
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.concurrency = max(1, self.concurrency // 2)
+                return
+            self.successes += 1
+            self.rate = min(self.max_rate, self.rate + self.min_rate / 4)
+            if self.successes >= self.concurrency:
+                self.successes = 0
+                self.concurrency = min(self.max_concurrency,
+                                       self.concurrency + 1)
+            self.condition.notify_all()
+
+    def report(self):
+        """Reports the limiter state and resets the per-run counters."""
+        with self.condition:
+            throttled, self.throttled = self.throttled, 0
+            waited, self.waited = self.waited, 0.0
+            rate, concurrency = self.rate, self.concurrency
+        monitor("dfc_rm_limiter_rate", rate)
+        monitor("dfc_rm_limiter_concurrency", concurrency)
+        monitor("dfc_rm_limiter_throttled", throttled)
+        monitor("dfc_rm_limiter_wait", waited)
+
+
+rm_limiter = RateLimiter(RM_MAX_QPS, RM_MIN_QPS, RM_MAX_CONCURRENCY)
+RM_THROTTLE_ERRORS = (
+    exceptions.TooManyRequests,
+    exceptions.ServiceUnavailable,
+)
+RM_RETRYABLE_ERRORS = RM_THROTTLE_ERRORS + (
+    exceptions.InternalServerError,
+    exceptions.DeadlineExceeded,
+)
+
+
+def rm_retry_delay(error, attempt):
+    """Returns the backoff before retry number attempt, or re-raises."""
+    delay = backoff_delay(attempt - 1, RM_BACKOFF_SECONDS,
+                          RM_BACKOFF_MAX_SECONDS)
+    if attempt >= RM_MAX_ATTEMPTS or out_of_time("fetch", delay):
+        raise error
+    log_event("warning", "Retrying Resource Manager call", "load",
+              attempt=attempt, error=str(error))
+    monitor("dfc_rm_retries", 1)
+    return delay
+
+
+def rm_pages(method, request):
+    """Yields the response pages of a listing, one limited call each.
+
+    A throttled or failed page is retried from its page token after a
+    jittered backoff instead of failing or restarting the listing. The
+    listing stops before any page the deadline leaves no time for.
+    """
+    pages = None
+    page_token = None
+    attempt = 0
+    while True:
+        # an empty token means the last page came; ending needs no call
+        if page_token != "" and out_of_time("fetch"):
+            return
+        delay = None
+        throttled = None
+        page = None
+        outcome = "error"
+        rm_limiter.acquire()
+        start_time = time.time()
+        try:
+            if pages is None:
+                if page_token is not None:
+                    request.page_token = page_token
+                pages = iter(method(request=request).pages)
+            page = next(pages, None)
+            throttled = False
+            outcome = "ok"
+        except RM_RETRYABLE_ERRORS as e:
+            throttled = isinstance(e, RM_THROTTLE_ERRORS) or None
+            outcome = "throttled" if throttled else "error"
+            attempt += 1
+            pages = None
+            delay = rm_retry_delay(e, attempt)
+        finally:
+            rm_limiter.release(throttled)
+            # the call after the last page ends the listing without an RPC
+            if page is not None or outcome != "ok":
+                observe_rpc("fetch", method, outcome,
+                            time.time() - start_time, request)
+        if delay is not None:
+            time.sleep(delay)
+            continue
+
+        attempt = 0
+        if page is None:
+            return
+        page_token = page.next_page_token
+        yield page
+
+
+def rm_call(method, request):
+    """Makes one limited Resource Manager call, retried like rm_pages."""
+    attempt = 0
+    while True:
+        delay = None
+        throttled = None
+        outcome = "error"
+        rm_limiter.acquire()
+        start_time = time.time()
+        try:
+            response = method(request=request)
+            throttled = False
+            outcome = "ok"
+        except RM_RETRYABLE_ERRORS as e:
+            throttled = isinstance(e, RM_THROTTLE_ERRORS) or None
+            outcome = "throttled" if throttled else "error"
+            attempt += 1
+            delay = rm_retry_delay(e, attempt)
+        finally:
+            rm_limiter.release(throttled)
+            observe_rpc("fetch", method, outcome, time.time() - start_time,
+                        request)
+        if delay is None:
+            return response
+        time.sleep(delay)
+
+
+async def rm_pages_async(method, request):
+    """Async rm_pages: the same limiter and retries on the event loop."""
+    pages = None
+    page_token = None
+    attempt = 0
+    while True:
+        delay = None
+        throttled = None
+        page = None
+        outcome = "error"
+        await rm_limiter.acquire_async()
+        start_time = time.time()
+        try:
+            if pages is None:
+                if page_token is not None:
+                    request.page_token = page_token
+                pages = aiter((await method(request=request)).pages)
+            page = await anext(pages, None)
+            throttled = False
+            outcome = "ok"
+        except RM_RETRYABLE_ERRORS as e:
+            throttled = isinstance(e, RM_THROTTLE_ERRORS) or None
+            outcome = "throttled" if throttled else "error"
+            attempt += 1
+            pages = None
+            delay = rm_retry_delay(e, attempt)
+        finally:
+            rm_limiter.release(throttled)
+            if page is not None or outcome != "ok":
+                observe_rpc("fetch", method, outcome,
+                            time.time() - start_time, request)
+        if delay is not None:
+            await asyncio.sleep(delay)
+            continue
+
+        attempt = 0
+        if page is None:
+            return
+        page_token = page.next_page_token
+        yield page
+
+
+def list_projects(client, folder_id):
+    """Lists the projects directly under a folder, counting its calls
+    like search_projects.
+    """
+    request = resourcemanager_v3.ListProjectsRequest(
+        parent=f"folders/{folder_id}")
+    projects = []
+    page_count = 0
+    for page in rm_pages(client.list_projects, request):
+        page_count += 1
+        projects.extend(page.projects)
+    monitor("dfc_prj_api_calls", page_count)
+    return projects
+
+
+def search_query(folder_id):
+    """Returns the SearchProjects query used for a folder."""
+    if SEARCH_QUERY is not None:
+        return SEARCH_QUERY
+    return f"parent:folders/{folder_id}"
+
+
+def search_projects(client, folder_id):
+    """Collects projects matching the search query in one paged stream."""
+    request = resourcemanager_v3.SearchProjectsRequest(
+        query=search_query(folder_id), page_size=PAGE_SIZE)
+    projects = []
+    page_count = 0
+    for page in rm_pages(client.search_projects, request):
+        page_count += 1
+        projects.extend(page.projects)
+    monitor("dfc_prj_api_calls", page_count)
+    return projects
+
+
+def project_pages(client, folder_id, page_token=""):
+    """Pages through the project listing of the configured collection mode."""
+    if COLLECTION_MODE == "search":
+        return rm_pages(
+            client.search_projects,
+            resourcemanager_v3.SearchProjectsRequest(
+                query=search_query(folder_id), page_size=PAGE_SIZE,
+                page_token=page_token))
+    return rm_pages(
+        client.list_projects,
+        resourcemanager_v3.ListProjectsRequest(
+            parent=f"folders/{folder_id}", page_size=PAGE_SIZE,
+            page_token=page_token))
+
+
+def list_subfolders(client, folder_id):
+    """Lists the IDs of the folders directly under a folder."""
+    request = resourcemanager_v3.ListFoldersRequest(
+        parent=f"folders/{folder_id}")
+    return [folder.name.split("/")[-1]
+            for page in rm_pages(client.list_folders, request)
+            for folder in page.folders]
+
+
+def get_projects(folder_id):
+    """Fetches projects from GCP Resource Manager API."""
+    projects = []
+
+    try:
+        start_time = time.time()
+        client = get_client("projects_client")
+        if COLLECTION_MODE == "search":
+            projects = search_projects(client, folder_id)
+        else:
+            projects = list_projects(client, folder_id)
+        duration = time.time() - start_time
+        monitor("dfc_prj_api_duration", duration)
+
+        if not projects:
+            log_event(
+                "warning",
+                f"No projects found under folder {folder_id}",
+                "load"
+            )
+
+    except Exception as e:  # pylint: disable=broad-except
+        log_load_error(e)
+
+    return projects
+
+
+def crawl_folder(projects_api, folders_api, folder_id):
+    """Returns the subfolder IDs and projects directly under one folder."""
+    try:
+        return (list_subfolders(folders_api, folder_id),
+                list_projects(projects_api, folder_id))
+    except Exception as e:  # pylint: disable=broad-except
+        log_load_error(e)
+        return [], []
+
+
+def get_projects_recursive(folder_id, max_workers=None):
+    """Fetches projects from a folder and every folder nested beneath it.
+
+    Folders are crawled on a bounded thread pool; each finished folder
+    schedules its subfolders straight away, so sibling branches of the
+    tree are listed concurrently instead of one after another.
+    """
+    start_time = time.time()
+    projects_api = get_client("projects_client")
+    folders_api = get_client("folders_client")
+    projects = []
+    folder_count = 0
+
+    with ThreadPoolExecutor(
+            max_workers=max_workers or CRAWL_MAX_WORKERS) as executor:
+        pending = {executor.submit(
+            crawl_folder, projects_api, folders_api, folder_id)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                subfolders, folder_projects = future.result()
+                folder_count += 1
+                projects.extend(folder_projects)
+                if subfolders and out_of_time("crawl"):
+                    continue
+                pending.update(
+                    executor.submit(crawl_folder, projects_api,
+                                    folders_api, subfolder)
+                    for subfolder in subfolders)
+
+    monitor("dfc_prj_api_duration", time.time() - start_time)
+    monitor("dfc_prj_folder_count", folder_count)
+    if not projects:
+        log_event(
+            "warning",
+            f"No projects found under folder tree {folder_id}",
+            "load"
+        )
+    return projects
+
+
+def folder_tree(folders, max_workers=None):
+    """Returns the folders and every folder nested beneath them.
+
+    The paged path lists each folder's own projects, so with
+    RECURSIVE_CRAWL it walks the tree first, concurrently like
+    get_projects_recursive. A folder that cannot be listed, or a walk cut
+    short by the deadline, leaves the run incomplete.
+    """
+    folders_api = get_client("folders_client")
+    tree = list(folders)
+
+    def subfolders(folder_id):
+        try:
+            return list_subfolders(folders_api, folder_id)
+        except Exception as e:  # pylint: disable=broad-except
+            log_load_error(e)
+            return []
+
+    with ThreadPoolExecutor(
+            max_workers=max_workers or CRAWL_MAX_WORKERS) as executor:
+        pending = {executor.submit(subfolders, folder_id)
+                   for folder_id in folders}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                children = future.result()
+                tree.extend(children)
+                if children and out_of_time("crawl"):
+                    continue
+                pending.update(executor.submit(subfolders, child)
+                               for child in children)
+
+    monitor("dfc_prj_folder_count", len(tree))
+    return tree
+
+
+class Page(list):
+    """A page of projects or rows and where its folder listing resumes."""
+
+    def __init__(self, items, folder_id, next_page_token):
+        super().__init__(items)
+        self.folder_id = folder_id
+        self.next_page_token = next_page_token
+
+
+def page_labels(page):
+    """Labels a page's metrics with its folder, when it is known."""
+    return {"folder_id": page.folder_id} if isinstance(page, Page) else {}
+
+
+def get_project_pages(folder_id):
+    """Yields projects from GCP Resource Manager API one page at a time.
+
+    Only the current page is held in memory, so callers can transform and
+    store each page before the next one is fetched. A run resumed from a
+    checkpoint starts at the page the checkpoint recorded.
+    """
+    fetch_time = 0.0
+    page_count = 0
+
+    try:
+        client = get_client("projects_client")
+        page_token = current_run.get("page_tokens", {}).get(folder_id, "")
+        pages = project_pages(client, folder_id, page_token)
+
+        while not out_of_time("fetch"):
+            start_time = time.time()
+            page = next(pages, None)
+            fetch_time += time.time() - start_time
+            if page is None:
+                break
+            page_count += 1
+            yield Page(page.projects, folder_id, page.next_page_token)
+
+        monitor("dfc_prj_api_duration", fetch_time)
+        monitor("dfc_prj_api_calls", page_count)
+        if not page_count:
+            log_event(
+                "warning",
+                f"No projects found under folder {folder_id}",
+                "load"
+            )
+
+    except Exception as e:  # pylint: disable=broad-except
+        log_load_error(e)
+
+
+def folder_ids():
+    """Returns the folders to collect, parsed from FOLDER_ID."""
+    value = FOLDER_ID
+    if os.path.isfile(value):
+        with open(value, encoding="utf-8") as folders_file:
+            value = ",".join(line.split("#")[0] for line in folders_file)
+    return [folder.strip().removeprefix("folders/")
+            for folder in value.split(",") if folder.strip()]
+
+
+def collection_folders():
+    """Returns the folders a run collects from.
+
+    An overriding SEARCH_QUERY returns the same projects for every folder,
+    so it is run for the first folder only instead of once per folder.
+    """
+    folders = folder_ids()
+    if COLLECTION_MODE == "search" and SEARCH_QUERY is not None:
+        return folders[:1]
+    return folders
+
+
+def monitor_folder(folder_id, duration, project_count):
+    """Reports how long one folder took and how many projects it held."""
+    monitor("dfc_folder_duration", duration, folder_id=folder_id)
+    monitor("dfc_folder_projects", project_count, folder_id=folder_id)
+
+
+def fetch_folder(folder_id):
+    """Fetches one folder's projects; a failure only empties that folder."""
+    if out_of_time("fetch"):
+        return []
+    start_time = time.time()
+    try:
+        if RECURSIVE_CRAWL and COLLECTION_MODE == "list":
+            projects = get_projects_recursive(folder_id)
+        else:
+            projects = get_projects(folder_id)
+    except Exception as e:  # pylint: disable=broad-except
+        log_load_error(e)
+        projects = []
+    monitor_folder(folder_id, time.time() - start_time, len(projects))
+    return projects
+
+
+def get_folders_projects(folders):
+    """Fetches the projects of several folders in parallel."""
+    if len(folders) == 1:
+        return fetch_folder(folders[0])
+    with ThreadPoolExecutor(max_workers=FOLDER_MAX_WORKERS) as executor:
+        return [project for projects in executor.map(fetch_folder, folders)
+                for project in projects]
+
+
+def folder_pages(folder_id):
+    """Yields one folder's project pages and reports its folder metrics."""
+    if folder_id in current_run.get("folders_done", ()):
+        return
+    start_time = time.time()
+    project_count = 0
+    for page in get_project_pages(folder_id):
+        project_count += len(page)
+        yield page
+    monitor_folder(folder_id, time.time() - start_time, project_count)
+
+
+def get_folders_pages(folders):
+    """Yields project pages from several folders fetched in parallel.
+
+    Each folder is paged on its own thread into one bounded queue, so at
+    most PIPELINE_QUEUE_SIZE pages wait in memory whatever the fan-out.
+    """
+    if len(folders) == 1:
+        yield from folder_pages(folders[0])
+        return
+
+    pages = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+
+    def feed(folder_id):
+        try:
+            for page in folder_pages(folder_id):
+                pages.put(page)
+        except Exception as e:  # pylint: disable=broad-except
+            log_load_error(e)
+        finally:
+            pages.put(PIPELINE_DONE)
+
+    remaining = len(folders)
+    with ThreadPoolExecutor(max_workers=FOLDER_MAX_WORKERS) as executor:
+        for folder_id in folders:
+            executor.submit(feed, folder_id)
+        try:
+            while remaining:
+                page = pages.get()
+                if page is PIPELINE_DONE:
+                    remaining -= 1
+                else:
+                    yield page
+        finally:
+            # unblock feeders if the consumer stopped early
+            while remaining:
+                if pages.get() is PIPELINE_DONE:
+                    remaining -= 1
+
+
+# (index, count) of the shard this run collects; (0, 1) is everything
+current_shard = (0, 1)
+# whether the shards split project-id hash ranges instead of folders
+shard_by_hash = False  # pylint: disable=invalid-name
+
+
+def set_shard(index, count):
+    """Selects the shard this run collects and how shards are split."""
+    global current_shard, shard_by_hash  # pylint: disable=global-statement
+    current_shard = (index, count)
+    if SHARD_BY == "auto":
+        shard_by_hash = count > 1 and len(collection_folders()) < count
+    else:
+        shard_by_hash = count > 1 and SHARD_BY == "project"
+
+
+def shard_folders(folders):
+    """Returns the folders the current shard lists."""
+    index, count = current_shard
+    if count == 1 or shard_by_hash:
+        return folders
+    return folders[index::count]
+
+
+def in_shard(project_id):
+    """Whether a project belongs to the current shard's hash range."""
+    if not shard_by_hash:
+        return True
+    index, count = current_shard
+    return zlib.crc32(project_id.encode("utf-8")) % count == index
+
+
+@lru_cache(maxsize=None)
+def project_states():
+    """Maps Project.State numbers to names, as MessageToDict renders them."""
+    state_field = resourcemanager_v3.Project.pb().DESCRIPTOR.fields_by_name[
+        "state"]
+    return {value.number: value.name
+            for value in state_field.enum_type.values}
+
+
+def proto_timestamp(message, field):
+    """Formats a Timestamp field as RFC 3339, or None when it is unset."""
+    if not message.HasField(field):
+        return None
+    return getattr(message, field).ToJsonString()
+
+
+def project_row(project, ingestion_timestamp, run_id=None):
+    """Builds a BigQuery row straight from the Project proto fields.
+
+    Produces the same row as a MessageToDict round trip (unset fields are
+    None, timestamps use the proto JSON format) without its reflection.
+    """
+    pb = project._pb  # pylint: disable=W0212
+    states = project_states()
+    return {
+        "project_id": pb.project_id or None,
+        "project_number": pb.name or None,
+        "folder_id": pb.parent or None,
+        "project_name": pb.display_name or None,
+        "state": states.get(pb.state) if pb.state else None,
+        "create_time": proto_timestamp(pb, "create_time"),
+        "update_time": proto_timestamp(pb, "update_time"),
+        "ingestion_time": ingestion_timestamp,
+        "etag": pb.etag or None,
+        "labels": [{"key": k, "value": v} for k, v in pb.labels.items()],
+        "run_id": run_id,
+    }
+
+
+def transform(projects, run=None):
+    """Transforms GCP project data for BigQuery.
+
+    Rows carry the run_id and ingestion_time of run, or of current_run
+    when no run is given.
+    """
+    start_time = time.time()
+    run = current_run if run is None else run
+    ingestion_timestamp = run.get(
+        "ingestion_time") or datetime.now(timezone.utc).isoformat()
+    run_id = run.get("run_id")
+    rows = []
+
+    for project in projects:
+        try:
+            if in_shard(project.project_id):
+                rows.append(
+                    project_row(project, ingestion_timestamp, run_id))
+
+        except Exception as e:  # pylint: disable=broad-except
+            log_event("error", "Error transforming project data",
+                      "transform", project_id=getattr(
+                          project, "project_id", None), error=str(e))
+
+    duration = time.time() - start_time
+    monitor("dfc_prj_processing_duration", duration)
+    return rows
+
+
+STORE_ERRORS = (
+    (exceptions.BadRequest, "BigQuery Bad Request error"),
+    (exceptions.NotFound, "BigQuery Not Found error"),
+    (exceptions.Forbidden, "BigQuery Forbidden error"),
+    (exceptions.ServiceUnavailable, "BigQuery Service Unavailable error"),
+    (exceptions.TooManyRequests, "BigQuery Too Many Requests error"),
+    (exceptions.GoogleAPICallError, "General BigQuery API error"),
+    (TypeError, "Type error during BigQuery insertion"),
+    (ValueError, "Value error during BigQuery insertion"),
+)
+
+
+def log_store_error(error, **kwargs):
+    """Logs a BigQuery insertion error with a readable message."""
+    message = next(
+        (text for error_type, text in STORE_ERRORS
+         if isinstance(error, error_type)),
+        "Unable to insert to project_info")
+    log_event("error", message, "store", error=str(error), **kwargs)
+
+
+def chunk_rows(rows, max_rows=None, max_bytes=None):
+    """Splits rows into insert batches bounded by row count and JSON size.
+
+    A single row larger than max_bytes is sent on its own so that BigQuery
+    rejects only that row rather than the rows batched alongside it.
+    """
+    max_rows = max_rows or INSERT_MAX_ROWS
+    max_bytes = max_bytes or INSERT_MAX_BYTES
+    chunk = []
+    chunk_bytes = 0
+
+    for row in rows:
+        row_bytes = len(json.dumps(row).encode("utf-8"))
+        if chunk and (len(chunk) >= max_rows
+                      or chunk_bytes + row_bytes > max_bytes):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(row)
+        chunk_bytes += row_bytes
+
+    if chunk:
+        yield chunk
+
+
+# per-row reasons returned by insertAll that are worth resending
+RETRYABLE_INSERT_REASONS = {
+    "stopped", "backendError", "internalError", "rateLimitExceeded", "timeout"}
+RETRYABLE_INSERT_ERRORS = (
+    exceptions.TooManyRequests,
+    exceptions.ServiceUnavailable,
+    exceptions.InternalServerError,
+    exceptions.BadGateway,
+    exceptions.DeadlineExceeded,
+)
+
+
+def backoff_delay(attempt, base=None, cap=None):
+    """Returns a full-jitter exponential backoff delay for a retry."""
+    base = INSERT_BACKOFF_SECONDS if base is None else base
+    cap = INSERT_BACKOFF_MAX_SECONDS if cap is None else cap
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def row_id(row):
+    """Returns the insert ID that lets BigQuery drop a resent row.
+
+    The ID only depends on the run, the project and its etag. The
+    streaming API drops repeats on a best-effort basis for about a
+    minute, which covers quick retries but not a resumed run resending
+    pages; the MERGE and the project_info_dedup view keep one row per
+    run and project for that.
+    """
+    run_id = row.get("run_id") or current_run.get("run_id")
+    key = f"{run_id}:{row['project_id']}:{row.get('etag')}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def split_insert_errors(chunk, errors):
+    """Splits insertAll row errors into retryable rows and dead letters."""
+    retry_rows = []
+    dead_letters = []
+    for error in errors:
+        row = chunk[error["index"]]
+        row_errors = error.get("errors", [])
+        reasons = {row_error.get("reason") for row_error in row_errors}
+        if reasons and reasons <= RETRYABLE_INSERT_REASONS:
+            retry_rows.append(row)
+        else:
+            dead_letters.append({"row": row, "errors": row_errors})
+    return retry_rows, dead_letters
+
+
+def insert_chunk(chunk, table=None):
+    """Inserts one batch of rows, resending only the rows that failed.
+
+    Rows rejected for transient reasons (and whole requests throttled or
+    refused by the backend) are retried with jittered exponential backoff;
+    rows that can never succeed are returned as dead-letter entries.
+    """
+    pending = chunk
+    dead_letters = []
+    reason = "retriesExhausted"
+
+    for attempt in range(INSERT_MAX_ATTEMPTS):
+        if attempt:
+            delay = backoff_delay(attempt - 1)
+            if out_of_time("store", delay):
+                reason = "deadlineExceeded"
+                break
+            time.sleep(delay)
+        start_time = time.time()
+        try:
+            errors = get_client("bq_client").insert_rows_json(
+                table or BQ_TABLE, pending,
+                row_ids=[row_id(row) for row in pending])
+            outcome = "partial" if errors else "ok"
+        except RETRYABLE_INSERT_ERRORS as e:
+            errors = [{"index": index,
+                       "errors": [{"reason": "backendError",
+                                   "message": str(e)}]}
+                      for index in range(len(pending))]
+            outcome = "error"
+        monitor("dfc_bigquery_chunk_insert_duration",
+                time.time() - start_time)
+        observe_rpc("store", "insert_rows_json", outcome,
+                    time.time() - start_time)
+
+        pending, rejected = split_insert_errors(pending, errors)
+        dead_letters.extend(rejected)
+        if not pending:
+            return dead_letters
+        log_event("warning", "Retrying failed BigQuery rows", "store",
+                  rows=len(pending), attempt=attempt + 1)
+
+    dead_letters.extend(
+        {"row": row, "errors": [{"reason": reason}]}
+        for row in pending)
+    return dead_letters
+
+
+def dead_letter(entries):
+    """Sends rows that could not be inserted to the dead-letter sink."""
+    log_event("error", "Failed to insert data into project_info", "store",
+              rows=len(entries), errors=[entry["errors"] for entry in entries])
+    monitor("dfc_bigquery_dead_letter_rows", len(entries))
+    if not DEAD_LETTER_PATH:
+        return
+    try:
+        with open(DEAD_LETTER_PATH, "a", encoding="utf-8") as sink:
+            for entry in entries:
+                sink.write(json.dumps(entry) + "\n")
+    except OSError as e:
+        log_event("error", "Unable to write dead-letter rows", "store",
+                  path=DEAD_LETTER_PATH, error=str(e))
+
+
+def parse_timestamp(value):
+    """Parses an RFC 3339 timestamp string into an aware datetime."""
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def arrow_schema():
+    """Returns the Arrow schema matching infra/schema/project_info.json."""
+    import pyarrow as pa  # pylint: disable=import-outside-toplevel
+
+    timestamp = pa.timestamp("us", tz="UTC")
+    return pa.schema([
+        pa.field("project_id", pa.string(), nullable=False),
+        pa.field("project_number", pa.string(), nullable=False),
+        pa.field("folder_id", pa.string()),
+        pa.field("project_name", pa.string()),
+        pa.field("state", pa.string()),
+        pa.field("create_time", timestamp),
+        pa.field("update_time", timestamp),
+        pa.field("ingestion_time", timestamp),
+        pa.field("etag", pa.string()),
+        pa.field("labels", pa.list_(pa.struct([
+            pa.field("key", pa.string()),
+            pa.field("value", pa.string()),
+        ]))),
+        pa.field("run_id", pa.string()),
+    ])
+
+
+def rows_to_arrow(rows):
+    """Builds a columnar Arrow table from transformed rows."""
+    import pyarrow as pa  # pylint: disable=import-outside-toplevel
+
+    columns = {field: [row.get(field) for row in rows]
+               for field in arrow_schema().names}
+    for field in ("create_time", "update_time", "ingestion_time"):
+        columns[field] = [parse_timestamp(value) for value in columns[field]]
+    columns["labels"] = [labels or [] for labels in columns["labels"]]
+    return pa.Table.from_pydict(columns, schema=arrow_schema())
+
+
+def rows_to_parquet(rows):
+    """Serialises transformed rows, or an Arrow table of them, into an
+    in-memory Parquet file.
+    """
+    import pyarrow as pa  # pylint: disable=import-outside-toplevel
+    import pyarrow.parquet as pq  # pylint: disable=import-outside-toplevel
+
+    if not isinstance(rows, pa.Table):
+        rows = rows_to_arrow(rows)
+    buffer = io.BytesIO()
+    pq.write_table(rows, buffer, compression="snappy")
+    buffer.seek(0)
+    return buffer
+
+
+def load_parquet(rows, table=None):
+    """Loads transformed project data into BigQuery with a load job.
+
+    The whole snapshot is written as one Parquet file, which is far smaller
+    than the equivalent streaming insert payload and is not billed as
+    streaming ingestion. When LOAD_TARGET is set the file is written there
+    instead, so the sink can be exercised without BigQuery.
+    """
+    start_time = time.time()
+    try:
+        parquet = rows_to_parquet(rows)
+        monitor("dfc_parquet_bytes", parquet.getbuffer().nbytes)
+
+        if LOAD_TARGET:
+            with open(LOAD_TARGET, "wb") as target:
+                target.write(parquet.getbuffer())
+        else:
+            parquet_options = bigquery.ParquetOptions()
+            parquet_options.enable_list_inference = True
+            job_config = bigquery.LoadJobConfig(
+                source_format=bigquery.SourceFormat.PARQUET,
+                write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+                parquet_options=parquet_options)
+            get_client("bq_client").load_table_from_file(
+                parquet, table or BQ_TABLE, job_config=job_config).result()
+
+        monitor("dfc_bigquery_load_duration", time.time() - start_time)
+        return True
+    except Exception as e:  # pylint: disable=broad-except
+        log_store_error(e)
+        return False
+
+
+def sink_tables():
+    """Returns the tables every stored snapshot is written to."""
+    tables = [BQ_TABLE] if WRITE_HISTORY or not CURRENT_TABLE else []
+    if CURRENT_TABLE:
+        tables.append(STAGING_TABLE)
+    return tables
+
+
+def store(rows, failures=None):
+    """Inserts transformed project data into BigQuery.
+
+    Rows go to the history table and, with CURRENT_TABLE, to the staging
+    table that merge_current reads; a failed write is recorded in
+    failures, store_failures by default.
+    """
+    failures = store_failures if failures is None else failures
+    if not rows:
+        log_event("warning", "No data to insert into BigQuery", "store")
+        return False
+    stored = True
+    for table in sink_tables():
+        if not store_table(rows, table):
+            failures.append(table)
+            stored = False
+    return stored
+
+
+def store_table(rows, table):
+    """Writes transformed rows to one BigQuery table.
+
+    Rows are split into size-bounded chunks that are inserted concurrently;
+    each chunk succeeds or fails on its own and the write is successful
+    only when no row ended up in the dead-letter sink. With SINK_MODE=load
+    the rows are written through a Parquet load job instead.
+    """
+    start_time = time.time()
+    if SINK_MODE == "load":
+        return load_parquet(rows, table)
+
+    chunks = list(chunk_rows(rows))
+    get_client("bq_client")
+    with ThreadPoolExecutor(
+            max_workers=min(STORE_MAX_WORKERS, len(chunks))) as executor:
+        futures = [executor.submit(insert_chunk, chunk, table)
+                   for chunk in chunks]
+
+    dead_letters = []
+    for index, (chunk, future) in enumerate(zip(chunks, futures)):
+        try:
+            dead_letters.extend(future.result())
+        except Exception as e:  # pylint: disable=broad-except
+            log_store_error(e, chunk=index)
+            dead_letters.extend(
+                {"row": row, "errors": [{"reason": "requestFailed",
+                                         "message": str(e)}]}
+                for row in chunk)
+
+    if dead_letters:
+        dead_letter(dead_letters)
+        return False
+    monitor("dfc_bigquery_insert_duration", time.time() - start_time)
+    return True
+
+
+ROW_COLUMNS = (
+    "project_id", "project_number", "folder_id", "project_name", "state",
+    "create_time", "update_time", "ingestion_time", "etag", "labels",
+    "run_id")
+
+
+def merge_query():
+    """Builds the MERGE of one run's staged rows into the current table.
+
+    A project staged more than once in a run (a page resent after a
+    resume) is merged once, and a DELETED row keeps the last known
+    details of its project. Projects the run did not return are marked
+    DELETED only when @mark_deleted is set.
+    """
+    updates = ", ".join(f"{column} = snapshot.{column}"
+                        for column in ROW_COLUMNS[1:])
+    return f"""
+MERGE `{CURRENT_TABLE}` AS target
+USING (
+  SELECT * FROM `{STAGING_TABLE}`
+  WHERE run_id = @run_id
+  QUALIFY ROW_NUMBER() OVER (PARTITION BY project_id) = 1
+) AS snapshot
+ON target.project_id = snapshot.project_id
+WHEN MATCHED AND snapshot.state = 'DELETED' THEN
+  UPDATE SET state = 'DELETED', ingestion_time = snapshot.ingestion_time,
+    run_id = snapshot.run_id
+WHEN MATCHED THEN
+  UPDATE SET {updates}
+WHEN NOT MATCHED BY TARGET THEN
+  INSERT ({", ".join(ROW_COLUMNS)}) VALUES ({", ".join(ROW_COLUMNS)})
+WHEN NOT MATCHED BY SOURCE AND @mark_deleted
+    AND target.state != 'DELETED' THEN
+  UPDATE SET state = 'DELETED', ingestion_time = @ingestion_time,
+    run_id = @run_id
+"""
+
+
+def merge_current(complete, run=None):
+    """Merges the staged rows of a run, by default current_run, into
+    CURRENT_TABLE.
+
+    Missing projects are only deletions when this run saw every project:
+    a complete, unsharded full snapshot whose writes all succeeded.
+    Incremental runs stage their DELETED rows explicitly instead.
+    """
+    run = current_run if run is None else run
+    mark_deleted = (complete and not INCREMENTAL_MODE and not store_failures
+                    and current_shard[1] == 1)
+    start_time = time.time()
+    try:
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter(
+                "run_id", "STRING", run.get("run_id")),
+            bigquery.ScalarQueryParameter(
+                "mark_deleted", "BOOL", mark_deleted),
+            bigquery.ScalarQueryParameter(
+                "ingestion_time", "TIMESTAMP",
+                parse_timestamp(run.get("ingestion_time"))),
+        ])
+        job = get_client("bq_client").query(
+            merge_query(), job_config=job_config)
+        job.result()
+    except Exception as e:  # pylint: disable=broad-except
+        log_store_error(e, table=CURRENT_TABLE)
+        return False
+    monitor("dfc_bigquery_merge_duration", time.time() - start_time)
+    monitor("dfc_current_rows_merged", job.num_dml_affected_rows or 0)
+    log_event("info", "Merged run into current table", "store",
+              table=CURRENT_TABLE, run_id=run.get("run_id"),
+              mark_deleted=mark_deleted)
+    return True
+
+
+def record_run_status(started, project_count, complete):
+    """Writes this invocation's outcome to RUNS_TABLE.
+
+    A resumed run has a row per invocation; its latest row under the
+    run_id tells whether the snapshot ended complete or partial.
+    """
+    if not RUNS_TABLE:
+        return
+    row = {
+        "run_id": current_run.get("run_id"),
+        "shard": current_shard[0],
+        "shards": current_shard[1],
+        "started": datetime.fromtimestamp(started, timezone.utc).isoformat(),
+        "finished": datetime.now(timezone.utc).isoformat(),
+        "complete": complete,
+        "projects": project_count,
+        "load_failures": len(load_failures),
+        "store_failures": sorted(set(store_failures)),
+        "deadline_stops": sorted(set(deadline_stops)),
+    }
+    try:
+        errors = get_client("bq_client").insert_rows_json(RUNS_TABLE, [row])
+        if errors:
+            raise ValueError(f"run status rejected: {errors}")
+    except Exception as e:  # pylint: disable=broad-except
+        log_store_error(e, table=RUNS_TABLE)
+
+
+def read_state(uri):
+    """Reads a JSON state document from a local path or gs:// URI."""
+    try:
+        if uri.startswith("gs://"):
+            from google.cloud import storage  # pylint: disable=C0415
+            bucket, _, name = uri[len("gs://"):].partition("/")
+            blob = storage.Client().bucket(bucket).blob(name)
+            return json.loads(blob.download_as_bytes())
+        with open(uri, encoding="utf-8") as state_file:
+            return json.load(state_file)
+    except (FileNotFoundError, exceptions.NotFound):
+        return None
+    except Exception as e:  # pylint: disable=broad-except
+        log_event("error", "Unable to read state", "state",
+                  uri=uri, error=str(e))
+        return None
+
+
+def write_state(uri, state):
+    """Writes a JSON state document to a local path or gs:// URI."""
+    try:
+        payload = json.dumps(state, separators=(",", ":"))
+        if uri.startswith("gs://"):
+            from google.cloud import storage  # pylint: disable=C0415
+            bucket, _, name = uri[len("gs://"):].partition("/")
+            storage.Client().bucket(bucket).blob(name).upload_from_string(
+                payload, content_type="application/json")
+        else:
+            with open(f"{uri}.tmp", "w", encoding="utf-8") as state_file:
+                state_file.write(payload)
+            os.replace(f"{uri}.tmp", uri)
+        return True
+    except Exception as e:  # pylint: disable=broad-except
+        log_event("error", "Unable to write state", "state",
+                  uri=uri, error=str(e))
+        return False
+
+
+# previous-run project state, kept in memory across warm invocations
+state_cache = {}
+
+
+def shard_uri(uri):
+    """Returns a state location of the current shard; shards never share."""
+    index, count = current_shard
+    if count == 1:
+        return uri
+    root, extension = os.path.splitext(uri)
+    return f"{root}.shard-{index}-of-{count}{extension}"
+
+
+def state_uri():
+    """Returns the incremental state location of the current shard."""
+    return shard_uri(STATE_URI)
+
+
+def previous_state():
+    """Returns project_id -> [etag, update_time, hash, project_number]."""
+    uri = state_uri()
+    if uri not in state_cache:
+        state_cache[uri] = read_state(uri) or {}
+    return state_cache[uri]
+
+
+def save_state(state):
+    """Persists the project state of this run for the next one."""
+    uri = state_uri()
+    if write_state(uri, state):
+        state_cache[uri] = state
+
+
+def row_fingerprint(row):
+    """Hashes the row content that is compared between runs."""
+    content = {key: value for key, value in row.items()
+               if key not in ("ingestion_time", "run_id")}
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def changed_rows(rows, previous, state):
+    """Keeps rows of new or changed projects and records them in state."""
+    changed = []
+    for row in rows:
+        entry = [row.get("etag"), row.get("update_time"),
+                 row_fingerprint(row), row.get("project_number")]
+        state[row["project_id"]] = entry
+        if previous.get(row["project_id"], [])[:3] != entry[:3]:
+            changed.append(row)
+    return changed
+
+
+def deleted_rows(previous, state, complete):
+    """Builds DELETED rows for projects that were not returned this run.
+
+    An incomplete crawl cannot tell a deleted project from one that was
+    simply not listed, so unseen projects are carried over instead.
+    """
+    missing = {project_id: entry for project_id, entry in previous.items()
+               if project_id not in state}
+    if not complete:
+        state.update(missing)
+        return []
+
+    return [deleted_row(project_id, entry[3])
+            for project_id, entry in missing.items()]
+
+
+def deleted_row(project_id, project_number, run=None):
+    """Builds the DELETED row of a project that no longer exists."""
+    run = current_run if run is None else run
+    return {
+        "project_id": project_id,
+        "project_number": project_number,
+        "state": "DELETED",
+        "ingestion_time": run.get(
+            "ingestion_time") or datetime.now(timezone.utc).isoformat(),
+        "labels": [],
+        "run_id": run.get("run_id"),
+    }
+
+
+def incremental_rows(rows, complete=True):
+    """Returns only new, changed and deleted project rows and the new state."""
+    previous = previous_state()
+    state = {}
+    rows = changed_rows(rows, previous, state)
+    rows.extend(deleted_rows(previous, state, complete))
+    monitor("dfc_prj_changed_rows", len(rows))
+    return rows, state
+
+
+# the snapshot being collected: its run_id and ingestion_time and, while
+# checkpointing, the folders finished and the page token of each folder
+current_run = {}
+checkpoint_lock = threading.Lock()
+checkpoint_written = 0.0  # pylint: disable=invalid-name
+
+
+def checkpoint_uri():
+    """Returns the checkpoint location of the current shard."""
+    return shard_uri(CHECKPOINT_URI)
+
+
+def new_run():
+    """Returns the context of a new run, started now."""
+    now = time.time()
+    return {
+        "run_id": uuid.uuid4().hex,
+        "started": now,
+        "ingestion_time": datetime.fromtimestamp(
+            now, timezone.utc).isoformat(),
+        "folders_done": [],
+        "page_tokens": {},
+    }
+
+
+def start_run(resume=False):
+    """Starts a new run, or resumes the one a checkpoint left unfinished.
+
+    A resumed run keeps the run_id and ingestion_time of the run it
+    continues, so rows stored by every invocation form one snapshot.
+    """
+    global current_run, checkpoint_written  # pylint: disable=W0603
+    saved = read_state(checkpoint_uri()) if resume else None
+    if saved and time.time() - saved["started"] < CHECKPOINT_MAX_AGE_SECONDS:
+        current_run = {**saved, "resumed": True}
+        log_event("info", f"Resuming run {saved['run_id']}", "checkpoint",
+                  folders_done=len(saved["folders_done"]),
+                  folders_in_progress=len(saved["page_tokens"]))
+        monitor("dfc_run_resumed", 1)
+    else:
+        current_run = new_run()
+    checkpoint_written = time.time()
+    return current_run
+
+
+def save_checkpoint():
+    """Writes the progress of the current run."""
+    global checkpoint_written  # pylint: disable=global-statement
+    with checkpoint_lock:
+        progress = json.loads(json.dumps(current_run))
+        checkpoint_written = time.time()
+    write_state(checkpoint_uri(), progress)
+
+
+def record_progress(page):
+    """Moves the checkpoint past a page whose rows are stored.
+
+    Writes are spaced CHECKPOINT_INTERVAL_SECONDS apart; a run killed in
+    between repeats at most that much work.
+    """
+    with checkpoint_lock:
+        if page.next_page_token:
+            current_run["page_tokens"][page.folder_id] = page.next_page_token
+        else:
+            current_run["page_tokens"].pop(page.folder_id, None)
+            current_run["folders_done"].append(page.folder_id)
+        due = (time.time() - checkpoint_written
+               >= CHECKPOINT_INTERVAL_SECONDS)
+    if due:
+        save_checkpoint()
+
+
+def finish_run():
+    """Clears the checkpoint once the whole run is stored."""
+    if CHECKPOINT_URI:
+        write_state(checkpoint_uri(), {})
+
+
+# Cloud Monitoring accepts at most 200 time series per create request
+MAX_SERIES_PER_REQUEST = 200
+metrics_buffer = {}
+histograms = {}
+metrics_lock = threading.Lock()
+# how repeated values of a gauge combine into its one point per write:
+# durations and depths keep the largest, as parallel folders or pages
+# overlap rather than add up; levels keep the latest; counts are summed
+METRIC_COMBINERS = (
+    (("_duration", "_depth", "_throughput"), max),
+    (("_rate", "_concurrency", "_complete"), lambda _, value: value),
+)
+
+
+def combine_metric(metric_name, previous, value):
+    """Combines a repeated value of a metric with the buffered one."""
+    if previous is None:
+        return value
+    for suffixes, combiner in METRIC_COMBINERS:
+        if metric_name.endswith(suffixes):
+            return combiner(previous, value)
+    return previous + value
+
+
+def monitor(metric_name, value, **labels):
+    """Buffers a custom metric point for Cloud Monitoring.
+
+    Nothing is sent until flush_metrics runs. A series may only receive
+    one point per write, so repeated values of a metric within a run
+    (per page, per chunk, per folder) are combined into a single point:
+    counts are summed, see METRIC_COMBINERS for the rest. Each distinct
+    set of labels is its own series.
+    """
+    if not metric_name:
+        log_event("error", "Metric name is required", "monitor")
+        return
+
+    if value is None:
+        log_event("error", "Metric value is required",
+                  "monitor", metric_name=metric_name)
+        return
+
+    key = (metric_name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        metrics_buffer[key] = combine_metric(
+            metric_name, metrics_buffer.get(key), value)
+
+
+class Histogram:
+    """Latency samples counted into exponential buckets.
+
+    Bucket 0 holds values below HISTOGRAM_SCALE_SECONDS and the last one
+    values beyond the finite buckets, as in a Cloud Monitoring
+    Distribution, so a run's tail latency survives being aggregated.
+    """
+
+    def __init__(self):
+        self.bucket_counts = [0] * (HISTOGRAM_BUCKETS + 2)
+        self.count = 0
+        self.mean = 0.0
+        self.squared_deviation = 0.0
+
+    def add(self, value):
+        """Counts one sample, keeping a running mean and deviation."""
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.squared_deviation += delta * (value - self.mean)
+        self.bucket_counts[self.bucket(value)] += 1
+
+    @staticmethod
+    def bucket(value):
+        """Returns the index of the bucket a value falls into."""
+        if value < HISTOGRAM_SCALE_SECONDS:
+            return 0
+        index = int(math.log(value / HISTOGRAM_SCALE_SECONDS,
+                             HISTOGRAM_GROWTH_FACTOR)) + 1
+        return min(index, HISTOGRAM_BUCKETS + 1)
+
+    def typed_value(self):
+        """Returns the histogram as a DISTRIBUTION point value."""
+        return monitoring_v3.TypedValue(distribution_value={
+            "count": self.count,
+            "mean": self.mean,
+            "sum_of_squared_deviation": self.squared_deviation,
+            "bucket_options": {"exponential_buckets": {
+                "num_finite_buckets": HISTOGRAM_BUCKETS,
+                "growth_factor": HISTOGRAM_GROWTH_FACTOR,
+                "scale": HISTOGRAM_SCALE_SECONDS,
+            }},
+            "bucket_counts": self.bucket_counts,
+        })
 
-logging.basicConfig(
-    format="%(levelname)s %(asctime)s [%(service_name)s]: %(message)s",
-    level=logging.INFO
+
+def observe(metric_name, seconds, **labels):
+    """Records one latency sample in the histogram of a metric.
+
+    Unlike monitor, every sample is kept (as a bucket count), and the
+    histogram is written as a single DISTRIBUTION point by flush_metrics.
+    """
+    key = (metric_name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+        histogram.add(seconds)
+
+
+def observe_rpc(stage, method, outcome, seconds, request=None):
+    """Records one API call in the dfc_rpc_latency histogram.
+
+    Calls are labelled by stage, method and outcome, and listings of a
+    folder also by folder_id.
+    """
+    labels = {"stage": stage, "outcome": outcome,
+              "method": getattr(method, "__name__", str(method))}
+    parent = getattr(request, "parent", None)
+    if isinstance(parent, str) and parent.startswith("folders/"):
+        labels["folder_id"] = parent.removeprefix("folders/")
+    observe("dfc_rpc_latency", seconds, **labels)
+
+
+def build_time_series(metric_name, value, now, labels=()):
+    """Builds a single-point gauge time series for a custom metric.
+
+    A Histogram value becomes a DISTRIBUTION point, anything else a
+    double.
+    """
+    series = monitoring_v3.TimeSeries()
+    series.metric.type = f"custom.googleapis.com/{metric_name}"
+    for label, label_value in labels:
+        series.metric.labels[label] = str(label_value)
+    if current_shard[1] > 1:
+        # parallel shards must not write points to the same series
+        series.metric.labels["shard"] = str(current_shard[0])
+    timestamp = Timestamp(seconds=int(
+        now), nanos=int((now - int(now)) * 1e9))
+
+    interval = monitoring_v3.TimeInterval(
+        start_time=timestamp, end_time=timestamp)
+    point = monitoring_v3.Point(
+        interval=interval,
+        value=value.typed_value() if isinstance(value, Histogram)
+        else monitoring_v3.TypedValue(double_value=value))
+    series.points = [point]
+    return series
+
+
+MONITOR_ERRORS = (
+    (exceptions.InvalidArgument, "Invalid argument for Cloud Monitoring"),
+    (exceptions.PermissionDenied, "Permission denied for Cloud Monitoring"),
+    (exceptions.ServiceUnavailable, "Cloud Monitoring service unavailable"),
+    (exceptions.DeadlineExceeded, "Cloud Monitoring request timed out"),
+    (exceptions.GoogleAPICallError, "General Google API error"),
+    (TypeError, "Type error during metric creation"),
+    (ValueError, "Value error during metric creation"),
 )
 
 
-def log_event(level, message, event, **kwargs):
-    """Structured log event"""
+def log_monitor_error(error, metric_names):
+    """Logs a Cloud Monitoring write error with a readable message."""
+    message = next(
+        (text for error_type, text in MONITOR_ERRORS
+         if isinstance(error, error_type)),
+        "Failed to report metric")
+    log_event("error", message, "monitor",
+              metric_names=metric_names, error=str(error))
 
-    log_message = (
-        f"service_name: {SERVICE_NAME}| "
-        f"event: {message}, "
-        f"json_payload: {json.dumps(event)}, "
-        f"additional_info: {json.dumps(kwargs)}"
-    )
 
-    if level == "info":
-        logging.info(log_message)
-    elif level == "warning":
-        logging.warning(log_message)
-    elif level == "error":
-        logging.error(log_message)
+def drain_metrics():
+    """Empties the buffer into batches of at most 200 time series."""
+    with metrics_lock:
+        points = {**metrics_buffer, **histograms}
+        metrics_buffer.clear()
+        histograms.clear()
 
+    now = time.time()
+    keys = list(points)
+    return [
+        ([name for name, _ in keys[offset:offset + MAX_SERIES_PER_REQUEST]],
+         [build_time_series(name, points[(name, labels)], now, labels)
+          for name, labels in keys[offset:offset + MAX_SERIES_PER_REQUEST]])
+        for offset in range(0, len(keys), MAX_SERIES_PER_REQUEST)
+    ]
 
-# variables
-BQ_TABLE = os.getenv("BQ_TABLE", "observability.project_info")
-FOLDER_ID = os.getenv("FOLDER_ID", "1062810406170")
-PROJECT_ID = os.getenv("GCP_PROJECT", "dev2-ea8f")
 
-if not BQ_TABLE or not FOLDER_ID or not PROJECT_ID:
-    log_event("error", "Missing environment variables", "config_error")
+def flush_metrics():
+    """Writes buffered metrics to Cloud Monitoring in as few calls as possible.
 
+    Failures are logged and the points dropped, so a Monitoring outage
+    never fails or retries the collection run itself.
+    """
+    if not metrics_buffer and not histograms:
+        return
+    try:
+        client = get_client("monitoring_client")
+    except Exception as e:  # pylint: disable=broad-except
+        log_event("error", "Failed to create Cloud Monitoring client",
+                  "monitor", error=str(e))
+        return
+
+    for names, series in drain_metrics():
+        try:
+            client.create_time_series(
+                name=f"projects/{PROJECT_ID}", time_series=series)
+        except Exception as e:  # pylint: disable=broad-except
+            log_monitor_error(e, names)
+
+
+# marks the end of the items flowing through an overlapped pipeline queue
+PIPELINE_DONE = object()
+
+
+def report_stage(name, items, busy_time, max_depth):
+    """Reports throughput and queue-depth metrics for a pipeline stage."""
+    monitor(f"dfc_pipeline_{name}_items", items)
+    monitor(f"dfc_pipeline_{name}_busy_duration", busy_time)
+    monitor(f"dfc_pipeline_{name}_max_queue_depth", max_depth)
+    if busy_time:
+        monitor(f"dfc_pipeline_{name}_throughput", items / busy_time)
 
-def get_projects(folder_id):
-    """Fetches projects from GCP Resource Manager API."""
-    projects = []
 
+def feed_stage(pages, outbox):
+    """Pipeline fetch stage: pulls pages from the pager into a queue."""
+    items = 0
+    busy_time = 0.0
     try:
+        pages = iter(pages)
+        while True:
+            start_time = time.time()
+            page = next(pages, PIPELINE_DONE)
+            busy_time += time.time() - start_time
+            if page is PIPELINE_DONE:
+                break
+            items += 1
+            outbox.put(page)
+    finally:
+        outbox.put(PIPELINE_DONE)
+        report_stage("fetch", items, busy_time, 0)
+
+
+def pipeline_stage(name, work, inbox, outbox=None, failures=None):
+    """Pipeline worker stage: applies work to every queued item.
+
+    Errors are logged per item, added to failures and the stage keeps
+    draining its inbox, so a failing stage never leaves the stage before
+    it blocked on a full queue.
+    """
+    items = 0
+    busy_time = 0.0
+    max_depth = 0
+    try:
+        while True:
+            max_depth = max(max_depth, inbox.qsize())
+            item = inbox.get()
+            if item is PIPELINE_DONE:
+                break
+            start_time = time.time()
+            try:
+                result = work(item)
+            except Exception as e:  # pylint: disable=broad-except
+                log_event("error", f"Pipeline {name} stage failed",
+                          "pipeline", error=str(e))
+                if failures is not None:
+                    failures.append(str(e))
+                result = None
+            busy_time += time.time() - start_time
+            items += 1
+            # an empty page still moves on, to record its progress
+            if outbox is not None and result is not None:
+                outbox.put(result)
+    finally:
+        if outbox is not None:
+            outbox.put(PIPELINE_DONE)
+        report_stage(name, items, busy_time, max_depth)
+
+
+class LoadBuffer:
+    """Holds a streamed run's pages for one load job per table.
+
+    With SINK_MODE=load every page would otherwise start its own load job
+    on each sink table, and BigQuery caps load jobs per table per day.
+    Pages are kept as Arrow tables, far smaller than row dicts, and only
+    advance the checkpoint once the load holding them succeeds.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.pages = []
+
+    def add(self, rows):
+        """Buffers a page of rows and, for a checkpointed page, its place."""
+        if rows:
+            self.parts.append(rows_to_arrow(rows))
+        if isinstance(rows, Page):
+            self.pages.append(Page([], rows.folder_id, rows.next_page_token))
+
+    def flush(self):
+        """Loads every buffered row and returns whether that succeeded."""
+        import pyarrow as pa  # pylint: disable=import-outside-toplevel
+
+        stored = True
+        if self.parts:
+            stored = store(pa.concat_tables(self.parts))
+        if stored:
+            for page in self.pages:
+                record_progress(page)
+        self.parts, self.pages = [], []
+        return stored
+
+
+def run_overlapped(pages, transform_page, store_page):
+    """Runs fetch, transform and store as concurrent pipeline stages.
+
+    The stages are linked by bounded queues. A full queue blocks the stage
+    feeding it, so a slow BigQuery write throttles fetching instead of
+    buffering the folder in memory, and the run takes about as long as its
+    slowest stage rather than the sum of all three. A page the transform
+    stage drops counts as a load failure, one the store stage drops as a
+    store failure; returns the errors of the dropped pages.
+    """
+    transform_failures = []
+    store_errors = []
+    fetched = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    transformed = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    workers = [
+        threading.Thread(target=pipeline_stage, name="pipeline-transform",
+                         args=("transform", transform_page, fetched,
+                               transformed, transform_failures)),
+        threading.Thread(target=pipeline_stage, name="pipeline-store",
+                         args=("store", store_page, transformed, None,
+                               store_errors)),
+    ]
+    for worker in workers:
+        worker.start()
+    feed_stage(pages, fetched)
+    for worker in workers:
+        worker.join()
+    load_failures.extend(transform_failures)
+    store_failures.extend(store_errors)
+    return transform_failures + store_errors
+
+
+def stream_projects(*folders):
+    """Transforms and stores each page of projects as soon as it arrives.
+
+    Pages go through one at a time, or through concurrent stages when
+    OVERLAPPED_PIPELINE is set. With CHECKPOINT_URI, each stored page
+    advances the run's checkpoint. With RECURSIVE_CRAWL every nested
+    folder is paged as a folder of its own. With SINK_MODE=load pages are
+    buffered and loaded together at the end.
+    """
+    if RECURSIVE_CRAWL and COLLECTION_MODE == "list":
+        folders = folder_tree(folders)
+    previous = previous_state() if INCREMENTAL_MODE else {}
+    state = {}
+    totals = {"rows": 0, "stored": True}
+    load_buffer = LoadBuffer() if SINK_MODE == "load" else None
+
+    def transform_page(page):
         start_time = time.time()
-        client = resourcemanager_v3.ProjectsClient()
-        request = resourcemanager_v3.ListProjectsRequest(
-            parent=f"folders/{folder_id}")
-        projects = list(client.list_projects(request=request))
-        duration = time.time() - start_time
-        monitor("dfc_prj_api_duration", duration)
+        rows = transform(page)
+        totals["rows"] += len(rows)
+        if INCREMENTAL_MODE:
+            rows = changed_rows(rows, previous, state)
+        if CHECKPOINT_URI:
+            rows = Page(rows, page.folder_id, page.next_page_token)
+        observe("dfc_page_latency", time.time() - start_time,
+                stage="transform", outcome="ok", **page_labels(page))
+        return rows
 
-        if not projects:
-            log_event(
-                "warning",
-                f"No projects found under folder {folder_id}",
-                "load"
-            )
+    def store_page(rows):
+        if load_buffer is not None:
+            load_buffer.add(rows)
+            return
+        if rows:
+            start_time = time.time()
+            stored = store(rows)
+            totals["stored"] = stored and totals["stored"]
+            observe("dfc_page_latency", time.time() - start_time,
+                    stage="store", outcome="ok" if stored else "error",
+                    **page_labels(rows))
+        if isinstance(rows, Page):
+            record_progress(rows)
 
-    except exceptions.InvalidArgument as e:
-        log_event(
-            "error", f"Invalid folder ID: {str(e)}", "load", error=str(e)
-        )
-    except exceptions.PermissionDenied as e:
-        log_event(
-            "error", f"Permission denied to access folder: {str(e)}",
-            "load", error=str(e)
-        )
-    except exceptions.NotFound as e:
-        log_event(
-            "error", f"Folder not found: {str(e)}", "load", error=str(e)
-        )
-    except exceptions.ServiceUnavailable as e:
-        log_event(
-            "error", f"Resource Manager API service unavailable: {str(e)}",
-            "load", error=str(e))
-    except exceptions.DeadlineExceeded as e:
-        log_event(
-            "error", f"Resource Manager API request timed out: {str(e)}",
-            "load", error=str(e))
-    except exceptions.GoogleAPICallError as e:
-        log_event(
-            "error", f"General Resource Manager API error: {str(e)}",
-            "load", error=str(e))
-    except KeyError as e:
-        log_event("error", f"Key error: {str(e)}", "load", error=str(e))
-    except ValueError as e:
-        log_event("error", f"Value error: {str(e)}", "load", error=str(e))
-    except TimeoutError as e:
-        log_event("error", f"Timeout error: {str(e)}", "load", error=str(e))
-    except Exception as e:  # pylint: disable=broad-except
-        log_event("error", f"Unexpected error: {str(e)}", "load", error=str(e))
+    pages = get_folders_pages(folders)
+    failed = []
+    if OVERLAPPED_PIPELINE:
+        failed = run_overlapped(pages, transform_page, store_page)
+    else:
+        for page in pages:
+            store_page(transform_page(page))
 
-    return projects
+    if INCREMENTAL_MODE:
+        # a resumed run did not see the pages stored before it started,
+        # and the state misses the pages a pipeline stage dropped
+        complete = (run_complete() and not current_run.get("resumed")
+                    and not failed)
+        store_page(deleted_rows(previous, state, complete=complete))
+    if load_buffer is not None:
+        totals["stored"] = load_buffer.flush() and totals["stored"]
+    if INCREMENTAL_MODE and totals["stored"] and not failed:
+        save_state(state)
+    return totals["rows"]
 
 
-def transform(projects):
-    """Transforms GCP project data for BigQuery."""
-    start_time = time.time()
-    ingestion_timestamp = datetime.now(timezone.utc).isoformat()
-    rows = []
+def store_snapshot(rows):
+    """Stores a transformed snapshot, only the changes in incremental mode."""
+    if not INCREMENTAL_MODE:
+        return store(rows)
 
-    for project in projects:
-        try:
-            project_dict = MessageToDict(
-                project._pb,  # pylint: disable=W0212
-                preserving_proto_field_name=True)
-
-            labels = project_dict.get("labels", {})
-            labels_list = [{"key": k, "value": v} for k, v in labels.items()]
-
-            row = {
-                "project_id": project_dict.get("project_id"),
-                "project_number": project_dict.get("name"),
-                "folder_id": project_dict.get("parent"),
-                "project_name": project_dict.get("display_name"),
-                "state": project_dict.get("state"),
-                "create_time": project_dict.get("create_time"),
-                "update_time": project_dict.get("update_time"),
-                "ingestion_time": ingestion_timestamp,
-                "etag": project_dict.get("etag"),
-                "labels": labels_list,
-            }
-            rows.append(row)
+    rows, state = incremental_rows(rows, complete=run_complete())
+    stored = store(rows) if rows else True
+    if stored:
+        save_state(state)
+    return stored
 
-        except Exception as e:  # pylint: disable=broad-except
-            log_event("error", "Error transforming project data",
-                      "transform", error=str(e))
 
-    duration = time.time() - start_time
-    monitor("dfc_prj_processing_duration", duration)
-    return rows
+# async clients belong to the event loop they were created on, so the
+# async entry point keeps one loop alive for the life of the instance
+async_loop = None  # pylint: disable=invalid-name
+async_clients = {}
+ASYNC_CLIENT_FACTORIES = {
+    "projects_client": lazy_class(resourcemanager_v3, "ProjectsAsyncClient"),
+    "folders_client": lazy_class(resourcemanager_v3, "FoldersAsyncClient"),
+    "monitoring_client": lazy_class(monitoring_v3, "MetricServiceAsyncClient"),
+}
+
+
+def run_async(coroutine):
+    """Runs a coroutine on the process-wide event loop and waits for it."""
+    global async_loop  # pylint: disable=global-statement
+    with clients_lock:
+        if async_loop is None:
+            async_loop = asyncio.new_event_loop()
+            threading.Thread(target=async_loop.run_forever,
+                             name="asyncio-loop", daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coroutine, async_loop).result()
+
+
+def get_async_client(name):
+    """Returns an async API client; only call this on the event loop."""
+    if name not in async_clients:
+        async_clients[name] = ASYNC_CLIENT_FACTORIES[name]()
+        monitor("dfc_client_created", 1)
+    else:
+        monitor("dfc_client_reused", 1)
+    return async_clients[name]
+
+
+async def list_projects_async(client, folder_id):
+    """Lists the projects under a folder with the async client."""
+    if COLLECTION_MODE == "search":
+        pages = rm_pages_async(
+            client.search_projects,
+            resourcemanager_v3.SearchProjectsRequest(
+                query=search_query(folder_id), page_size=PAGE_SIZE))
+    else:
+        pages = rm_pages_async(
+            client.list_projects,
+            resourcemanager_v3.ListProjectsRequest(
+                parent=f"folders/{folder_id}", page_size=PAGE_SIZE))
+    return [project async for page in pages for project in page.projects]
+
 
+async def list_subfolders_async(client, folder_id):
+    """Lists the IDs of the folders under a folder with the async client."""
+    pages = rm_pages_async(
+        client.list_folders,
+        resourcemanager_v3.ListFoldersRequest(parent=f"folders/{folder_id}"))
+    return [folder.name.split("/")[-1]
+            async for page in pages for folder in page.folders]
 
-def store(rows):
-    """Inserts transformed project data into BigQuery."""
-    success = False
+
+async def get_projects_async(folder_id):
+    """Fetches projects on the event loop, walking subfolders if enabled.
+
+    Every folder listing is a coroutine, bounded by a semaphore of
+    CRAWL_MAX_WORKERS, so many requests are in flight without a thread
+    per request.
+    """
     start_time = time.time()
-    if not rows:
-        log_event("warning", "No data to insert into BigQuery", "store")
-        return success
+    projects_api = get_async_client("projects_client")
+    recursive = RECURSIVE_CRAWL and COLLECTION_MODE == "list"
+    folders_api = get_async_client("folders_client") if recursive else None
+    semaphore = asyncio.Semaphore(CRAWL_MAX_WORKERS)
+    projects = []
+
+    async def crawl(crawl_folder_id):
+        async with semaphore:
+            if out_of_time("crawl"):
+                return
+            try:
+                subfolders = (
+                    await list_subfolders_async(folders_api, crawl_folder_id)
+                    if recursive else [])
+                projects.extend(
+                    await list_projects_async(projects_api, crawl_folder_id))
+            except Exception as e:  # pylint: disable=broad-except
+                log_load_error(e)
+                return
+        await asyncio.gather(*(crawl(subfolder) for subfolder in subfolders))
+
+    await crawl(folder_id)
+    monitor("dfc_prj_api_duration", time.time() - start_time)
+    return projects
+
+
+async def flush_metrics_async():
+    """Writes buffered metrics with concurrent async Monitoring calls."""
+    if not metrics_buffer and not histograms:
+        return
     try:
-        errors = bq_client.insert_rows_json(BQ_TABLE, rows)
-        if errors:
-            log_event("error", "Failed to insert data into project_info",
-                      "store", errors=errors)
-        else:
-            monitor("dfc_bigquery_insert_duration", time.time() - start_time)
-            success = True
-    except exceptions.BadRequest as e:
-        log_event("error", "BigQuery Bad Request error", "store", error=str(e))
-    except exceptions.NotFound as e:
-        log_event("error", "BigQuery Not Found error", "store", error=str(e))
-    except exceptions.Forbidden as e:
-        log_event("error", "BigQuery Forbidden error", "store", error=str(e))
-    except exceptions.ServiceUnavailable as e:
-        log_event("error", "BigQuery Service Unavailable error",
-                  "store", error=str(e))
-    except exceptions.TooManyRequests as e:
-        log_event("error", "BigQuery Too Many Requests error",
-                  "store", error=str(e))
-    except exceptions.GoogleAPICallError as e:
-        log_event("error", "General BigQuery API error", "store", error=str(e))
-    except TypeError as e:
-        log_event("error", "Type error during BigQuery insertion",
-                  "store", error=str(e))
-    except ValueError as e:
-        log_event("error", "Value error during BigQuery insertion",
-                  "store", error=str(e))
+        client = get_async_client("monitoring_client")
     except Exception as e:  # pylint: disable=broad-except
-        log_event(
-            "error", "Unable to insert to project_info", "store", error=str(e))
-    return success
+        log_event("error", "Failed to create Cloud Monitoring client",
+                  "monitor", error=str(e))
+        return
 
+    async def write(names, series):
+        try:
+            await client.create_time_series(
+                name=f"projects/{PROJECT_ID}", time_series=series)
+        except Exception as e:  # pylint: disable=broad-except
+            log_monitor_error(e, names)
 
-def monitor(metric_name, value):
-    """Reports a custom metric to Cloud Monitoring."""
-    if not metric_name:
-        log_event("error", "Metric name is required", "monitor")
-        return
+    await asyncio.gather(*(write(names, series)
+                           for names, series in drain_metrics()))
 
-    if value is None:
-        log_event("error", "Metric value is required",
-                  "monitor", metric_name=metric_name)
-        return
 
+async def fetch_folder_async(folder_id):
+    """Fetches one folder's projects; a failure only empties that folder."""
+    start_time = time.time()
     try:
-        series = monitoring_v3.TimeSeries()
-        series.metric.type = f"custom.googleapis.com/{metric_name}"
-        now = time.time()
-        timestamp = Timestamp(seconds=int(
-            now), nanos=int((now - int(now)) * 1e9))
-
-        interval = monitoring_v3.TimeInterval(
-            start_time=timestamp, end_time=timestamp)
-        point = monitoring_v3.Point(
-            interval=interval,
-            value=monitoring_v3.TypedValue(double_value=value))
-        series.points = [point]
-
-        monitoring_client.create_time_series(
-            name=f"projects/{PROJECT_ID}", time_series=[series])
-
-    except exceptions.InvalidArgument as e:
-        log_event("error", "Invalid argument for Cloud Monitoring",
-                  "monitor", metric_name=metric_name, error=str(e))
-    except exceptions.PermissionDenied as e:
-        log_event("error", "Permission denied for Cloud Monitoring",
-                  "monitor", metric_name=metric_name, error=str(e))
-    except exceptions.ServiceUnavailable as e:
-        log_event("error", "Cloud Monitoring service unavailable",
-                  "monitor", metric_name=metric_name, error=str(e))
-    except exceptions.DeadlineExceeded as e:
-        log_event("error", "Cloud Monitoring request timed out",
-                  "monitor", metric_name=metric_name, error=str(e))
-    except exceptions.GoogleAPICallError as e:
-        log_event("error", "General Google API error", "monitor",
-                  metric_name=metric_name, error=str(e))
-    except TypeError as e:
-        log_event("error", "Type error during metric creation",
-                  "monitor", metric_name=metric_name, error=str(e))
-    except ValueError as e:
-        log_event("error", "Value error during metric creation",
-                  "monitor", metric_name=metric_name, error=str(e))
+        projects = await get_projects_async(folder_id)
     except Exception as e:  # pylint: disable=broad-except
-        log_event("error", "Failed to report metric", "monitor",
-                  metric_name=metric_name, error=str(e))
+        log_load_error(e)
+        projects = []
+    monitor_folder(folder_id, time.time() - start_time, len(projects))
+    return projects
 
 
-@functions_framework.http
-def main(request):
-    """Main Cloud Function entry point (HTTP Triggered)."""
+async def collect_async(folders):
+    """Collects, transforms and stores projects on the event loop.
+
+    Folders are fetched concurrently. BigQuery has no async client, so
+    the blocking writer runs in the loop's default executor while the
+    loop stays free.
+    """
+    start_run()
+    projects = [project for folder_projects in await asyncio.gather(
+        *(fetch_folder_async(folder_id) for folder_id in folders))
+        for project in folder_projects]
+    if projects:
+        rows = transform(projects)
+        await asyncio.get_running_loop().run_in_executor(
+            None, store_snapshot, rows)
+    return len(projects)
+
+
+def collect():
+    """Collects, transforms and stores projects with the threaded path."""
+    folders = shard_folders(collection_folders())
+    start_run(resume=bool(CHECKPOINT_URI))
+    if STREAMING_MODE or OVERLAPPED_PIPELINE or CHECKPOINT_URI:
+        project_count = stream_projects(*folders)
+        if deadline_stops and CHECKPOINT_URI:
+            # keep the checkpoint so the next invocation carries on
+            save_checkpoint()
+        else:
+            finish_run()
+        return project_count
+
+    projects = get_folders_projects(folders)
+    if projects:
+        transformed_data = transform(projects)
+        store_snapshot(transformed_data)
+    return len(projects)
+
+
+def run_batch(request, run, flush):
+    """Runs one collection for an HTTP trigger and reports its outcome."""
     start_time = time.time()
     log_event("info", "batch triggered : {start_time}",
               {"method": request.method, "path": request.path})
+    load_failures.clear()
+    store_failures.clear()
+    deadline_stops.clear()
+    start_deadline()
     try:
-        projects = get_projects(FOLDER_ID)
-        if projects:
-            transformed_data = transform(projects)
-            store(transformed_data)
-        else:
+        project_count = run()
+        if not project_count:
             log_event("info", "No projects to process", "complete")
+        elif CURRENT_TABLE:
+            merge_current(run_complete())
+        complete = run_complete()
+        record_run_status(start_time, project_count, complete)
+        log_event(
+            "info" if complete else "warning",
+            f"Run {'complete' if complete else 'partial'}", "complete",
+            run_id=current_run.get("run_id"), load_failures=len(load_failures),
+            store_failures=sorted(set(store_failures)),
+            deadline_stops=sorted(set(deadline_stops)),
+            time_left=time_left())
+        monitor("dfc_run_complete", int(complete))
         monitor("dfc_prj_total_duration", time.time() - start_time)
+        if not complete:
+            return "Project details partially loaded"
         return "Project details loaded successfully"
 
     except exceptions.GoogleAPICallError as e:
@@ -291,3 +2460,531 @@ def main(request):
             error=str(e)
         )
         return "Internal server error", 500
+
+    finally:
+        rm_limiter.report()
+        flush()
+
+
+def shard_params(request):
+    """Returns (shard index, shard count) from the request arguments.
+
+    An index of None means the request asks this instance to coordinate
+    that many shards instead of collecting itself.
+    """
+    count = int(request.args.get("shards", 1))
+    index = request.args.get("shard")
+    if count < 1:
+        raise ValueError(f"shard count must be positive, got {count}")
+    if count > SHARD_MAX_COUNT:
+        raise ValueError(
+            f"shard count {count} is above the limit of {SHARD_MAX_COUNT}")
+    if index is None:
+        return (None, count) if count > 1 else (0, 1)
+    index = int(index)
+    if not 0 <= index < count:
+        raise ValueError(f"shard {index} is outside 0..{count - 1}")
+    return index, count
+
+
+def shard_url(request):
+    """Returns the URL shard requests are sent to, by default this one."""
+    if SHARD_URL:
+        return SHARD_URL
+    scheme = request.headers.get("X-Forwarded-Proto", request.scheme)
+    return f"{scheme}://{request.host}{request.path}"
+
+
+def call_shard(url, index, count):
+    """Runs one shard on its own instance and returns its result."""
+    # pylint: disable=import-outside-toplevel
+    import requests
+    from google.auth.transport.requests import Request
+    from google.oauth2 import id_token
+
+    start_time = time.time()
+    try:
+        token = id_token.fetch_id_token(Request(), url)
+        response = requests.post(
+            url, params={"shard": index, "shards": count},
+            headers={"Authorization": f"Bearer {token}"},
+            timeout=SHARD_TIMEOUT_SECONDS)
+        response.raise_for_status()
+        result = response.json()
+    except Exception as e:  # pylint: disable=broad-except
+        log_event("error", f"Shard {index} of {count} failed: {str(e)}",
+                  "coordinator", shard=index, error=str(e))
+        result = {"shard": index, "shards": count, "error": str(e)}
+    monitor("dfc_shard_duration", time.time() - start_time, shard=index)
+    return result
+
+
+def coordinate(request, count):
+    """Fans a run out to count parallel shards and aggregates the results."""
+    start_time = time.time()
+    url = shard_url(request)
+    log_event("info", f"Fanning out to {count} shards", "coordinator",
+              shards=count, url=url)
+    with ThreadPoolExecutor(
+            max_workers=min(count, SHARD_MAX_COUNT)) as executor:
+        results = list(executor.map(
+            lambda index: call_shard(url, index, count), range(count)))
+
+    summary = {
+        "shards": count,
+        "projects": sum(result.get("projects", 0) for result in results),
+        "failed_shards": [result["shard"] for result in results
+                          if "error" in result],
+        "partial_shards": [result["shard"] for result in results
+                           if result.get("complete") is False],
+    }
+    monitor("dfc_shard_projects", summary["projects"])
+    monitor("dfc_shard_failures", len(summary["failed_shards"]))
+    monitor("dfc_shard_total_duration", time.time() - start_time)
+    flush_metrics()
+    if summary["failed_shards"]:
+        log_event("error", "Some shards failed", "coordinator", **summary)
+        return summary, 500
+    log_event("info", "All shards completed", "coordinator", **summary)
+    return summary
+
+
+def lock_holder(uri):
+    """Returns the lock document and its GCS generation, if any."""
+    if uri.startswith("gs://"):
+        from google.cloud import storage  # pylint: disable=C0415
+        bucket, _, name = uri[len("gs://"):].partition("/")
+        blob = storage.Client().bucket(bucket).get_blob(name)
+        if blob is None:
+            return None, 0
+        return json.loads(blob.download_as_bytes()), blob.generation
+    return read_state(uri), None
+
+
+def create_lock(uri, holder, generation=0):
+    """Writes the lock only if it is unchanged since it was read.
+
+    GCS uses a generation precondition (0 means "must not exist"); a
+    local lock uses an exclusive create.
+    """
+    payload = json.dumps(holder)
+    try:
+        if uri.startswith("gs://"):
+            from google.cloud import storage  # pylint: disable=C0415
+            bucket, _, name = uri[len("gs://"):].partition("/")
+            storage.Client().bucket(bucket).blob(name).upload_from_string(
+                payload, content_type="application/json",
+                if_generation_match=generation)
+            return True
+        if generation is None and os.path.exists(uri):
+            os.remove(uri)
+        with open(uri, "x", encoding="utf-8") as lock_file:
+            lock_file.write(payload)
+        return True
+    except (exceptions.PreconditionFailed, FileExistsError,
+            FileNotFoundError):
+        return False
+
+
+def acquire_run_lock(uri, owner):
+    """Takes the run lock unless a live run holds it; True if taken.
+
+    An expired lock belongs to a run that was killed and is taken over.
+    Errors reaching the lock are logged and the run goes ahead unlocked.
+    """
+    holder = {"owner": owner, "expires": time.time()
+              + FUNCTION_TIMEOUT_SECONDS}
+    try:
+        if create_lock(uri, holder):
+            return True
+        current, generation = lock_holder(uri)
+        if current and current.get("expires", 0) > time.time():
+            return False
+        return create_lock(uri, holder, generation)
+    except Exception as e:  # pylint: disable=broad-except
+        log_event("error", "Unable to take the run lock", "lock",
+                  uri=uri, error=str(e))
+        return True
+
+
+def release_run_lock(uri, owner):
+    """Removes the run lock if this run still holds it."""
+    try:
+        current, generation = lock_holder(uri)
+        if not current or current.get("owner") != owner:
+            return
+        if uri.startswith("gs://"):
+            from google.cloud import storage  # pylint: disable=C0415
+            bucket, _, name = uri[len("gs://"):].partition("/")
+            storage.Client().bucket(bucket).blob(name).delete(
+                if_generation_match=generation)
+        else:
+            os.remove(uri)
+    except Exception as e:  # pylint: disable=broad-except
+        log_event("error", "Unable to release the run lock", "lock",
+                  uri=uri, error=str(e))
+
+
+def run_exclusively(run):
+    """Runs unless another instance holds the run lock; None if skipped."""
+    if not RUN_LOCK_URI:
+        return run()
+    uri = shard_uri(RUN_LOCK_URI)
+    owner = uuid.uuid4().hex
+    if not acquire_run_lock(uri, owner):
+        log_event("warning", "Another run is in progress, skipping", "lock",
+                  uri=uri)
+        monitor("dfc_run_skipped", 1)
+        flush_metrics()
+        return None
+    try:
+        return run()
+    finally:
+        release_run_lock(uri, owner)
+
+
+# runs in flight on this instance by shard; a second trigger for the same
+# shard waits for the first one and shares its response
+flights = {}
+flights_lock = threading.Lock()
+
+
+def single_flight(key, run):
+    """Runs run, or joins the identical run already in flight."""
+    with flights_lock:
+        flight = flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = flights[key] = {
+                "done": threading.Event(),
+                "result": ("Internal server error", 500)}
+    if not leader:
+        log_event("info", "Joining the run in progress", "lock")
+        flight["done"].wait()
+        return flight["result"]
+    try:
+        flight["result"] = run()
+        return flight["result"]
+    finally:
+        with flights_lock:
+            del flights[key]
+        flight["done"].set()
+
+
+def run_collection(request, index, count):
+    """Collects the current shard and builds the HTTP response."""
+    if count == 1:
+        return run_batch(request, collect, flush_metrics)
+
+    totals = {"projects": 0}
+
+    def run():
+        totals["projects"] = collect()
+        return totals["projects"]
+
+    result = run_batch(request, run, flush_metrics)
+    if isinstance(result, tuple):
+        return result
+    return {"shard": index, "shards": count, **totals,
+            "complete": run_complete()}
+
+
+def should_profile(request):
+    """Whether an invocation is sampled or asked to be profiled."""
+    headers = getattr(request, "headers", None) or {}
+    if PROFILE_TOKEN and headers.get(PROFILE_HEADER) == PROFILE_TOKEN:
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.randrange(
+        PROFILE_SAMPLE_RATE) == 0
+
+
+def profile_report(name, seconds, stats, snapshot, peak):
+    """Summarises a profile as its top functions and allocation sites."""
+    import resource  # pylint: disable=import-outside-toplevel
+
+    hotspots = sorted(stats.stats.items(), key=lambda item: item[1][2],
+                      reverse=True)[:PROFILE_TOP_N]
+    allocations = snapshot.statistics("lineno")[:PROFILE_TOP_N]
+    return {
+        "entry_point": name,
+        "run_id": current_run.get("run_id"),
+        "seconds": round(seconds, 3),
+        "peak_traced_mb": round(peak / 2 ** 20, 1),
+        "peak_rss_mb": round(resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "hotspots": [{
+            "function": f"{path}:{line}({function})",
+            "calls": calls,
+            "own_seconds": round(own_time, 4),
+            "cumulative_seconds": round(cumulative_time, 4),
+        } for (path, line, function), (_, calls, own_time, cumulative_time,
+                                       _) in hotspots],
+        "allocations": [{
+            "site": str(allocation.traceback),
+            "size_kb": round(allocation.size / 1024, 1),
+            "count": allocation.count,
+        } for allocation in allocations],
+    }
+
+
+def run_profiled(name, run):
+    """Runs an invocation under cProfile and tracemalloc and reports it.
+
+    On Python 3.12 cProfile also sees the worker threads; tracemalloc
+    always covers every thread.
+    """
+    # pylint: disable=import-outside-toplevel
+    import cProfile
+    import pstats
+    import tracemalloc
+
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    profile = cProfile.Profile()
+    start_time = time.time()
+    profile.enable()
+    try:
+        return run()
+    finally:
+        profile.disable()
+        seconds = time.time() - start_time
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            (tracemalloc.Filter(False, tracemalloc.__file__),))
+        peak = tracemalloc.get_traced_memory()[1]
+        if not tracing:
+            tracemalloc.stop()
+        try:
+            report = profile_report(name, seconds, pstats.Stats(profile),
+                                    snapshot, peak)
+            log_event("info", f"Profile of {name}", "profile", **report)
+            if PROFILE_URI:
+                stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+                write_state(f"{PROFILE_URI.rstrip('/')}/{name}-{stamp}-"
+                            f"{uuid.uuid4().hex[:8]}.json", report)
+        except Exception as e:  # pylint: disable=broad-except
+            log_event("error", "Unable to report profile", "profile",
+                      error=str(e))
+
+
+def invocation(entry_point):
+    """Wraps an entry point to profile it on demand and flush its logs.
+
+    Invocations that are not profiled call straight through; nothing is
+    imported or traced unless a run is profiled.
+    """
+    @functools.wraps(entry_point)
+    def wrapper(request):
+        try:
+            if not should_profile(request):
+                return entry_point(request)
+            return run_profiled(entry_point.__name__,
+                                lambda: entry_point(request))
+        finally:
+            flush_logs()
+    return wrapper
+
+
+@functions_framework.http
+@invocation
+def main(request):
+    """Main Cloud Function entry point (HTTP Triggered)."""
+    try:
+        index, count = shard_params(request)
+    except ValueError as e:
+        log_event("error", f"Invalid shard parameters: {str(e)}", "main",
+                  error=str(e))
+        return "Invalid shard parameters", 400
+
+    if index is None:
+        set_shard(0, 1)
+        return coordinate(request, count)
+
+    set_shard(index, count)
+    result = single_flight(current_shard, lambda: run_exclusively(
+        lambda: run_collection(request, index, count)))
+    if result is not None:
+        return result
+    if count == 1:
+        return "Run already in progress"
+    return {"shard": index, "shards": count, "projects": 0,
+            "complete": False, "skipped": True}
+
+
+@functions_framework.http
+@invocation
+def main_async(request):
+    """Cloud Function entry point running the collector on asyncio."""
+    set_shard(0, 1)
+    result = single_flight(current_shard, lambda: run_exclusively(
+        lambda: run_batch(
+            request,
+            lambda: run_async(collect_async(collection_folders())),
+            lambda: run_async(flush_metrics_async()))))
+    return "Run already in progress" if result is None else result
+
+
+PROJECT_ASSET_TYPE = "cloudresourcemanager.googleapis.com/Project"
+
+
+def event_asset(cloud_event):
+    """Decodes the TemporalAsset carried by a project change CloudEvent.
+
+    Asset feeds publish to Pub/Sub, whose CloudEvents wrap the asset in
+    a base64 message; an event whose data is the asset itself is read
+    as is.
+    """
+    data = cloud_event.data
+    if "message" in data:
+        return json.loads(base64.b64decode(data["message"]["data"]))
+    return data
+
+
+def event_in_scope(ancestors):
+    """Whether a project with these ancestors is collected by this service.
+
+    Without RECURSIVE_CRAWL only projects directly under FOLDER_ID count.
+    An event without ancestors is trusted to come from the folder's feed.
+    """
+    if not ancestors:
+        return True
+    folders = {f"folders/{folder_id}" for folder_id in folder_ids()}
+    if RECURSIVE_CRAWL:
+        return not folders.isdisjoint(ancestors)
+    return len(ancestors) > 1 and ancestors[1] in folders
+
+
+def event_changes(cloud_event):
+    """Returns {project name: project id} for the project an event changed.
+
+    Events for other asset types or for projects outside FOLDER_ID give
+    no changes.
+    """
+    temporal_asset = event_asset(cloud_event)
+    asset = temporal_asset.get("asset") or {}
+    if asset.get("assetType") != PROJECT_ASSET_TYPE:
+        return {}
+    prior_asset = temporal_asset.get("priorAsset") or {}
+    ancestors = asset.get("ancestors") or prior_asset.get("ancestors")
+    if not event_in_scope(ancestors or []):
+        return {}
+    # "//cloudresourcemanager.googleapis.com/projects/<number>"
+    name = "projects/" + asset["name"].rsplit("/projects/", 1)[1]
+    resource = asset.get("resource") or prior_asset.get("resource") or {}
+    return {name: resource.get("data", {}).get("projectId")}
+
+
+def get_changed_project(name):
+    """Fetches a changed project, None when it is gone or out of reach."""
+    try:
+        return rm_call(get_client("projects_client").get_project,
+                       resourcemanager_v3.GetProjectRequest(name=name))
+    except (exceptions.NotFound, exceptions.PermissionDenied):
+        return None
+
+
+def ingest_changes(changes):
+    """Fetches, transforms and stores the projects changed by events.
+
+    Projects that can no longer be read are stored as DELETED. With
+    CURRENT_TABLE the rows are merged straight away; the batch never
+    marks unseen projects deleted. Batches run concurrently, so each
+    keeps its own run rather than replacing current_run.
+    """
+    run = new_run()
+    start_time = time.time()
+    with ThreadPoolExecutor(
+            max_workers=min(CRAWL_MAX_WORKERS, len(changes))) as executor:
+        projects = dict(zip(changes,
+                            executor.map(get_changed_project, changes)))
+    monitor("dfc_prj_api_duration", time.time() - start_time)
+
+    rows = transform([project for project in projects.values()
+                      if project is not None], run)
+    for name, project in projects.items():
+        if project is None and changes[name]:
+            rows.append(deleted_row(changes[name], name, run))
+        elif project is None:
+            log_event("warning", "Deleted project without a project id",
+                      "event", project_number=name)
+    monitor("dfc_event_projects", len(rows))
+    if not rows:
+        return True
+    if not store(rows, failures=[]):
+        return False
+    return not CURRENT_TABLE or merge_current(complete=False, run=run)
+
+
+# changes waiting for the batch window of the first event in a burst
+event_batch = None  # pylint: disable=invalid-name
+event_batch_lock = threading.Lock()
+
+
+def batch_changes(changes):
+    """Adds changes to the open batch.
+
+    The first event of a burst opens the batch and, EVENT_BATCH_SECONDS
+    later, ingests every change that joined it. The other events wait
+    for that outcome, so a failed batch is redelivered for all of them.
+    Returns whether the batch was stored and whether this call led it.
+    """
+    global event_batch  # pylint: disable=global-statement
+    with event_batch_lock:
+        batch = event_batch
+        leader = batch is None
+        if leader:
+            batch = event_batch = {"changes": {}, "stored": False,
+                                   "done": threading.Event()}
+        batch["changes"].update(changes)
+    if not leader:
+        batch["done"].wait()
+        return batch["stored"], False
+
+    time.sleep(EVENT_BATCH_SECONDS)
+    with event_batch_lock:
+        event_batch = None
+    try:
+        monitor("dfc_event_batch_size", len(batch["changes"]))
+        batch["stored"] = ingest_changes(batch["changes"])
+    except Exception as e:  # pylint: disable=broad-except
+        log_event("error", f"Unable to ingest project changes: {str(e)}",
+                  "event", error=str(e))
+    finally:
+        batch["done"].set()
+    return batch["stored"], True
+
+
+@functions_framework.cloud_event
+@invocation
+def main_event(cloud_event):
+    """Cloud Function entry point for project change events.
+
+    Only the changed projects are collected, so the scheduled full scan
+    is left to reconcile what events missed. Raising makes Pub/Sub
+    redeliver the event. Invocations run concurrently, so only the leader
+    of a batch flushes metrics; the others' go out with its series.
+    """
+    start_time = time.time()
+    set_shard(0, 1)
+    try:
+        changes = event_changes(cloud_event)
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        # a malformed event will not parse on redelivery either
+        log_event("error", "Unreadable project change event", "event",
+                  event_id=cloud_event["id"], error=str(e))
+        monitor("dfc_event_invalid", 1)
+        return
+
+    monitor("dfc_event_received", 1)
+    if not changes:
+        log_event("info", "Event ignored", "event",
+                  event_id=cloud_event["id"])
+        return
+    stored, leader = batch_changes(changes)
+    monitor("dfc_event_duration", time.time() - start_time)
+    if leader:
+        flush_metrics()
+    if not stored:
+        raise RuntimeError(f"Project changes of event {cloud_event['id']} "
+                           "were not stored")
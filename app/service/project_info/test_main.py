@@ -1,10 +1,46 @@
 """
     Summary : unit test scripts
 """
-from unittest.mock import patch, MagicMock
+# pylint: disable=too-many-lines
+import asyncio
+import base64
+import json
+import logging
+import queue
+import re
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import patch, AsyncMock, MagicMock
+import pytest
+from cloudevents.http import CloudEvent
 from google.api_core import exceptions
+from google.protobuf.timestamp_pb2 import Timestamp  # pylint: disable=E0611
 
 import main
+from bench_transform import message_to_dict_row
+
+
+@pytest.fixture(autouse=True)
+def reset_clients(monkeypatch):
+    """Every test starts without memoised API clients."""
+    for name in main.CLIENT_FACTORIES:
+        monkeypatch.setattr(f"main.{name}", None)
+    monkeypatch.setattr("main.client_states", {})
+    monkeypatch.setattr("main.async_clients", {})
+    monkeypatch.setattr("main.current_shard", (0, 1))
+    monkeypatch.setattr("main.shard_by_hash", False)
+    monkeypatch.setattr("main.current_run", {})
+    monkeypatch.setattr("main.run_deadline", float("inf"))
+    monkeypatch.setattr("main.deadline_stops", [])
+    monkeypatch.setattr("main.rm_limiter", main.RateLimiter(1e6, 1.0, 64))
+    monkeypatch.setattr("main.RM_BACKOFF_SECONDS", 0)
+    monkeypatch.setattr("main.store_failures", [])
+    monkeypatch.setattr("main.histograms", {})
+    monkeypatch.setattr("main.log_repeats", {})
 
 
 def test_get_projects_success(monkeypatch):
@@ -18,11 +54,11 @@ def test_get_projects_success(monkeypatch):
         mock_projects_client.return_value.list_projects
     ) = MagicMock()
     mock_project = MagicMock()
-    mock_list_projects.return_value = [mock_project]
+    mock_list_projects.return_value = _pager([mock_project])
 
     monkeypatch.setattr(
         "main.resourcemanager_v3.ProjectsClient",
-        lambda: mock_projects_client.return_value,
+        lambda **_: mock_projects_client.return_value,
     )
 
     projects = main.get_projects("test_folder")
@@ -39,11 +75,11 @@ def test_get_projects_no_projects(monkeypatch):
     mock_list_projects = (
         mock_projects_client.return_value.list_projects
     ) = MagicMock()
-    mock_list_projects.return_value = []
+    mock_list_projects.return_value = _pager([])
 
     monkeypatch.setattr(
         "main.resourcemanager_v3.ProjectsClient",
-        lambda: mock_projects_client.return_value,
+        lambda **_: mock_projects_client.return_value,
     )
 
     projects = main.get_projects("test_folder")
@@ -65,7 +101,7 @@ def test_get_projects_invalid_argument(monkeypatch):
 
     monkeypatch.setattr(
         "main.resourcemanager_v3.ProjectsClient",
-        lambda: mock_projects_client.return_value,
+        lambda **_: mock_projects_client.return_value,
     )
 
     projects = main.get_projects("test_folder")
@@ -87,7 +123,7 @@ def test_get_projects_permission_denied(monkeypatch):
 
     monkeypatch.setattr(
         "main.resourcemanager_v3.ProjectsClient",
-        lambda: mock_projects_client.return_value,
+        lambda **_: mock_projects_client.return_value,
     )
 
     projects = main.get_projects("test_folder")
@@ -108,7 +144,7 @@ def test_get_projects_not_found(monkeypatch):
 
     monkeypatch.setattr(
         "main.resourcemanager_v3.ProjectsClient",
-        lambda: mock_projects_client.return_value,
+        lambda **_: mock_projects_client.return_value,
     )
 
     projects = main.get_projects("test_folder")
@@ -131,7 +167,7 @@ def test_get_projects_service_unavailable(monkeypatch):
 
     monkeypatch.setattr(
         "main.resourcemanager_v3.ProjectsClient",
-        lambda: mock_projects_client.return_value,
+        lambda **_: mock_projects_client.return_value,
     )
 
     projects = main.get_projects("test_folder")
@@ -153,7 +189,7 @@ def test_get_projects_deadline_exceeded(monkeypatch):
 
     monkeypatch.setattr(
         "main.resourcemanager_v3.ProjectsClient",
-        lambda: mock_projects_client.return_value,
+        lambda **_: mock_projects_client.return_value,
     )
 
     projects = main.get_projects("test_folder")
@@ -176,7 +212,7 @@ def test_get_projects_google_api_call_error(monkeypatch):
 
     monkeypatch.setattr(
         "main.resourcemanager_v3.ProjectsClient",
-        lambda: mock_projects_client.return_value,
+        lambda **_: mock_projects_client.return_value,
     )
 
     projects = main.get_projects("test_folder")
@@ -197,7 +233,7 @@ def test_get_projects_key_error(monkeypatch):
 
     monkeypatch.setattr(
         "main.resourcemanager_v3.ProjectsClient",
-        lambda: mock_projects_client.return_value,
+        lambda **_: mock_projects_client.return_value,
     )
 
     projects = main.get_projects("test_folder")
@@ -218,7 +254,7 @@ def test_get_projects_value_error(monkeypatch):
 
     monkeypatch.setattr(
         "main.resourcemanager_v3.ProjectsClient",
-        lambda: mock_projects_client.return_value,
+        lambda **_: mock_projects_client.return_value,
     )
 
     projects = main.get_projects("test_folder")
@@ -239,7 +275,7 @@ def test_get_projects_timeout_error(monkeypatch):
 
     monkeypatch.setattr(
         "main.resourcemanager_v3.ProjectsClient",
-        lambda: mock_projects_client.return_value,
+        lambda **_: mock_projects_client.return_value,
     )
 
     projects = main.get_projects("test_folder")
@@ -260,41 +296,61 @@ def test_get_projects_unexpected_error(monkeypatch):
 
     monkeypatch.setattr(
         "main.resourcemanager_v3.ProjectsClient",
-        lambda: mock_projects_client.return_value,
+        lambda **_: mock_projects_client.return_value,
     )
 
     projects = main.get_projects("test_folder")
     assert not projects
 
 
-@patch("main.MessageToDict")
-def test_transform(mock_message_to_dict):
-    """_summary_
-
-    Args:
-        mock_message_to_dict (_type_): _description_
-    """
-    mock_message_to_dict.return_value = {
+def _project(**overrides):
+    """Builds a Resource Manager Project message for transform tests."""
+    fields = {
         "project_id": "test_project_id",
         "name": "test_project_number",
         "display_name": "test_project_name",
         "labels": {"key1": "value1"},
-        "state": "ACTIVE",
+        "state": main.resourcemanager_v3.Project.State.ACTIVE,
         "parent": "test_folder_id",
         "etag": "test_etag",
-        "create_time": "test_create_time",
-        "update_time": "test_update_time",
+        "create_time": Timestamp(seconds=1742299200),
+        "update_time": Timestamp(seconds=1742299500, nanos=123000000),
     }
-    transformed_data = main.transform([MagicMock()])
+    fields.update(overrides)
+    return main.resourcemanager_v3.Project(**fields)
+
+
+def test_transform():
+    """_summary_
+    """
+    transformed_data = main.transform([_project()])
     assert len(transformed_data) == 1
     assert transformed_data[0]["project_id"] == "test_project_id"
     assert transformed_data[0]["project_number"] == "test_project_number"
     assert transformed_data[0]["project_name"] == "test_project_name"
     assert transformed_data[0]["folder_id"] == "test_folder_id"
+    assert transformed_data[0]["state"] == "ACTIVE"
+    assert transformed_data[0]["create_time"] == "2025-03-18T12:00:00Z"
+    assert transformed_data[0]["update_time"] == "2025-03-18T12:05:00.123Z"
     assert transformed_data[0]["labels"] == [
         {"key": "key1", "value": "value1"}]
 
 
+def test_transform_matches_message_to_dict():
+    """Direct field access yields exactly the MessageToDict-based rows."""
+    projects = [
+        _project(),
+        _project(labels={"b": "2", "a": "1", "c": ""}, etag=""),
+        _project(state=main.resourcemanager_v3.Project.State.DELETE_REQUESTED,
+                 update_time=Timestamp(seconds=1742299500, nanos=1)),
+        main.resourcemanager_v3.Project(name="projects/1"),
+    ]
+    rows = main.transform(projects)
+    ingestion_timestamp = rows[0]["ingestion_time"]
+    assert rows == [message_to_dict_row(project, ingestion_timestamp)
+                    for project in projects]
+
+
 @patch("main.bq_client")
 def test_store_success(mock_bq_client):
     """_summary_
@@ -310,7 +366,8 @@ def test_store_success(mock_bq_client):
     result = main.store(rows)
     assert result is True
     mock_insert_rows_json.assert_called_once_with(
-        "observability.project_info", rows)
+        "observability.project_info", rows,
+        row_ids=[main.row_id(rows[0])])
 
 
 def test_store_no_data():
@@ -498,6 +555,8 @@ def test_monitor(mock_monitoring_client):
     mock_monitoring_client.create_time_series = mock_create_time_series
     main.PROJECT_ID = "test_project"
     main.monitor("test_metric", 1.0)
+    mock_create_time_series.assert_not_called()
+    main.flush_metrics()
     mock_create_time_series.assert_called_once()
 
 
@@ -507,6 +566,7 @@ def test_main_success(monkeypatch):
     mock_request = MagicMock()
     mock_request.method = "POST"
     mock_request.path = "/test-path"
+    mock_request.args = {}
 
     mock_get_projects = MagicMock(return_value=[{
         "project_id": "test_project_id",
@@ -547,6 +607,7 @@ def test_main_no_projects(monkeypatch):
     mock_request = MagicMock()
     mock_request.method = "POST"
     mock_request.path = "/test-path"
+    mock_request.args = {}
     mock_get_projects = MagicMock(return_value=[])
     monkeypatch.setattr("main.get_projects", mock_get_projects)
 
@@ -560,3 +621,2034 @@ def test_main_no_projects(monkeypatch):
     mock_get_projects.assert_called_once_with("test_project")
     mock_log_event.assert_any_call(
         "info", "No projects to process", "complete")
+
+
+def _pager(*pages, field="projects"):
+    """Builds a fake Resource Manager pager yielding the given pages."""
+    pager = MagicMock()
+    pager.pages = [MagicMock(**{field: list(page)}, next_page_token="")
+                   for page in pages]
+    return pager
+
+
+def test_get_project_pages_yields_each_page(monkeypatch):
+    """Each pager page is yielded separately, in order."""
+    mock_client = MagicMock()
+    mock_client.list_projects.return_value = _pager(["p1", "p2"], ["p3"])
+    monkeypatch.setattr(
+        "main.resourcemanager_v3.ProjectsClient", lambda **_: mock_client)
+    monkeypatch.setattr("main.monitor", MagicMock())
+
+    pages = list(main.get_project_pages("test_folder"))
+    assert pages == [["p1", "p2"], ["p3"]]
+
+
+def test_get_project_pages_error(monkeypatch):
+    """API errors end the stream without raising."""
+    mock_client = MagicMock()
+    mock_client.list_projects.side_effect = exceptions.PermissionDenied(
+        "Permission Denied")
+    monkeypatch.setattr(
+        "main.resourcemanager_v3.ProjectsClient", lambda **_: mock_client)
+
+    assert not list(main.get_project_pages("test_folder"))
+
+
+def test_stream_projects_stores_page_by_page(monkeypatch):
+    """Every page is transformed and stored before the next is fetched."""
+    calls = []
+
+    def fake_pages(_folder_id):
+        for page in (["p1", "p2"], ["p3"]):
+            calls.append(("fetch", page))
+            yield page
+
+    monkeypatch.setattr("main.get_project_pages", fake_pages)
+    monkeypatch.setattr("main.transform", list)
+    monkeypatch.setattr(
+        "main.store", lambda rows: calls.append(("store", rows)))
+
+    assert main.stream_projects("test_folder") == 3
+    assert calls == [
+        ("fetch", ["p1", "p2"]), ("store", ["p1", "p2"]),
+        ("fetch", ["p3"]), ("store", ["p3"]),
+    ]
+
+
+def test_main_streaming_mode(monkeypatch):
+    """Streaming mode bypasses the materialised get_projects path."""
+    mock_request = MagicMock()
+    mock_request.method = "POST"
+    mock_request.path = "/test-path"
+    mock_request.args = {}
+    mock_get_projects = MagicMock()
+    mock_stream_projects = MagicMock(return_value=2)
+    monkeypatch.setattr("main.STREAMING_MODE", True)
+    monkeypatch.setattr("main.FOLDER_ID", "test_project")
+    monkeypatch.setattr("main.get_projects", mock_get_projects)
+    monkeypatch.setattr("main.stream_projects", mock_stream_projects)
+    monkeypatch.setattr("main.monitor", MagicMock())
+
+    result = main.main(mock_request)
+    assert result == "Project details loaded successfully"
+    mock_stream_projects.assert_called_once_with("test_project")
+    mock_get_projects.assert_not_called()
+
+
+def _fake_folders_client(tree):
+    """Builds a FoldersClient mock serving the given parent -> children map."""
+    mock_folders_client = MagicMock()
+    mock_folders_client.list_folders.side_effect = lambda request: _pager(
+        [SimpleNamespace(name=f"folders/{child}")
+         for child in tree.get(request.parent.split("/")[-1], [])],
+        field="folders")
+    return mock_folders_client
+
+
+def test_get_projects_recursive_walks_nested_folders(monkeypatch):
+    """Projects in every nested subfolder are collected."""
+    tree = {"root": ["a", "b"], "a": ["a1"]}
+    folder_projects = {"root": ["p0"], "a": ["p1"], "b": ["p2"],
+                       "a1": ["p3", "p4"]}
+    mock_projects_client = MagicMock()
+    mock_projects_client.list_projects.side_effect = lambda request: _pager(
+        folder_projects[request.parent.split("/")[-1]])
+    monkeypatch.setattr("main.resourcemanager_v3.FoldersClient",
+                        lambda **_: _fake_folders_client(tree))
+    monkeypatch.setattr(
+        "main.resourcemanager_v3.ProjectsClient",
+        lambda **_: mock_projects_client)
+    monkeypatch.setattr("main.monitor", MagicMock())
+
+    projects = main.get_projects_recursive("root", max_workers=2)
+    assert sorted(projects) == ["p0", "p1", "p2", "p3", "p4"]
+
+
+def test_get_projects_recursive_isolates_folder_errors(monkeypatch):
+    """A failing subfolder is logged and skipped; siblings still load."""
+    def fake_list_projects(request):
+        if request.parent == "folders/bad":
+            raise exceptions.PermissionDenied("Permission Denied")
+        return _pager([request.parent])
+
+    mock_projects_client = MagicMock()
+    mock_projects_client.list_projects.side_effect = fake_list_projects
+    monkeypatch.setattr(
+        "main.resourcemanager_v3.FoldersClient",
+        lambda **_: _fake_folders_client({"root": ["bad", "good"]}))
+    monkeypatch.setattr(
+        "main.resourcemanager_v3.ProjectsClient",
+        lambda **_: mock_projects_client)
+    monkeypatch.setattr("main.monitor", MagicMock())
+
+    projects = main.get_projects_recursive("root")
+    assert sorted(projects) == ["folders/good", "folders/root"]
+
+
+def test_collect_checkpointed_run_walks_nested_folders(monkeypatch,
+                                                        tmp_path):
+    """The paged path collects nested folders and checkpoints each one."""
+    tree = {"root": ["a", "b"], "a": ["a1"]}
+    folder_pages = {folder: [[_project(project_id=f"{folder}-p")]]
+                    for folder in ("root", "a", "b", "a1")}
+    monkeypatch.setattr("main.resourcemanager_v3.FoldersClient",
+                        lambda **_: _fake_folders_client(tree))
+    monkeypatch.setattr(
+        "main.resourcemanager_v3.ProjectsClient",
+        lambda **_: _token_pager_client(folder_pages))
+    monkeypatch.setattr("main.RECURSIVE_CRAWL", True)
+    monkeypatch.setattr("main.CHECKPOINT_URI", str(tmp_path / "run.json"))
+    monkeypatch.setattr("main.CHECKPOINT_INTERVAL_SECONDS", 0)
+    monkeypatch.setattr("main.FOLDER_ID", "root")
+    monkeypatch.setattr("main.monitor", MagicMock())
+    stored = []
+    monkeypatch.setattr("main.store", lambda rows: stored.extend(rows) or 1)
+
+    assert main.collect() == 4
+    assert sorted(row["project_id"] for row in stored) == [
+        "a-p", "a1-p", "b-p", "root-p"]
+
+
+def test_get_projects_list_mode_counts_calls(monkeypatch):
+    """List mode reports its page calls like search mode does."""
+    mock_client = MagicMock()
+    mock_client.list_projects.return_value = _pager(["p1", "p2"], ["p3"])
+    monkeypatch.setattr(
+        "main.resourcemanager_v3.ProjectsClient", lambda **_: mock_client)
+    mock_monitor = MagicMock()
+    monkeypatch.setattr("main.monitor", mock_monitor)
+
+    assert main.get_projects("test_folder") == ["p1", "p2", "p3"]
+    mock_monitor.assert_any_call("dfc_prj_api_calls", 2)
+
+
+def test_get_projects_search_mode(monkeypatch):
+    """Search mode queries the folder with one paged SearchProjects stream."""
+    mock_client = MagicMock()
+    mock_client.search_projects.return_value = _pager(["p1", "p2"], ["p3"])
+    monkeypatch.setattr(
+        "main.resourcemanager_v3.ProjectsClient", lambda **_: mock_client)
+    monkeypatch.setattr("main.COLLECTION_MODE", "search")
+    mock_monitor = MagicMock()
+    monkeypatch.setattr("main.monitor", mock_monitor)
+
+    projects = main.get_projects("test_folder")
+    assert projects == ["p1", "p2", "p3"]
+    request = mock_client.search_projects.call_args.kwargs["request"]
+    assert request.query == "parent:folders/test_folder"
+    mock_client.list_projects.assert_not_called()
+    mock_monitor.assert_any_call("dfc_prj_api_calls", 2)
+
+
+def test_get_project_pages_search_query_override(monkeypatch):
+    """SEARCH_QUERY replaces the folder query, e.g. for org-wide scans."""
+    mock_client = MagicMock()
+    mock_client.search_projects.return_value = _pager(["p1"])
+    monkeypatch.setattr(
+        "main.resourcemanager_v3.ProjectsClient", lambda **_: mock_client)
+    monkeypatch.setattr("main.COLLECTION_MODE", "search")
+    monkeypatch.setattr("main.SEARCH_QUERY", "state:ACTIVE")
+    monkeypatch.setattr("main.monitor", MagicMock())
+
+    assert list(main.get_project_pages("test_folder")) == [["p1"]]
+    request = mock_client.search_projects.call_args.kwargs["request"]
+    assert request.query == "state:ACTIVE"
+
+
+def test_collect_runs_search_query_once(monkeypatch):
+    """An org-wide SEARCH_QUERY is not repeated for every folder."""
+    mock_client = MagicMock()
+    mock_client.search_projects.side_effect = lambda request: _pager(
+        [_project(project_id="p1"), _project(project_id="p2")])
+    monkeypatch.setattr(
+        "main.resourcemanager_v3.ProjectsClient", lambda **_: mock_client)
+    monkeypatch.setattr("main.COLLECTION_MODE", "search")
+    monkeypatch.setattr("main.SEARCH_QUERY", "state:ACTIVE")
+    monkeypatch.setattr("main.FOLDER_ID", "a,b")
+    monkeypatch.setattr("main.monitor", MagicMock())
+    stored = []
+    monkeypatch.setattr("main.store", lambda rows: stored.extend(rows) or 1)
+
+    assert main.collect() == 2
+    assert mock_client.search_projects.call_count == 1
+    assert sorted(row["project_id"] for row in stored) == ["p1", "p2"]
+
+    monkeypatch.setattr("main.SEARCH_QUERY", None)
+    assert main.collection_folders() == ["a", "b"]
+
+
+def test_search_and_list_modes_produce_same_rows(monkeypatch):
+    """Both collection modes feed identical rows through transform."""
+    project = main.resourcemanager_v3.Project(
+        name="projects/123", project_id="test-project",
+        parent="folders/test_folder", display_name="Test Project",
+        state=main.resourcemanager_v3.Project.State.ACTIVE,
+        etag="test_etag", labels={"env": "test"})
+    mock_client = MagicMock()
+    mock_client.list_projects.return_value = _pager([project])
+    mock_client.search_projects.return_value = _pager([project])
+    monkeypatch.setattr(
+        "main.resourcemanager_v3.ProjectsClient", lambda **_: mock_client)
+    monkeypatch.setattr("main.monitor", MagicMock())
+
+    listed = main.transform(main.get_projects("test_folder"))
+    monkeypatch.setattr("main.COLLECTION_MODE", "search")
+    searched = main.transform(main.get_projects("test_folder"))
+
+    for row in listed + searched:
+        row.pop("ingestion_time")
+    assert listed == searched
+    assert listed[0]["project_id"] == "test-project"
+
+
+def test_chunk_rows_limits_row_count():
+    """Chunks never exceed the row limit."""
+    rows = [{"project_id": f"p{i}"} for i in range(5)]
+    chunks = list(main.chunk_rows(rows, max_rows=2, max_bytes=10_000))
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    assert [row for chunk in chunks for row in chunk] == rows
+
+
+def test_chunk_rows_limits_encoded_size():
+    """Chunks are split by encoded size; oversized rows travel alone."""
+    small = {"project_id": "p"}
+    large = {"project_id": "x" * 100}
+    chunks = list(main.chunk_rows(
+        [small, small, large, small], max_rows=100, max_bytes=50))
+    assert chunks == [[small, small], [large], [small]]
+
+
+@patch("main.bq_client")
+def test_store_chunks_in_parallel(mock_bq_client, monkeypatch):
+    """Each chunk is inserted separately and the run succeeds as a whole."""
+    mock_bq_client.insert_rows_json = MagicMock(return_value=[])
+    mock_monitor = MagicMock()
+    monkeypatch.setattr("main.monitor", mock_monitor)
+    monkeypatch.setattr("main.INSERT_MAX_ROWS", 2)
+    rows = [{"project_id": f"p{i}"} for i in range(5)]
+
+    assert main.store(rows) is True
+    assert mock_bq_client.insert_rows_json.call_count == 3
+    inserted = [row for call in mock_bq_client.insert_rows_json.call_args_list
+                for row in call.args[1]]
+    assert sorted(r["project_id"] for r in inserted) == [
+        "p0", "p1", "p2", "p3", "p4"]
+    chunk_metrics = [call for call in mock_monitor.call_args_list
+                     if call.args[0] == "dfc_bigquery_chunk_insert_duration"]
+    assert len(chunk_metrics) == 3
+
+
+@patch("main.bq_client")
+def test_store_chunk_failure_is_isolated(mock_bq_client, monkeypatch):
+    """A failing chunk fails the run without stopping the other chunks."""
+    def fake_insert(_table, chunk):
+        if chunk[0]["project_id"] == "p2":
+            raise exceptions.BadRequest("Bad Request")
+        return []
+
+    mock_bq_client.insert_rows_json = MagicMock(side_effect=fake_insert)
+    monkeypatch.setattr("main.monitor", MagicMock())
+    monkeypatch.setattr("main.INSERT_MAX_ROWS", 2)
+    rows = [{"project_id": f"p{i}"} for i in range(5)]
+
+    assert main.store(rows) is False
+    assert mock_bq_client.insert_rows_json.call_count == 3
+
+
+@patch("main.bq_client")
+def test_store_retries_only_failed_rows(mock_bq_client, monkeypatch):
+    """Only rows rejected for transient reasons are resent."""
+    mock_bq_client.insert_rows_json = MagicMock(side_effect=[
+        [{"index": 1, "errors": [{"reason": "backendError"}]}],
+        [],
+    ])
+    monkeypatch.setattr("main.monitor", MagicMock())
+    monkeypatch.setattr("main.time.sleep", MagicMock())
+    rows = [{"project_id": "p0"}, {"project_id": "p1"}, {"project_id": "p2"}]
+
+    assert main.store(rows) is True
+    assert mock_bq_client.insert_rows_json.call_args_list[1].args == (
+        main.BQ_TABLE, [{"project_id": "p1"}])
+
+
+@patch("main.bq_client")
+def test_store_dead_letters_invalid_rows(mock_bq_client, monkeypatch,
+                                         tmp_path):
+    """Invalid rows go to the dead-letter sink; stopped rows are retried."""
+    mock_bq_client.insert_rows_json = MagicMock(side_effect=[
+        [{"index": 0, "errors": [{"reason": "invalid"}]},
+         {"index": 1, "errors": [{"reason": "stopped"}]}],
+        [],
+    ])
+    dead_letter_path = tmp_path / "dead_letter.ndjson"
+    monkeypatch.setattr("main.DEAD_LETTER_PATH", str(dead_letter_path))
+    monkeypatch.setattr("main.monitor", MagicMock())
+    monkeypatch.setattr("main.time.sleep", MagicMock())
+    rows = [{"project_id": "bad"}, {"project_id": "good"}]
+
+    assert main.store(rows) is False
+    assert mock_bq_client.insert_rows_json.call_args_list[1].args == (
+        main.BQ_TABLE, [{"project_id": "good"}])
+    entries = [json.loads(line)
+               for line in dead_letter_path.read_text().splitlines()]
+    assert entries == [{"row": {"project_id": "bad"},
+                        "errors": [{"reason": "invalid"}]}]
+
+
+@patch("main.bq_client")
+def test_store_retries_throttled_requests(mock_bq_client, monkeypatch):
+    """A transient TooManyRequests does not lose the snapshot."""
+    mock_bq_client.insert_rows_json = MagicMock(side_effect=[
+        exceptions.TooManyRequests("Too Many Requests"),
+        exceptions.ServiceUnavailable("Service Unavailable"),
+        [],
+    ])
+    mock_sleep = MagicMock()
+    monkeypatch.setattr("main.monitor", MagicMock())
+    monkeypatch.setattr("main.time.sleep", mock_sleep)
+
+    assert main.store([{"project_id": "p0"}]) is True
+    assert mock_sleep.call_count == 2
+
+
+def test_backoff_delay_is_bounded(monkeypatch):
+    """Backoff grows exponentially but never exceeds the cap."""
+    monkeypatch.setattr("main.random.uniform", lambda low, high: high)
+    monkeypatch.setattr("main.INSERT_BACKOFF_SECONDS", 1.0)
+    monkeypatch.setattr("main.INSERT_BACKOFF_MAX_SECONDS", 5.0)
+    assert [main.backoff_delay(n) for n in range(4)] == [1.0, 2.0, 4.0, 5.0]
+
+
+def test_arrow_schema_matches_bigquery_schema():
+    """The Arrow schema mirrors infra/schema/project_info.json."""
+    schema_path = Path(__file__).parents[3] / "infra/schema/project_info.json"
+    bq_schema = json.loads(schema_path.read_text())
+    arrow_schema = main.arrow_schema()
+
+    assert arrow_schema.names == [field["name"] for field in bq_schema]
+    for field in bq_schema:
+        assert arrow_schema.field(field["name"]).nullable == (
+            field["mode"] != "REQUIRED")
+    assert arrow_schema.field("labels").type.value_type.names == [
+        "key", "value"]
+
+
+def test_store_load_mode_local_target(monkeypatch, tmp_path):
+    """Load mode writes a Parquet file that round-trips the rows."""
+    import pyarrow.parquet as pq  # pylint: disable=import-outside-toplevel
+
+    target = tmp_path / "project_info.parquet"
+    monkeypatch.setattr("main.SINK_MODE", "load")
+    monkeypatch.setattr("main.LOAD_TARGET", str(target))
+    monkeypatch.setattr("main.monitor", MagicMock())
+    rows = [{
+        "project_id": "test_project_id",
+        "project_number": "projects/123",
+        "folder_id": "folders/456",
+        "project_name": "Test Project",
+        "state": "ACTIVE",
+        "create_time": "2025-03-18T12:00:00Z",
+        "update_time": "2025-03-18T12:05:00.123456Z",
+        "ingestion_time": "2025-03-18T12:10:00+00:00",
+        "etag": "test_etag",
+        "labels": [{"key": "env", "value": "test"}],
+    }]
+
+    assert main.store(rows) is True
+    loaded = pq.read_table(target).to_pylist()
+    assert loaded[0]["project_id"] == "test_project_id"
+    assert loaded[0]["labels"] == [{"key": "env", "value": "test"}]
+    assert loaded[0]["update_time"].microsecond == 123456
+
+
+@patch("main.bq_client")
+def test_store_load_mode_runs_load_job(mock_bq_client, monkeypatch):
+    """Load mode sends one Parquet load job instead of streaming inserts."""
+    monkeypatch.setattr("main.SINK_MODE", "load")
+    monkeypatch.setattr("main.LOAD_TARGET", "")
+    monkeypatch.setattr("main.monitor", MagicMock())
+
+    rows = [{"project_id": "test_project_id", "project_number": "123"}]
+    assert main.store(rows) is True
+    mock_bq_client.insert_rows_json.assert_not_called()
+    job_config = mock_bq_client.load_table_from_file.call_args.kwargs[
+        "job_config"]
+    assert job_config.source_format == "PARQUET"
+    load_job = mock_bq_client.load_table_from_file.return_value
+    load_job.result.assert_called_once()
+
+
+def _row(project_id, etag="etag-1", **overrides):
+    """Builds a transformed row for change-detection tests."""
+    row = {"project_id": project_id,
+           "project_number": f"projects/{project_id}",
+           "etag": etag, "update_time": "2025-03-18T12:05:00Z",
+           "ingestion_time": "2025-03-18T12:10:00+00:00", "labels": []}
+    row.update(overrides)
+    return row
+
+
+def test_incremental_rows_emit_only_changes(monkeypatch, tmp_path):
+    """Only new, changed and deleted projects are written on later runs."""
+    monkeypatch.setattr("main.STATE_URI", str(tmp_path / "state.json"))
+    monkeypatch.setattr("main.state_cache", {})
+    monkeypatch.setattr("main.monitor", MagicMock())
+
+    rows, state = main.incremental_rows([_row("a"), _row("b"), _row("c")])
+    assert len(rows) == 3
+    main.save_state(state)
+
+    main.state_cache.clear()  # simulate a cold start reading the file
+    rows, _ = main.incremental_rows([
+        _row("a", ingestion_time="2025-03-18T12:20:00+00:00"),
+        _row("b", etag="etag-2"),
+        _row("d"),
+    ])
+    assert [(row["project_id"], row.get("state")) for row in rows] == [
+        ("b", None), ("d", None), ("c", "DELETED")]
+    assert rows[2]["project_number"] == "projects/c"
+
+
+def test_incremental_rows_incomplete_run_keeps_unseen(monkeypatch):
+    """Projects missing from a failed crawl are not reported as deleted."""
+    monkeypatch.setattr("main.state_cache", {main.STATE_URI: {
+        "a": ["etag-1", "2025-03-18T12:05:00Z", "hash", "projects/a"]}})
+    monkeypatch.setattr("main.monitor", MagicMock())
+
+    rows, state = main.incremental_rows([], complete=False)
+    assert not rows
+    assert "a" in state
+
+
+def test_main_incremental_skips_unchanged(monkeypatch, tmp_path):
+    """An incremental run with nothing changed does not call store."""
+    mock_request = MagicMock()
+    mock_request.method = "POST"
+    mock_request.path = "/test-path"
+    mock_request.args = {}
+    monkeypatch.setattr("main.INCREMENTAL_MODE", True)
+    monkeypatch.setattr("main.STATE_URI", str(tmp_path / "state.json"))
+    monkeypatch.setattr("main.state_cache", {})
+    monkeypatch.setattr("main.get_projects", MagicMock(return_value=["p"]))
+    monkeypatch.setattr("main.transform", lambda projects: [_row("a")])
+    monkeypatch.setattr("main.monitor", MagicMock())
+    mock_store = MagicMock(return_value=True)
+    monkeypatch.setattr("main.store", mock_store)
+
+    main.main(mock_request)
+    main.main(mock_request)
+    assert mock_store.call_count == 1
+
+
+@patch("main.monitoring_client")
+def test_flush_metrics_batches_series(mock_monitoring_client, monkeypatch):
+    """Buffered metrics are flushed in calls of at most 200 series."""
+    monkeypatch.setattr("main.metrics_buffer", {})
+    for index in range(250):
+        main.monitor(f"test_metric_{index}", 1.0)
+    main.monitor("test_metric_0", 2.0)
+
+    main.flush_metrics()
+    calls = mock_monitoring_client.create_time_series.call_args_list
+    # 250 test metrics plus the registry's dfc_client_reused point
+    assert [len(call.kwargs["time_series"]) for call in calls] == [200, 51]
+    first = calls[0].kwargs["time_series"][0]
+    assert first.metric.type == "custom.googleapis.com/test_metric_0"
+    assert first.points[0].value.double_value == 3.0
+    assert not main.metrics_buffer
+
+
+def test_monitor_combines_repeats_by_metric_kind(monkeypatch):
+    """Counts add up; durations keep the longest, levels the latest."""
+    monkeypatch.setattr("main.metrics_buffer", {})
+    for value in (3.0, 5.0, 2.0):
+        main.monitor("dfc_prj_api_calls", value)
+        main.monitor("dfc_folder_duration", value, folder_id="a")
+        main.monitor("dfc_pipeline_store_max_queue_depth", value)
+        main.monitor("dfc_rm_limiter_rate", value)
+
+    assert main.metrics_buffer == {
+        ("dfc_prj_api_calls", ()): 10.0,
+        ("dfc_folder_duration", (("folder_id", "a"),)): 5.0,
+        ("dfc_pipeline_store_max_queue_depth", ()): 5.0,
+        ("dfc_rm_limiter_rate", ()): 2.0,
+    }
+
+
+@patch("main.monitoring_client")
+def test_flush_metrics_failure_is_logged(mock_monitoring_client, monkeypatch):
+    """A failed flush is logged and does not raise."""
+    mock_monitoring_client.create_time_series.side_effect = (
+        exceptions.ServiceUnavailable("Service Unavailable"))
+    mock_log_event = MagicMock()
+    monkeypatch.setattr("main.log_event", mock_log_event)
+    monkeypatch.setattr("main.metrics_buffer", {})
+
+    main.monitor("test_metric", 1.0)
+    main.flush_metrics()
+    assert mock_log_event.call_args.args[:3] == (
+        "error", "Cloud Monitoring service unavailable", "monitor")
+
+
+def test_import_defers_client_libraries():
+    """Importing main neither loads the client libraries nor builds clients."""
+    heavy_modules = ["google.cloud.bigquery.client",
+                     "google.cloud.resourcemanager_v3.services",
+                     "google.cloud.monitoring_v3.services",
+                     "google.cloud.logging_v2"]
+    result = subprocess.run(
+        [sys.executable, "-c",
+         "import sys, main; "
+         f"print([m for m in {heavy_modules!r} if m in sys.modules]); "
+         "print(main.bq_client, main.monitoring_client)"],
+        cwd=Path(__file__).parent, capture_output=True, text=True, check=True)
+    assert result.stdout.splitlines() == ["[]", "None None"]
+
+
+def test_get_client_is_reused(monkeypatch):
+    """Clients are created once and reused by later calls."""
+    mock_client_class = MagicMock()
+    monkeypatch.setattr("main.bigquery.Client", mock_client_class)
+    mock_monitor = MagicMock()
+    monkeypatch.setattr("main.monitor", mock_monitor)
+
+    assert main.get_client("bq_client") is main.get_client("bq_client")
+    mock_client_class.assert_called_once_with()
+    assert [call.args[0] for call in mock_monitor.call_args_list] == [
+        "dfc_client_created", "dfc_client_reused"]
+
+
+def test_get_client_rebuilds_failed_channel(monkeypatch):
+    """A client whose channel reports a failure is closed and rebuilt."""
+    created = []
+
+    def fake_projects_client(**_):
+        client = MagicMock()
+        created.append(client)
+        return client
+
+    monkeypatch.setattr(
+        "main.resourcemanager_v3.ProjectsClient", fake_projects_client)
+    monkeypatch.setattr("main.monitor", MagicMock())
+
+    first = main.get_client("projects_client")
+    on_state_change = first.transport.grpc_channel.subscribe.call_args.args[0]
+    on_state_change(main.grpc.ChannelConnectivity.TRANSIENT_FAILURE)
+
+    second = main.get_client("projects_client")
+    assert second is not first
+    first.transport.close.assert_called_once()
+    assert main.get_client("projects_client") is second
+
+
+def test_get_client_reports_outside_clients_lock(monkeypatch):
+    """Logging a rebuild cannot wait on the lock get_client holds."""
+    def unlocked(*_, **__):
+        assert not main.clients_lock.locked()
+
+    monkeypatch.setattr(
+        "main.resourcemanager_v3.ProjectsClient", lambda **_: MagicMock())
+    monkeypatch.setattr("main.monitor", MagicMock(side_effect=unlocked))
+    mock_log_event = MagicMock(side_effect=unlocked)
+    monkeypatch.setattr("main.log_event", mock_log_event)
+
+    main.get_client("projects_client")
+    main.client_states["projects_client"] = (
+        main.grpc.ChannelConnectivity.SHUTDOWN)
+    main.get_client("projects_client")
+    assert mock_log_event.call_args.args[2] == "clients"
+    assert main.logging_lock is not main.clients_lock
+
+
+def test_new_projects_client_uses_keepalive_channel(monkeypatch):
+    """The Resource Manager channel is created with keepalive options."""
+    transport_class = MagicMock()
+    monkeypatch.setattr(
+        "main.resourcemanager_v3.services.projects.transports"
+        ".ProjectsGrpcTransport", transport_class)
+    mock_client_class = MagicMock()
+    monkeypatch.setattr(
+        "main.resourcemanager_v3.ProjectsClient", mock_client_class)
+
+    main.new_projects_client()
+    transport_factory = mock_client_class.call_args.kwargs["transport"]
+    transport_factory(host="cloudresourcemanager.googleapis.com")
+    create_channel = transport_class.call_args.kwargs["channel"]
+    create_channel("cloudresourcemanager.googleapis.com",
+                   options=[("grpc.max_send_message_length", -1)])
+
+    options = dict(transport_class.create_channel.call_args.kwargs["options"])
+    assert options["grpc.keepalive_time_ms"] == 30000
+    assert options["grpc.max_send_message_length"] == -1
+
+
+def _slow_pages(count, delay, fetched):
+    """Yields count pages, sleeping before each like a slow pager."""
+    for index in range(count):
+        time.sleep(delay)
+        fetched.append(index)
+        yield [f"p{index}"]
+
+
+def test_stream_projects_overlaps_stages(monkeypatch):
+    """Overlapped stages finish close to the slowest stage, not the sum."""
+    delay = 0.05
+    stored = []
+
+    def slow_transform(page):
+        time.sleep(delay)
+        return list(page)
+
+    def slow_store(rows):
+        time.sleep(delay)
+        stored.extend(rows)
+        return True
+
+    monkeypatch.setattr("main.OVERLAPPED_PIPELINE", True)
+    monkeypatch.setattr(
+        "main.get_project_pages",
+        lambda folder_id: _slow_pages(6, delay, []))
+    monkeypatch.setattr("main.transform", slow_transform)
+    monkeypatch.setattr("main.store", slow_store)
+    mock_monitor = MagicMock()
+    monkeypatch.setattr("main.monitor", mock_monitor)
+
+    start_time = time.time()
+    assert main.stream_projects("test_folder") == 6
+    elapsed = time.time() - start_time
+
+    assert stored == [f"p{index}" for index in range(6)]
+    assert elapsed < 6 * 3 * delay * 0.75
+    mock_monitor.assert_any_call("dfc_pipeline_store_items", 6)
+    metric_names = {call.args[0] for call in mock_monitor.call_args_list}
+    assert {"dfc_pipeline_fetch_throughput",
+            "dfc_pipeline_transform_max_queue_depth"} <= metric_names
+
+
+def test_stream_projects_overlapped_backpressure(monkeypatch):
+    """A slow store stage stops the fetcher running far ahead."""
+    fetched = []
+    progress = []
+
+    def slow_store(rows):
+        time.sleep(0.05)
+        progress.append((len(fetched), rows))
+        return True
+
+    monkeypatch.setattr("main.OVERLAPPED_PIPELINE", True)
+    monkeypatch.setattr("main.PIPELINE_QUEUE_SIZE", 1)
+    monkeypatch.setattr(
+        "main.get_project_pages",
+        lambda folder_id: _slow_pages(10, 0, fetched))
+    monkeypatch.setattr("main.transform", list)
+    monkeypatch.setattr("main.store", slow_store)
+    monkeypatch.setattr("main.monitor", MagicMock())
+
+    main.stream_projects("test_folder")
+    fetched_when_first_stored = progress[0][0]
+    assert fetched_when_first_stored <= 5
+
+
+def test_stream_projects_overlapped_store_error(monkeypatch):
+    """A failing store stage is logged and does not deadlock the fetcher."""
+    def failing_store(rows):
+        raise ValueError("Value Error")
+
+    monkeypatch.setattr("main.OVERLAPPED_PIPELINE", True)
+    monkeypatch.setattr("main.PIPELINE_QUEUE_SIZE", 1)
+    monkeypatch.setattr(
+        "main.get_project_pages",
+        lambda folder_id: _slow_pages(5, 0, []))
+    monkeypatch.setattr("main.transform", list)
+    monkeypatch.setattr("main.store", failing_store)
+    monkeypatch.setattr("main.monitor", MagicMock())
+    mock_log_event = MagicMock()
+    monkeypatch.setattr("main.log_event", mock_log_event)
+
+    assert main.stream_projects("test_folder") == 5
+    mock_log_event.assert_any_call(
+        "error", "Pipeline store stage failed", "pipeline",
+        error="Value Error")
+
+
+def test_stream_projects_overlapped_transform_error_deletes_nothing(
+        monkeypatch):
+    """Projects of a page the transform dropped are not marked DELETED."""
+    def transform_once(page):
+        if "b" in page:
+            raise ValueError("Value Error")
+        return [_row(project_id) for project_id in page]
+
+    monkeypatch.setattr("main.OVERLAPPED_PIPELINE", True)
+    monkeypatch.setattr("main.INCREMENTAL_MODE", True)
+    monkeypatch.setattr("main.load_failures", [])
+    monkeypatch.setattr(
+        "main.get_project_pages", lambda folder_id: iter([["a"], ["b"]]))
+    monkeypatch.setattr("main.transform", transform_once)
+    monkeypatch.setattr("main.previous_state", lambda: {
+        "a": ["", "", "", "1"], "b": ["", "", "", "2"]})
+    mock_save_state = MagicMock()
+    monkeypatch.setattr("main.save_state", mock_save_state)
+    stored = []
+    monkeypatch.setattr("main.store", lambda rows: stored.extend(rows) or 1)
+    monkeypatch.setattr("main.monitor", MagicMock())
+    monkeypatch.setattr("main.log_event", MagicMock())
+
+    main.stream_projects("test_folder")
+    assert main.load_failures == ["Value Error"]
+    assert not [row for row in stored if row.get("state") == "DELETED"]
+    mock_save_state.assert_not_called()
+
+
+def test_stream_projects_overlapped_store_error_keeps_state(monkeypatch):
+    """State is not saved for rows a failing store stage never wrote."""
+    monkeypatch.setattr("main.OVERLAPPED_PIPELINE", True)
+    monkeypatch.setattr("main.INCREMENTAL_MODE", True)
+    monkeypatch.setattr(
+        "main.get_project_pages", lambda folder_id: iter([["a"]]))
+    monkeypatch.setattr(
+        "main.transform", lambda page: [_row(item) for item in page])
+    monkeypatch.setattr("main.previous_state", dict)
+    mock_save_state = MagicMock()
+    monkeypatch.setattr("main.save_state", mock_save_state)
+    monkeypatch.setattr(
+        "main.store", MagicMock(side_effect=ValueError("Value Error")))
+    monkeypatch.setattr("main.monitor", MagicMock())
+    monkeypatch.setattr("main.log_event", MagicMock())
+
+    main.stream_projects("test_folder")
+    assert main.store_failures == ["Value Error"]
+    mock_save_state.assert_not_called()
+
+
+def test_stream_projects_load_mode_loads_once_per_table(monkeypatch,
+                                                       tmp_path):
+    """Load mode buffers every page into one load job per sink table."""
+    monkeypatch.setattr("main.OVERLAPPED_PIPELINE", True)
+    monkeypatch.setattr("main.SINK_MODE", "load")
+    monkeypatch.setattr("main.CURRENT_TABLE", "observability.current")
+    monkeypatch.setattr("main.STAGING_TABLE", "observability.staging")
+    monkeypatch.setattr("main.CHECKPOINT_URI", str(tmp_path / "run.json"))
+    monkeypatch.setattr("main.CHECKPOINT_INTERVAL_SECONDS", 0)
+    monkeypatch.setattr("main.get_project_pages", lambda folder_id: iter([
+        main.Page([_project(project_id=f"p{index}")], folder_id,
+                  "" if index == 2 else str(index + 1))
+        for index in range(3)]))
+    loads = []
+    monkeypatch.setattr(
+        "main.load_parquet",
+        lambda rows, table=None: loads.append((table, rows.num_rows)) or 1)
+    monkeypatch.setattr("main.monitor", MagicMock())
+    main.start_run()
+
+    assert main.stream_projects("a") == 3
+    assert loads == [("observability.project_info", 3),
+                     ("observability.staging", 3)]
+    assert main.current_run["folders_done"] == ["a"]
+
+
+def test_stream_projects_overlapped_records_empty_pages(monkeypatch,
+                                                        tmp_path):
+    """A page with no rows in this shard still advances the checkpoint."""
+    monkeypatch.setattr("main.OVERLAPPED_PIPELINE", True)
+    monkeypatch.setattr("main.CHECKPOINT_URI", str(tmp_path / "run.json"))
+    monkeypatch.setattr("main.CHECKPOINT_INTERVAL_SECONDS", 0)
+    monkeypatch.setattr(
+        "main.get_project_pages",
+        lambda folder_id: iter([main.Page([_project()], folder_id, "")]))
+    monkeypatch.setattr("main.transform", lambda page: [])
+    mock_store = MagicMock(return_value=True)
+    monkeypatch.setattr("main.store", mock_store)
+    monkeypatch.setattr("main.monitor", MagicMock())
+    main.start_run()
+
+    assert main.stream_projects("a") == 0
+    mock_store.assert_not_called()
+    assert main.current_run["folders_done"] == ["a"]
+
+
+class _AsyncPager:  # pylint: disable=too-few-public-methods
+    """Fake async Resource Manager pager with a single page of items."""
+
+    def __init__(self, items, field="projects"):
+        self.page = SimpleNamespace(**{field: items}, next_page_token="")
+
+    @property
+    async def pages(self):
+        """Yields the response pages."""
+        yield self.page
+
+
+def _fake_async_clients(monkeypatch, tree, folder_projects):
+    """Serves a folder tree through fake async Resource Manager clients."""
+    def folder_of(request):
+        return request.parent.split("/")[-1]
+
+    async def list_projects(request):
+        if folder_of(request) == "bad":
+            raise exceptions.PermissionDenied("Permission Denied")
+        return _AsyncPager(folder_projects.get(folder_of(request), []))
+
+    async def list_folders(request):
+        return _AsyncPager([SimpleNamespace(name=f"folders/{child}")
+                            for child in tree.get(folder_of(request), [])],
+                           field="folders")
+
+    mock_client = MagicMock()
+    mock_client.list_projects.side_effect = list_projects
+    mock_client.list_folders.side_effect = list_folders
+    monkeypatch.setitem(main.ASYNC_CLIENT_FACTORIES, "projects_client",
+                        lambda: mock_client)
+    monkeypatch.setitem(main.ASYNC_CLIENT_FACTORIES, "folders_client",
+                        lambda: mock_client)
+    return mock_client
+
+
+def test_get_projects_async_walks_nested_folders(monkeypatch):
+    """The async crawl collects every nested subfolder concurrently."""
+    monkeypatch.setattr("main.RECURSIVE_CRAWL", True)
+    monkeypatch.setattr("main.CRAWL_MAX_WORKERS", 2)
+    monkeypatch.setattr("main.monitor", MagicMock())
+    _fake_async_clients(
+        monkeypatch, {"root": ["a", "b"], "a": ["a1"]},
+        {"root": ["p0"], "a": ["p1"], "b": ["p2"], "a1": ["p3", "p4"]})
+
+    projects = main.run_async(main.get_projects_async("root"))
+    assert sorted(projects) == ["p0", "p1", "p2", "p3", "p4"]
+
+
+def test_get_projects_async_isolates_folder_errors(monkeypatch):
+    """A failing folder is recorded as a load failure; siblings load."""
+    monkeypatch.setattr("main.RECURSIVE_CRAWL", True)
+    monkeypatch.setattr("main.monitor", MagicMock())
+    monkeypatch.setattr("main.log_event", MagicMock())
+    monkeypatch.setattr("main.load_failures", [])
+    _fake_async_clients(monkeypatch, {"root": ["bad", "good"]},
+                        {"root": ["p0"], "good": ["p1"]})
+
+    projects = main.run_async(main.get_projects_async("root"))
+    assert sorted(projects) == ["p0", "p1"]
+    assert main.load_failures == ["403 Permission Denied"]
+
+
+def test_main_async_collects_and_stores(monkeypatch):
+    """The async entry point stores transformed rows and flushes metrics."""
+    monkeypatch.setattr("main.FOLDER_ID", "root")
+    monkeypatch.setattr("main.RECURSIVE_CRAWL", False)
+    monkeypatch.setattr("main.metrics_buffer", {})
+    _fake_async_clients(monkeypatch, {}, {"root": ["p0", "p1"]})
+    mock_monitoring = MagicMock()
+    mock_monitoring.create_time_series = AsyncMock()
+    monkeypatch.setitem(main.ASYNC_CLIENT_FACTORIES, "monitoring_client",
+                        lambda: mock_monitoring)
+    monkeypatch.setattr("main.transform", list)
+    mock_store_snapshot = MagicMock()
+    monkeypatch.setattr("main.store_snapshot", mock_store_snapshot)
+    mock_request = MagicMock(method="POST", path="/")
+
+    response = main.main_async(mock_request)
+    assert response == "Project details loaded successfully"
+    mock_store_snapshot.assert_called_once_with(["p0", "p1"])
+    mock_monitoring.create_time_series.assert_awaited()
+    assert not main.metrics_buffer
+
+
+def test_flush_metrics_async_failure_is_logged(monkeypatch):
+    """A failed async flush batch is logged and does not raise."""
+    mock_monitoring = MagicMock()
+    mock_monitoring.create_time_series = AsyncMock(
+        side_effect=exceptions.ServiceUnavailable("Service Unavailable"))
+    monkeypatch.setitem(main.ASYNC_CLIENT_FACTORIES, "monitoring_client",
+                        lambda: mock_monitoring)
+    mock_log_event = MagicMock()
+    monkeypatch.setattr("main.log_event", mock_log_event)
+    monkeypatch.setattr("main.metrics_buffer", {})
+
+    main.monitor("test_metric", 1.0)
+    main.run_async(main.flush_metrics_async())
+    assert mock_log_event.call_args.args[:3] == (
+        "error", "Cloud Monitoring service unavailable", "monitor")
+
+
+def test_folder_ids_from_list_and_file(monkeypatch, tmp_path):
+    """FOLDER_ID accepts a comma-separated list or a folder list file."""
+    monkeypatch.setattr("main.FOLDER_ID", "123, folders/456,")
+    assert main.folder_ids() == ["123", "456"]
+
+    folders_file = tmp_path / "folders.txt"
+    folders_file.write_text("# business units\n123\nfolders/456  # eu\n\n")
+    monkeypatch.setattr("main.FOLDER_ID", str(folders_file))
+    assert main.folder_ids() == ["123", "456"]
+
+
+def test_collect_fetches_folders_in_parallel(monkeypatch):
+    """Every folder is fetched once and one failing folder is isolated."""
+    def fake_get_projects(folder_id):
+        if folder_id == "bad":
+            raise ValueError("Value Error")
+        time.sleep(0.2)
+        return [f"{folder_id}-project"]
+
+    monkeypatch.setattr("main.FOLDER_ID", "a,bad,b")
+    monkeypatch.setattr("main.get_projects", fake_get_projects)
+    monkeypatch.setattr("main.transform", list)
+    mock_store_snapshot = MagicMock()
+    monkeypatch.setattr("main.store_snapshot", mock_store_snapshot)
+    monkeypatch.setattr("main.log_event", MagicMock())
+    monkeypatch.setattr("main.metrics_buffer", {})
+    monkeypatch.setattr("main.load_failures", [])
+
+    start_time = time.time()
+    assert main.collect() == 2
+    assert time.time() - start_time < 0.4
+    mock_store_snapshot.assert_called_once_with(
+        ["a-project", "b-project"])
+    assert main.load_failures == ["Value Error"]
+
+
+def test_folder_metrics_are_labelled_per_folder(monkeypatch):
+    """Each folder gets its own duration and project-count series."""
+    monkeypatch.setattr("main.metrics_buffer", {})
+    monkeypatch.setattr(
+        "main.get_projects", lambda folder_id: [folder_id] * len(folder_id))
+
+    main.get_folders_projects(["a", "bb"])
+    assert main.metrics_buffer[
+        ("dfc_folder_projects", (("folder_id", "bb"),))] == 2
+    _, series = main.drain_metrics()[0]
+    labelled = [item for item in series
+                if item.metric.type.endswith("dfc_folder_duration")]
+    assert sorted(item.metric.labels["folder_id"]
+                  for item in labelled) == ["a", "bb"]
+
+
+def test_stream_projects_merges_folder_pages(monkeypatch):
+    """Streaming several folders stores every page from each folder."""
+    monkeypatch.setattr(
+        "main.get_project_pages",
+        lambda folder_id: iter([[f"{folder_id}1"], [f"{folder_id}2"]]))
+    monkeypatch.setattr("main.transform", list)
+    stored = []
+    monkeypatch.setattr("main.store", lambda rows: stored.extend(rows) or 1)
+    monkeypatch.setattr("main.monitor", MagicMock())
+
+    assert main.stream_projects("a", "b", "c") == 6
+    assert sorted(stored) == ["a1", "a2", "b1", "b2", "c1", "c2"]
+
+
+def _shard_request(**args):
+    """Builds an HTTP request carrying shard query arguments."""
+    return SimpleNamespace(
+        method="POST", path="/", args=args, headers={}, scheme="https",
+        host="project-info.example.run.app")
+
+
+def test_shard_params():
+    """Shard arguments select a shard, a coordinator or a plain run."""
+    assert main.shard_params(_shard_request()) == (0, 1)
+    assert main.shard_params(_shard_request(shards="4")) == (None, 4)
+    assert main.shard_params(
+        _shard_request(shard="3", shards="4")) == (3, 4)
+    with pytest.raises(ValueError):
+        main.shard_params(_shard_request(shard="4", shards="4"))
+
+
+def test_main_rejects_invalid_shard(monkeypatch):
+    """Malformed shard arguments are a client error."""
+    monkeypatch.setattr("main.log_event", MagicMock())
+    assert main.main(_shard_request(shard="x", shards="2")) == (
+        "Invalid shard parameters", 400)
+
+
+def test_main_rejects_too_many_shards(monkeypatch):
+    """A shard count above SHARD_MAX_COUNT is refused before fanning out."""
+    monkeypatch.setattr("main.SHARD_MAX_COUNT", 4)
+    monkeypatch.setattr("main.log_event", MagicMock())
+    mock_coordinate = MagicMock()
+    monkeypatch.setattr("main.coordinate", mock_coordinate)
+
+    assert main.shard_params(_shard_request(shards="4")) == (None, 4)
+    assert main.main(_shard_request(shards="100000")) == (
+        "Invalid shard parameters", 400)
+    mock_coordinate.assert_not_called()
+
+
+def test_shards_split_folders(monkeypatch):
+    """With enough folders, every folder is listed by exactly one shard."""
+    monkeypatch.setattr("main.FOLDER_ID", "a,b,c,d,e")
+    folders = main.folder_ids()
+    shards = []
+    for index in range(2):
+        main.set_shard(index, 2)
+        assert main.in_shard("any-project")
+        shards.append(main.shard_folders(folders))
+    assert shards == [["a", "c", "e"], ["b", "d"]]
+
+
+def test_shards_split_project_hash_ranges(monkeypatch):
+    """With fewer folders than shards, project ids are partitioned."""
+    monkeypatch.setattr("main.FOLDER_ID", "root")
+    project_ids = [f"project-{index}" for index in range(100)]
+    owners = {}
+    for index in range(4):
+        main.set_shard(index, 4)
+        assert main.shard_folders(["root"]) == ["root"]
+        for project_id in project_ids:
+            if main.in_shard(project_id):
+                owners.setdefault(project_id, []).append(index)
+    assert all(len(owners[project_id]) == 1 for project_id in project_ids)
+    assert len({shard for (shard,) in owners.values()}) == 4
+
+
+def test_main_shard_reports_its_projects(monkeypatch):
+    """A shard run answers with its own project count and keeps state apart."""
+    monkeypatch.setattr("main.FOLDER_ID", "a,b")
+    monkeypatch.setattr("main.STATE_URI", "gs://bucket/state.json")
+    collected = []
+    monkeypatch.setattr(
+        "main.get_folders_projects",
+        lambda folders: collected.extend(folders) or ["p1", "p2"])
+    monkeypatch.setattr("main.transform", list)
+    monkeypatch.setattr("main.store_snapshot", MagicMock())
+    monkeypatch.setattr("main.flush_metrics", MagicMock())
+    monkeypatch.setattr("main.log_event", MagicMock())
+
+    result = main.main(_shard_request(shard="1", shards="2"))
+    assert result == {"shard": 1, "shards": 2, "projects": 2,
+                      "complete": True}
+    assert collected == ["b"]
+    assert main.state_uri() == "gs://bucket/state.shard-1-of-2.json"
+
+
+def test_coordinator_aggregates_shards(monkeypatch):
+    """The coordinator calls every shard and reports failed ones."""
+    def fake_call_shard(_url, index, count):
+        if index == 2:
+            return {"shard": index, "shards": count, "error": "timed out"}
+        return {"shard": index, "shards": count, "projects": 10,
+                "complete": index == 0}
+
+    mock_call_shard = MagicMock(side_effect=fake_call_shard)
+    monkeypatch.setattr("main.call_shard", mock_call_shard)
+    monkeypatch.setattr("main.flush_metrics", MagicMock())
+    monkeypatch.setattr("main.log_event", MagicMock())
+    monkeypatch.setattr("main.metrics_buffer", {})
+
+    summary, status = main.main(_shard_request(shards="3"))
+    assert status == 500
+    assert summary == {"shards": 3, "projects": 20, "failed_shards": [2],
+                       "partial_shards": [1]}
+    assert sorted(call.args[1] for call in mock_call_shard.call_args_list) == [
+        0, 1, 2]
+    assert mock_call_shard.call_args.args[0] == (
+        "https://project-info.example.run.app/")
+    assert main.metrics_buffer[("dfc_shard_projects", ())] == 20
+
+
+def test_call_shard_posts_authenticated_request(monkeypatch):
+    """Shard calls carry an ID token and the shard arguments."""
+    from google.oauth2 import id_token  # pylint: disable=C0415
+    import requests  # pylint: disable=C0415
+
+    monkeypatch.setattr(id_token, "fetch_id_token",
+                        lambda request, audience: "token")
+    mock_post = MagicMock()
+    mock_post.return_value.json.return_value = {
+        "shard": 1, "shards": 2, "projects": 5}
+    monkeypatch.setattr(requests, "post", mock_post)
+    monkeypatch.setattr("main.monitor", MagicMock())
+
+    result = main.call_shard("https://fn.example", 1, 2)
+    assert result["projects"] == 5
+    assert mock_post.call_args.kwargs["params"] == {"shard": 1, "shards": 2}
+    assert mock_post.call_args.kwargs["headers"] == {
+        "Authorization": "Bearer token"}
+
+
+def _token_pager_client(folder_pages):
+    """Builds a ProjectsClient mock whose listings honour page tokens."""
+    def list_projects(request):
+        pages = folder_pages[request.parent.split("/")[-1]]
+        first = int(request.page_token or 0)
+        pager = MagicMock()
+        pager.pages = [
+            SimpleNamespace(projects=page, next_page_token=(
+                str(number + 1) if number + 1 < len(pages) else ""))
+            for number, page in enumerate(pages) if number >= first]
+        return pager
+
+    mock_client = MagicMock()
+    mock_client.list_projects.side_effect = list_projects
+    return mock_client
+
+
+def test_collect_resumes_from_checkpoint(monkeypatch, tmp_path):
+    """A killed run resumes after its last stored page under its run id."""
+    class Killed(Exception):
+        """Stands in for the platform stopping the instance."""
+
+    folder_pages = {
+        folder: [[_project(project_id=f"{folder}{page}{item}")
+                  for item in range(2)] for page in range(3)]
+        for folder in ("a", "b")}
+    monkeypatch.setattr(
+        "main.resourcemanager_v3.ProjectsClient",
+        lambda **_: _token_pager_client(folder_pages))
+    checkpoint_file = tmp_path / "checkpoint.json"
+    monkeypatch.setattr("main.CHECKPOINT_URI", str(checkpoint_file))
+    monkeypatch.setattr("main.CHECKPOINT_INTERVAL_SECONDS", 0)
+    monkeypatch.setattr("main.FOLDER_ID", "a,b")
+    monkeypatch.setattr("main.FOLDER_MAX_WORKERS", 1)
+    monkeypatch.setattr("main.monitor", MagicMock())
+    monkeypatch.setattr("main.log_event", MagicMock())
+    stored = []
+
+    def store_until_killed(rows):
+        if len(stored) == 8:
+            raise Killed()
+        stored.extend(rows)
+        return True
+
+    monkeypatch.setattr("main.store", store_until_killed)
+    with pytest.raises(Killed):
+        main.collect()
+    checkpoint = json.loads(checkpoint_file.read_text())
+    assert checkpoint["folders_done"] == ["a"]
+    assert checkpoint["page_tokens"] == {"b": "1"}
+
+    monkeypatch.setattr("main.store", lambda rows: stored.extend(rows) or 1)
+    assert main.collect() == 4
+    assert [row["project_id"] for row in stored] == [
+        f"{folder}{page}{item}" for folder in ("a", "b")
+        for page in range(3) for item in range(2)]
+    assert {row["run_id"] for row in stored} == {checkpoint["run_id"]}
+    assert {row["ingestion_time"] for row in stored} == {
+        checkpoint["ingestion_time"]}
+    assert not json.loads(checkpoint_file.read_text())
+
+
+def test_start_run_ignores_expired_checkpoint(monkeypatch, tmp_path):
+    """Page tokens expire, so an old checkpoint starts a new run."""
+    checkpoint_file = tmp_path / "checkpoint.json"
+    checkpoint_file.write_text(json.dumps({
+        "run_id": "old", "started": time.time() - 7200,
+        "ingestion_time": "2025-03-18T12:00:00+00:00",
+        "folders_done": ["a"], "page_tokens": {}}))
+    monkeypatch.setattr("main.CHECKPOINT_URI", str(checkpoint_file))
+
+    run = main.start_run(resume=True)
+    assert run["run_id"] != "old"
+    assert not run["folders_done"]
+
+
+def test_main_stops_fetching_at_deadline(monkeypatch):
+    """Near the timeout fetching stops; fetched pages are still stored."""
+    monkeypatch.setattr("main.FUNCTION_TIMEOUT_SECONDS", 0.25)
+    monkeypatch.setattr("main.DEADLINE_MARGIN_SECONDS", 0)
+    monkeypatch.setattr("main.STREAMING_MODE", True)
+    monkeypatch.setattr("main.FOLDER_ID", "test_folder")
+    monkeypatch.setattr(
+        "main.get_project_pages",
+        lambda folder_id: (page for page in _slow_pages(50, 0.05, [])
+                           if not main.out_of_time("fetch")))
+    monkeypatch.setattr("main.transform", list)
+    stored = []
+    monkeypatch.setattr("main.store", lambda rows: stored.extend(rows) or 1)
+    monkeypatch.setattr("main.flush_metrics", MagicMock())
+    mock_monitor = MagicMock()
+    monkeypatch.setattr("main.monitor", mock_monitor)
+    monkeypatch.setattr("main.log_event", MagicMock())
+
+    result = main.main(SimpleNamespace(method="POST", path="/", args={}))
+    assert result == "Project details partially loaded"
+    assert 0 < len(stored) < 50
+    mock_monitor.assert_any_call("dfc_run_complete", 0)
+
+
+def test_get_project_pages_checks_deadline(monkeypatch):
+    """No further page is requested once the budget is spent."""
+    fetched = []
+    mock_client = MagicMock()
+    mock_client.list_projects.return_value = SimpleNamespace(
+        pages=(fetched.append(index) or SimpleNamespace(
+            projects=[index], next_page_token="") for index in range(5)))
+    monkeypatch.setattr(
+        "main.resourcemanager_v3.ProjectsClient", lambda **_: mock_client)
+    monkeypatch.setattr("main.monitor", MagicMock())
+    monkeypatch.setattr("main.log_event", MagicMock())
+
+    pages = main.get_project_pages("test_folder")
+    assert next(pages) == [0]
+    monkeypatch.setattr("main.run_deadline", time.monotonic())
+    assert not list(pages)
+    assert fetched == [0]
+    assert main.deadline_stops == ["fetch"]
+    assert not main.run_complete()
+
+
+def test_list_projects_checks_deadline_per_page(monkeypatch):
+    """The batch path also stops before a page it has no time for."""
+    fetched = []
+
+    def pages():
+        for index in range(5):
+            fetched.append(index)
+            if index == 1:
+                monkeypatch.setattr("main.run_deadline", time.monotonic())
+            yield SimpleNamespace(projects=[index],
+                                  next_page_token=str(index + 1))
+
+    mock_client = MagicMock()
+    mock_client.list_projects.return_value = SimpleNamespace(pages=pages())
+    monkeypatch.setattr("main.monitor", MagicMock())
+    monkeypatch.setattr("main.log_event", MagicMock())
+
+    assert main.list_projects(mock_client, "test_folder") == [0, 1]
+    assert fetched == [0, 1]
+    assert main.deadline_stops == ["fetch"]
+
+
+def test_run_batch_records_run_status(monkeypatch):
+    """Each invocation writes whether its run was complete to RUNS_TABLE."""
+    monkeypatch.setattr("main.RUNS_TABLE", "observability.runs")
+    monkeypatch.setattr("main.current_run", {"run_id": "run-1"})
+    monkeypatch.setattr("main.monitor", MagicMock())
+    monkeypatch.setattr("main.log_event", MagicMock())
+    mock_client = MagicMock()
+    mock_client.insert_rows_json.return_value = []
+    monkeypatch.setattr("main.get_client", lambda name: mock_client)
+
+    def partial_run():
+        main.deadline_stops.append("fetch")
+        return 3
+
+    request = SimpleNamespace(method="POST", path="/", args={})
+    assert main.run_batch(request, partial_run, MagicMock()) == (
+        "Project details partially loaded")
+    table, [row] = mock_client.insert_rows_json.call_args.args
+    assert table == "observability.runs"
+    assert row["run_id"] == "run-1"
+    assert row["complete"] is False
+    assert row["projects"] == 3
+    assert row["deadline_stops"] == ["fetch"]
+
+
+def test_run_batch_store_failure_is_partial(monkeypatch):
+    """A run whose writes failed is reported and recorded as partial."""
+    monkeypatch.setattr("main.RUNS_TABLE", "observability.runs")
+    monkeypatch.setattr("main.CURRENT_TABLE", "observability.current")
+    monkeypatch.setattr("main.monitor", MagicMock())
+    monkeypatch.setattr("main.log_event", MagicMock())
+    mock_merge = MagicMock(return_value=True)
+    monkeypatch.setattr("main.merge_current", mock_merge)
+    mock_client = MagicMock()
+    mock_client.insert_rows_json.return_value = []
+    monkeypatch.setattr("main.get_client", lambda name: mock_client)
+
+    def failed_store():
+        main.store_failures.append("observability.project_info")
+        return 3
+
+    request = SimpleNamespace(method="POST", path="/", args={})
+    assert main.run_batch(request, failed_store, MagicMock()) == (
+        "Project details partially loaded")
+    mock_merge.assert_called_once_with(False)
+    [row] = mock_client.insert_rows_json.call_args.args[1]
+    assert row["complete"] is False
+    assert row["store_failures"] == ["observability.project_info"]
+
+
+@patch("main.bq_client")
+def test_insert_chunk_stops_retrying_at_deadline(mock_bq_client,
+                                                  monkeypatch):
+    """Retries that cannot finish in time dead-letter their rows."""
+    mock_bq_client.insert_rows_json = MagicMock(
+        side_effect=exceptions.ServiceUnavailable("Service Unavailable"))
+    monkeypatch.setattr("main.monitor", MagicMock())
+    monkeypatch.setattr("main.log_event", MagicMock())
+    monkeypatch.setattr("main.run_deadline", time.monotonic() + 0.01)
+    monkeypatch.setattr("main.INSERT_BACKOFF_SECONDS", 1.0)
+
+    dead_letters = main.insert_chunk([{"project_id": "p0"}])
+    assert mock_bq_client.insert_rows_json.call_count == 1
+    assert dead_letters == [{"row": {"project_id": "p0"},
+                             "errors": [{"reason": "deadlineExceeded"}]}]
+
+
+def test_partial_run_reports_no_deletions(monkeypatch):
+    """Projects not reached before the deadline are not marked deleted."""
+    monkeypatch.setattr("main.INCREMENTAL_MODE", True)
+    monkeypatch.setattr("main.state_cache", {main.STATE_URI: {
+        "a": ["etag-1", "2025-03-18T12:05:00Z", "hash", "projects/a"]}})
+    monkeypatch.setattr("main.deadline_stops", ["fetch"])
+    monkeypatch.setattr("main.monitor", MagicMock())
+    mock_store = MagicMock(return_value=True)
+    monkeypatch.setattr("main.store", mock_store)
+    monkeypatch.setattr("main.save_state", MagicMock())
+
+    main.store_snapshot([_row("b")])
+    stored_rows = mock_store.call_args.args[0]
+    assert [row["project_id"] for row in stored_rows] == ["b"]
+
+
+def test_rate_limiter_backs_off_and_recovers():
+    """Throttling halves rate and concurrency; successes win them back."""
+    limiter = main.RateLimiter(8.0, 1.0, 8)
+    limiter.feedback(True)
+    limiter.feedback(True)
+    assert (limiter.rate, limiter.concurrency) == (2.0, 2)
+    for _ in range(100):
+        limiter.feedback(False)
+    assert (limiter.rate, limiter.concurrency) == (8.0, 8)
+    for _ in range(10):
+        limiter.feedback(True)
+    assert (limiter.rate, limiter.concurrency) == (1.0, 1)
+    limiter.feedback(None)
+    assert limiter.throttled == 12
+
+
+def test_rate_limiter_paces_calls():
+    """Past the burst, calls are spaced at the token rate."""
+    limiter = main.RateLimiter(20.0, 1.0, 4)
+    start_time = time.monotonic()
+    for _ in range(30):
+        limiter.acquire()
+        limiter.release(False)
+    assert time.monotonic() - start_time >= 0.4
+
+
+def test_rm_pages_retries_throttled_page(monkeypatch):
+    """A throttled page is retried from its token, not from page one."""
+    monkeypatch.setattr("main.log_event", MagicMock())
+    monkeypatch.setattr("main.monitor", MagicMock())
+    tokens = []
+
+    def list_projects(request):
+        tokens.append(request.page_token)
+        if request.page_token == "2":
+            return SimpleNamespace(pages=iter([SimpleNamespace(
+                projects=["p3"], next_page_token="")]))
+
+        def pages():
+            yield SimpleNamespace(projects=["p1"], next_page_token="1")
+            yield SimpleNamespace(projects=["p2"], next_page_token="2")
+            raise exceptions.TooManyRequests("Too Many Requests")
+        return SimpleNamespace(pages=pages())
+
+    mock_client = MagicMock()
+    mock_client.list_projects.side_effect = list_projects
+
+    assert main.list_projects(mock_client, "test_folder") == [
+        "p1", "p2", "p3"]
+    assert tokens == ["", "2"]
+    assert main.rm_limiter.throttled == 1
+
+
+def test_get_projects_survives_transient_unavailable(monkeypatch):
+    """One 503 no longer empties the run; the call is retried."""
+    mock_client = MagicMock()
+    mock_client.list_projects.side_effect = [
+        exceptions.ServiceUnavailable("Service Unavailable"),
+        _pager(["p1", "p2"]),
+    ]
+    monkeypatch.setattr(
+        "main.resourcemanager_v3.ProjectsClient", lambda **_: mock_client)
+    mock_sleep = MagicMock()
+    monkeypatch.setattr("main.time.sleep", mock_sleep)
+    monkeypatch.setattr("main.monitor", MagicMock())
+    monkeypatch.setattr("main.log_event", MagicMock())
+    monkeypatch.setattr("main.load_failures", [])
+
+    assert main.get_projects("test_folder") == ["p1", "p2"]
+    assert not main.load_failures
+    assert mock_client.list_projects.call_count == 2
+
+
+def test_rate_limiter_reports_state(monkeypatch):
+    """The limiter state is reported as metrics once per run."""
+    mock_monitor = MagicMock()
+    monkeypatch.setattr("main.monitor", mock_monitor)
+    limiter = main.RateLimiter(8.0, 1.0, 8)
+    limiter.feedback(True)
+
+    limiter.report()
+    mock_monitor.assert_any_call("dfc_rm_limiter_rate", 4.0)
+    mock_monitor.assert_any_call("dfc_rm_limiter_concurrency", 4)
+    mock_monitor.assert_any_call("dfc_rm_limiter_throttled", 1)
+    assert limiter.throttled == 0
+
+
+def test_rm_pages_async_limits_calls_in_flight(monkeypatch):
+    """Async listings wait for a slot like threaded ones do."""
+    monkeypatch.setattr("main.rm_limiter", main.RateLimiter(1e6, 1.0, 1))
+    calls = {"in_flight": 0, "max": 0}
+
+    async def list_projects(request):
+        calls["in_flight"] += 1
+        calls["max"] = max(calls["max"], calls["in_flight"])
+        await asyncio.sleep(0.02)
+        calls["in_flight"] -= 1
+        return _AsyncPager([request.parent])
+
+    async def listing(folder_id):
+        request = main.resourcemanager_v3.ListProjectsRequest(
+            parent=f"folders/{folder_id}")
+        return [page.projects async for page in main.rm_pages_async(
+            list_projects, request)]
+
+    async def run():
+        return await asyncio.gather(*(listing(index) for index in range(3)))
+
+    assert main.run_async(run()) == [[[f"folders/{index}"]]
+                                     for index in range(3)]
+    assert calls["max"] == 1
+    assert main.rm_limiter.in_flight == 0
+
+
+def test_row_id_is_deterministic():
+    """Insert IDs depend only on run, project and etag."""
+    row = _row("a", run_id="run-1")
+    assert main.row_id(row) == main.row_id(dict(row, labels=[{"k": "v"}]))
+    assert main.row_id(row) != main.row_id(dict(row, etag="etag-2"))
+    assert main.row_id(row) != main.row_id(dict(row, run_id="run-2"))
+
+
+@patch("main.bq_client")
+def test_insert_retry_resends_same_row_ids(mock_bq_client, monkeypatch):
+    """A retried row carries the insert ID of its first attempt."""
+    mock_bq_client.insert_rows_json = MagicMock(side_effect=[
+        exceptions.ServiceUnavailable("Service Unavailable"), []])
+    monkeypatch.setattr("main.time.sleep", MagicMock())
+    monkeypatch.setattr("main.monitor", MagicMock())
+    monkeypatch.setattr("main.log_event", MagicMock())
+
+    assert not main.insert_chunk([_row("a", run_id="run-1")])
+    first, second = mock_bq_client.insert_rows_json.call_args_list
+    assert first.kwargs["row_ids"] == second.kwargs["row_ids"]
+
+
+def test_run_lock_skips_overlapping_run(monkeypatch, tmp_path):
+    """A live lock makes a second trigger skip; an expired one is taken."""
+    lock_file = tmp_path / "run.lock"
+    monkeypatch.setattr("main.RUN_LOCK_URI", str(lock_file))
+    monkeypatch.setattr("main.log_event", MagicMock())
+    monkeypatch.setattr("main.flush_metrics", MagicMock())
+    monkeypatch.setattr("main.monitor", MagicMock())
+    mock_run = MagicMock(return_value="done")
+
+    assert main.acquire_run_lock(str(lock_file), "other")
+    assert main.run_exclusively(mock_run) is None
+    mock_run.assert_not_called()
+
+    lock_file.write_text(json.dumps({"owner": "other", "expires": 0}))
+    assert main.run_exclusively(mock_run) == "done"
+    assert not lock_file.exists()
+
+
+def test_main_skips_when_run_locked(monkeypatch, tmp_path):
+    """The entry point answers without collecting while locked."""
+    lock_file = tmp_path / "run.lock"
+    lock_file.write_text(json.dumps({
+        "owner": "other", "expires": time.time() + 60}))
+    monkeypatch.setattr("main.RUN_LOCK_URI", str(lock_file))
+    mock_collect = MagicMock()
+    monkeypatch.setattr("main.collect", mock_collect)
+    monkeypatch.setattr("main.log_event", MagicMock())
+    monkeypatch.setattr("main.flush_metrics", MagicMock())
+
+    request = SimpleNamespace(method="POST", path="/", args={})
+    assert main.main(request) == "Run already in progress"
+    mock_collect.assert_not_called()
+
+
+def test_single_flight_joins_run_in_progress(monkeypatch):
+    """A concurrent trigger waits for the running one and shares its result."""
+    monkeypatch.setattr("main.log_event", MagicMock())
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_run():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "shared"
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(
+        main.single_flight("key", slow_run)))
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=lambda: results.append(
+        main.single_flight("key", slow_run)))
+    follower.start()
+    time.sleep(0.05)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert results == ["shared", "shared"]
+    assert len(calls) == 1
+    assert not main.flights
+
+
+@patch("main.bq_client")
+def test_store_writes_history_and_staging(mock_bq_client, monkeypatch):
+    """With a current table, rows are staged next to the history."""
+    mock_bq_client.insert_rows_json = MagicMock(return_value=[])
+    monkeypatch.setattr("main.BQ_TABLE", "observability.project_info")
+    monkeypatch.setattr("main.CURRENT_TABLE", "observability.current")
+    monkeypatch.setattr("main.STAGING_TABLE", "observability.staging")
+    monkeypatch.setattr("main.monitor", MagicMock())
+
+    assert main.store([_row("a")]) is True
+    tables = [call.args[0]
+              for call in mock_bq_client.insert_rows_json.call_args_list]
+    assert tables == ["observability.project_info", "observability.staging"]
+
+    monkeypatch.setattr("main.WRITE_HISTORY", False)
+    mock_bq_client.insert_rows_json.reset_mock()
+    assert main.store([_row("a")]) is True
+    mock_bq_client.insert_rows_json.assert_called_once()
+    assert mock_bq_client.insert_rows_json.call_args.args[0] == (
+        "observability.staging")
+
+
+def _merge_parameters(mock_bq_client):
+    """Returns the query parameters of the MERGE job by name."""
+    job_config = mock_bq_client.query.call_args.kwargs["job_config"]
+    return {parameter.name: parameter.value
+            for parameter in job_config.query_parameters}
+
+
+@patch("main.bq_client")
+def test_merge_current_marks_deleted_only_for_full_runs(mock_bq_client,
+                                                         monkeypatch):
+    """Missing projects are deleted only by a complete unsharded run."""
+    mock_bq_client.query.return_value.num_dml_affected_rows = 3
+    monkeypatch.setattr("main.CURRENT_TABLE", "observability.current")
+    monkeypatch.setattr("main.STAGING_TABLE", "observability.staging")
+    monkeypatch.setattr("main.monitor", MagicMock())
+    monkeypatch.setattr("main.log_event", MagicMock())
+    main.start_run()
+
+    assert main.merge_current(complete=True) is True
+    query = mock_bq_client.query.call_args.args[0]
+    assert "MERGE `observability.current`" in query
+    assert "FROM `observability.staging`" in query
+    parameters = _merge_parameters(mock_bq_client)
+    assert parameters["run_id"] == main.current_run["run_id"]
+    assert parameters["mark_deleted"] is True
+
+    main.merge_current(complete=False)
+    assert _merge_parameters(mock_bq_client)["mark_deleted"] is False
+
+    monkeypatch.setattr("main.current_shard", (0, 2))
+    main.merge_current(complete=True)
+    assert _merge_parameters(mock_bq_client)["mark_deleted"] is False
+
+    monkeypatch.setattr("main.current_shard", (0, 1))
+    main.store_failures.append("observability.staging")
+    main.merge_current(complete=True)
+    assert _merge_parameters(mock_bq_client)["mark_deleted"] is False
+
+
+# reserved keywords of GoogleSQL, which cannot be used as table aliases
+GOOGLESQL_RESERVED_KEYWORDS = set("""
+ALL AND ANY ARRAY AS ASC ASSERT_ROWS_MODIFIED AT BETWEEN BY CASE CAST
+COLLATE CONTAINS CREATE CROSS CUBE CURRENT DEFAULT DEFINE DESC DISTINCT
+ELSE END ENUM ESCAPE EXCEPT EXCLUDE EXISTS EXTRACT FALSE FETCH FOLLOWING
+FOR FROM FULL GROUP GROUPING GROUPS HASH HAVING IF IGNORE IN INNER
+INTERSECT INTERVAL INTO IS JOIN LATERAL LEFT LIKE LIMIT LOOKUP MERGE
+NATURAL NEW NO NOT NULL NULLS OF ON OR ORDER OUTER OVER PARTITION
+PRECEDING PROTO QUALIFY RANGE RECURSIVE RESPECT RIGHT ROLLUP ROWS SELECT
+SET SOME STRUCT TABLESAMPLE THEN TO TREAT TRUE UNBOUNDED UNION UNNEST
+USING WHEN WHERE WINDOW WITH WITHIN
+""".split())
+
+
+def test_merge_query_aliases_are_not_reserved(monkeypatch):
+    """Every alias and qualifier in the MERGE is a usable identifier."""
+    monkeypatch.setattr("main.CURRENT_TABLE", "p.observability.current")
+    monkeypatch.setattr("main.STAGING_TABLE", "p.observability.staging")
+    query = main.merge_query()
+    aliases = set(re.findall(r"\bAS (\w+)", query))
+    qualifiers = set(re.findall(r"\b(\w+)\.\w+", query.replace(
+        "`p.observability.current`", "").replace(
+            "`p.observability.staging`", "")))
+    assert aliases == {"target", "snapshot"}
+    assert qualifiers == aliases
+    assert not {name.upper() for name in aliases} & (
+        GOOGLESQL_RESERVED_KEYWORDS)
+
+
+@patch("main.bq_client")
+def test_merge_current_failure_is_logged(mock_bq_client, monkeypatch):
+    """A failed MERGE is reported as a store error."""
+    mock_bq_client.query.side_effect = exceptions.BadRequest("bad query")
+    monkeypatch.setattr("main.CURRENT_TABLE", "observability.current")
+    mock_log_event = MagicMock()
+    monkeypatch.setattr("main.log_event", mock_log_event)
+
+    assert main.merge_current(complete=True) is False
+    mock_log_event.assert_called_once_with(
+        "error", "BigQuery Bad Request error", "store",
+        error="400 bad query", table="observability.current")
+
+
+def test_run_merges_into_current_table(monkeypatch):
+    """A run that collected projects ends with one MERGE."""
+    monkeypatch.setattr("main.CURRENT_TABLE", "observability.current")
+    monkeypatch.setattr("main.collect", MagicMock(return_value=2))
+    monkeypatch.setattr("main.flush_metrics", MagicMock())
+    monkeypatch.setattr("main.log_event", MagicMock())
+    mock_merge = MagicMock(return_value=True)
+    monkeypatch.setattr("main.merge_current", mock_merge)
+
+    request = SimpleNamespace(method="POST", path="/", args={})
+    assert main.main(request) == "Project details loaded successfully"
+    mock_merge.assert_called_once_with(True)
+
+    monkeypatch.setattr("main.collect", MagicMock(return_value=0))
+    main.main(request)
+    mock_merge.assert_called_once()
+
+
+def _asset_event(number, project_id, ancestors=None, deleted=False,
+                 asset_type="cloudresourcemanager.googleapis.com/Project"):
+    """Builds the Pub/Sub CloudEvent an Asset feed sends for a project."""
+    asset = {
+        "name": f"//cloudresourcemanager.googleapis.com/projects/{number}",
+        "assetType": asset_type,
+        "ancestors": ancestors or [f"projects/{number}", "folders/123"],
+    }
+    if not deleted:
+        asset["resource"] = {"data": {"projectId": project_id}}
+    temporal_asset = {"asset": asset, "deleted": deleted}
+    if deleted:
+        temporal_asset["priorAsset"] = {
+            "resource": {"data": {"projectId": project_id}}}
+    message = {"data": base64.b64encode(
+        json.dumps(temporal_asset).encode("utf-8")).decode("ascii")}
+    return CloudEvent({
+        "type": "google.cloud.pubsub.topic.v1.messagePublished",
+        "source": "//pubsub.googleapis.com/projects/p/topics/project-changes",
+    }, {"message": message, "subscription": "project-changes"})
+
+
+def test_event_changes_keeps_projects_in_scope(monkeypatch):
+    """Only project events under the collected folder are changes."""
+    monkeypatch.setattr("main.FOLDER_ID", "123")
+    monkeypatch.setattr("main.RECURSIVE_CRAWL", False)
+
+    assert main.event_changes(_asset_event(1, "alpha")) == {
+        "projects/1": "alpha"}
+    assert main.event_changes(_asset_event(2, "beta", deleted=True)) == {
+        "projects/2": "beta"}
+    assert not main.event_changes(_asset_event(
+        3, "other", ancestors=["projects/3", "folders/999"]))
+    assert not main.event_changes(_asset_event(
+        4, "nested", ancestors=["projects/4", "folders/5", "folders/123"]))
+    assert not main.event_changes(_asset_event(
+        5, "bucket", asset_type="storage.googleapis.com/Bucket"))
+
+    monkeypatch.setattr("main.RECURSIVE_CRAWL", True)
+    assert main.event_changes(_asset_event(
+        4, "nested", ancestors=["projects/4", "folders/5",
+                                "folders/123"])) == {"projects/4": "nested"}
+
+
+def test_main_event_batches_a_burst(monkeypatch):
+    """Events arriving within the window are fetched and stored once."""
+    monkeypatch.setattr("main.FOLDER_ID", "123")
+    monkeypatch.setattr("main.EVENT_BATCH_SECONDS", 0.2)
+    monkeypatch.setattr("main.CURRENT_TABLE", "")
+    mock_flush = MagicMock()
+    monkeypatch.setattr("main.flush_metrics", mock_flush)
+    mock_store = MagicMock(return_value=True)
+    monkeypatch.setattr("main.store", mock_store)
+    mock_client = MagicMock()
+    mock_client.get_project.side_effect = (
+        lambda request: main.resourcemanager_v3.Project(
+            name=request.name, project_id=f"id-{request.name[9:]}",
+            parent="folders/123"))
+    monkeypatch.setattr("main.get_client", lambda name: mock_client)
+
+    events = [_asset_event(number, f"id-{number}") for number in (1, 2, 1)]
+    threads = [threading.Thread(target=main.main_event, args=(event,))
+               for event in events]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    mock_store.assert_called_once()
+    rows = mock_store.call_args.args[0]
+    assert sorted(row["project_id"] for row in rows) == ["id-1", "id-2"]
+    assert mock_client.get_project.call_count == 2
+    assert main.event_batch is None
+    mock_flush.assert_called_once()
+
+
+def test_main_event_stores_deleted_projects(monkeypatch):
+    """A project that can no longer be read is stored as DELETED."""
+    monkeypatch.setattr("main.FOLDER_ID", "123")
+    monkeypatch.setattr("main.EVENT_BATCH_SECONDS", 0)
+    monkeypatch.setattr("main.CURRENT_TABLE", "observability.current")
+    monkeypatch.setattr("main.flush_metrics", MagicMock())
+    mock_store = MagicMock(return_value=True)
+    monkeypatch.setattr("main.store", mock_store)
+    mock_merge = MagicMock(return_value=True)
+    monkeypatch.setattr("main.merge_current", mock_merge)
+    mock_client = MagicMock()
+    mock_client.get_project.side_effect = exceptions.NotFound("gone")
+    monkeypatch.setattr("main.get_client", lambda name: mock_client)
+
+    monkeypatch.setattr("main.current_run", {"run_id": "scheduled"})
+    main.main_event(_asset_event(7, "gone-project", deleted=True))
+    [row] = mock_store.call_args.args[0]
+    assert row["project_id"] == "gone-project"
+    assert row["project_number"] == "projects/7"
+    assert row["state"] == "DELETED"
+    # the batch merges its own run and leaves the shared one alone
+    mock_merge.assert_called_once()
+    assert mock_merge.call_args.kwargs["complete"] is False
+    assert mock_merge.call_args.kwargs["run"]["run_id"] == row["run_id"]
+    assert main.current_run == {"run_id": "scheduled"}
+
+
+def test_main_event_raises_when_not_stored(monkeypatch):
+    """A failed batch raises so Pub/Sub redelivers the event."""
+    monkeypatch.setattr("main.FOLDER_ID", "123")
+    monkeypatch.setattr("main.EVENT_BATCH_SECONDS", 0)
+    monkeypatch.setattr("main.flush_metrics", MagicMock())
+    monkeypatch.setattr("main.store", MagicMock(return_value=False))
+    mock_client = MagicMock()
+    mock_client.get_project.return_value = main.resourcemanager_v3.Project(
+        name="projects/1", project_id="alpha")
+    monkeypatch.setattr("main.get_client", lambda name: mock_client)
+
+    with pytest.raises(RuntimeError):
+        main.main_event(_asset_event(1, "alpha"))
+
+
+def test_main_event_drops_unreadable_events(monkeypatch):
+    """A malformed event is logged and acknowledged, not retried."""
+    monkeypatch.setattr("main.flush_metrics", MagicMock())
+    mock_log_event = MagicMock()
+    monkeypatch.setattr("main.log_event", mock_log_event)
+    mock_batch = MagicMock()
+    monkeypatch.setattr("main.batch_changes", mock_batch)
+
+    event = CloudEvent({"type": "google.cloud.pubsub.topic.v1."
+                                "messagePublished",
+                        "source": "//pubsub.googleapis.com/"},
+                       {"message": {"data": "not base64 json"}})
+    assert main.main_event(event) is None
+    mock_batch.assert_not_called()
+    assert mock_log_event.call_args.args[1] == (
+        "Unreadable project change event")
+
+
+def test_histogram_buckets_follow_exponential_bounds(monkeypatch):
+    """Samples land in the bucket whose bounds contain them."""
+    monkeypatch.setattr("main.HISTOGRAM_BUCKETS", 4)
+    monkeypatch.setattr("main.HISTOGRAM_GROWTH_FACTOR", 2.0)
+    monkeypatch.setattr("main.HISTOGRAM_SCALE_SECONDS", 0.001)
+
+    histogram = main.Histogram()
+    for seconds in (0.0005, 0.001, 0.0015, 0.003, 0.007, 10.0):
+        histogram.add(seconds)
+    # underflow, [1ms, 2ms), [2ms, 4ms), [4ms, 8ms), [8ms, 16ms), overflow
+    assert histogram.bucket_counts == [1, 2, 1, 1, 0, 1]
+    assert histogram.count == 6
+    assert histogram.mean == pytest.approx(10.013 / 6)
+
+
+def test_observed_latencies_flush_as_distributions(monkeypatch):
+    """Each label set is written as one DISTRIBUTION point."""
+    monkeypatch.setattr("main.metrics_buffer", {})
+    for seconds in (0.002, 0.004, 0.2):
+        main.observe("dfc_rpc_latency", seconds, stage="store",
+                     method="insert_rows_json", outcome="ok")
+    main.observe("dfc_rpc_latency", 0.5, stage="store",
+                 method="insert_rows_json", outcome="error")
+    main.monitor("dfc_prj_total_duration", 1.0)
+
+    _, series = main.drain_metrics()[0]
+    assert not main.histograms
+    by_outcome = {item.metric.labels.get("outcome"): item for item in series}
+    assert by_outcome[None].points[0].value.double_value == 1.0
+    distribution = by_outcome["ok"].points[0].value.distribution_value
+    assert by_outcome["ok"].metric.labels["stage"] == "store"
+    assert distribution.count == 3
+    assert sum(distribution.bucket_counts) == 3
+    assert distribution.bucket_options.exponential_buckets.scale == (
+        main.HISTOGRAM_SCALE_SECONDS)
+    assert by_outcome["error"].points[0].value.distribution_value.count == 1
+
+
+def test_rm_pages_observe_each_page(monkeypatch):
+    """Every page and every throttled call is one latency sample."""
+    monkeypatch.setattr("main.log_event", MagicMock())
+    monkeypatch.setattr("main.monitor", MagicMock())
+    mock_client = MagicMock()
+    mock_client.list_projects.side_effect = [
+        exceptions.TooManyRequests("Too Many Requests"),
+        _pager(["p1"], ["p2"]),
+    ]
+    mock_client.list_projects.__name__ = "list_projects"
+
+    assert main.list_projects(mock_client, "42") == ["p1", "p2"]
+    counts = {dict(labels)["outcome"]: histogram.count
+              for (name, labels), histogram in main.histograms.items()
+              if name == "dfc_rpc_latency"}
+    assert counts == {"ok": 2, "throttled": 1}
+    assert all(dict(labels) == {
+        "stage": "fetch", "method": "list_projects", "folder_id": "42",
+        "outcome": dict(labels)["outcome"]} for _, labels in main.histograms)
+
+
+@patch("main.bq_client")
+def test_insert_chunk_observes_outcomes(mock_bq_client, monkeypatch):
+    """Partial and clean insert calls are told apart."""
+    mock_bq_client.insert_rows_json = MagicMock(side_effect=[
+        [{"index": 0, "errors": [{"reason": "backendError"}]}], []])
+    monkeypatch.setattr("main.time.sleep", MagicMock())
+    monkeypatch.setattr("main.log_event", MagicMock())
+
+    assert not main.insert_chunk([_row("a"), _row("b")])
+    outcomes = {dict(labels)["outcome"]: histogram.count
+                for (_, labels), histogram in main.histograms.items()}
+    assert outcomes == {"partial": 1, "ok": 1}
+
+
+def test_profiling_is_off_by_default(monkeypatch):
+    """Unsampled invocations never reach the profiler."""
+    monkeypatch.setattr("main.collect", MagicMock(return_value=1))
+    monkeypatch.setattr("main.flush_metrics", MagicMock())
+    mock_run_profiled = MagicMock()
+    monkeypatch.setattr("main.run_profiled", mock_run_profiled)
+
+    request = SimpleNamespace(method="POST", path="/", args={},
+                              headers={"X-Profile": "guess"})
+    assert main.main(request) == "Project details loaded successfully"
+    mock_run_profiled.assert_not_called()
+
+
+def test_profile_header_profiles_the_run(monkeypatch, tmp_path):
+    """A matching header logs and stores hotspots and allocation sites."""
+    monkeypatch.setattr("main.PROFILE_TOKEN", "secret")
+    monkeypatch.setattr("main.PROFILE_TOP_N", 5)
+    monkeypatch.setattr("main.PROFILE_URI", str(tmp_path))
+    monkeypatch.setattr("main.flush_metrics", MagicMock())
+    mock_log_event = MagicMock()
+    monkeypatch.setattr("main.log_event", mock_log_event)
+
+    def busy_collect():
+        return len([bytearray(1024) for _ in range(20000)])
+    monkeypatch.setattr("main.collect", busy_collect)
+
+    request = SimpleNamespace(method="POST", path="/", args={},
+                              headers={"X-Profile": "secret"})
+    assert main.main(request) == "Project details loaded successfully"
+
+    [profile_call] = [call for call in mock_log_event.call_args_list
+                      if call.args[2] == "profile"]
+    report = profile_call.kwargs
+    assert report["entry_point"] == "main"
+    assert 0 < len(report["hotspots"]) <= 5
+    assert 0 < len(report["allocations"]) <= 5
+    assert any("busy_collect" in hotspot["function"]
+               for hotspot in report["hotspots"])
+    [report_file] = tmp_path.glob("main-*.json")
+    assert json.loads(report_file.read_text())["hotspots"] == (
+        report["hotspots"])
+
+
+def test_profile_sampling_rate(monkeypatch):
+    """PROFILE_SAMPLE_RATE=N profiles about one invocation in N."""
+    request = SimpleNamespace(headers={})
+    monkeypatch.setattr("main.PROFILE_SAMPLE_RATE", 1)
+    assert main.should_profile(request)
+    monkeypatch.setattr("main.PROFILE_SAMPLE_RATE", 4)
+    monkeypatch.setattr("main.random.randrange", lambda n: 1)
+    assert not main.should_profile(request)
+
+
+def test_log_event_sends_structured_payload(monkeypatch):
+    """The event and keyword arguments become JSON payload fields."""
+    monkeypatch.setattr("main.setup_cloud_logging", MagicMock())
+    mock_log = MagicMock()
+    monkeypatch.setattr("main.logging.log", mock_log)
+
+    main.log_event("warning", "Retrying", "store", rows=3)
+    level, message = mock_log.call_args.args
+    assert (level, message) == (logging.WARNING, "Retrying")
+    assert mock_log.call_args.kwargs["extra"]["json_fields"] == {
+        "service_name": main.SERVICE_NAME, "event": "store", "rows": 3}
+
+
+def test_log_event_skips_disabled_levels(monkeypatch):
+    """A filtered level is dropped before anything is built."""
+    monkeypatch.setattr("main.setup_cloud_logging", MagicMock())
+    mock_log = MagicMock()
+    monkeypatch.setattr("main.logging.log", mock_log)
+    mock_suppressed = MagicMock()
+    monkeypatch.setattr("main.repeats_suppressed", mock_suppressed)
+    root = logging.getLogger()
+    level = root.level
+    root.setLevel(logging.WARNING)
+    try:
+        main.log_event("info", "Quiet", "test")
+    finally:
+        root.setLevel(level)
+    mock_suppressed.assert_not_called()
+    mock_log.assert_not_called()
+
+
+def test_log_event_limits_repeated_errors(monkeypatch):
+    """Repeats past the limit are counted and summarised at flush."""
+    monkeypatch.setattr("main.setup_cloud_logging", MagicMock())
+    monkeypatch.setattr("main.LOG_REPEAT_LIMIT", 2)
+    monkeypatch.setattr("main.log_queue", None)
+    mock_log = MagicMock()
+    monkeypatch.setattr("main.logging.log", mock_log)
+
+    for index in range(5):
+        main.log_event("error", "Error transforming project data",
+                       "transform", project_id=f"p{index}")
+    assert mock_log.call_count == 2
+
+    main.flush_logs()
+    summary = mock_log.call_args.kwargs["extra"]["json_fields"]
+    assert summary["repeats"] == {"Error transforming project data": 3}
+    main.flush_logs()
+    assert mock_log.call_count == 3
+
+    monkeypatch.setattr("main.LOG_REPEAT_WINDOW_SECONDS", 0)
+    main.log_event("error", "Error transforming project data", "transform")
+    assert mock_log.call_count == 4
+
+
+def test_flush_logs_drops_ended_repeat_windows(monkeypatch):
+    """Windows of messages that stopped repeating do not accumulate."""
+    monkeypatch.setattr("main.setup_cloud_logging", MagicMock())
+    monkeypatch.setattr("main.log_queue", None)
+    monkeypatch.setattr("main.logging.log", MagicMock())
+
+    main.log_event("error", "Unable to fetch project p1", "load")
+    main.log_event("error", "Unable to fetch project p2", "load")
+    main.flush_logs()
+    assert len(main.log_repeats) == 2
+
+    monkeypatch.setattr("main.LOG_REPEAT_WINDOW_SECONDS", 0)
+    main.flush_logs()
+    assert not main.log_repeats
+
+
+def test_log_queue_handler_keeps_request_trace():
+    """The trace of the request is captured before the record is queued."""
+    # pylint: disable=import-outside-toplevel
+    import flask
+    from google.cloud.logging_v2.handlers import CloudLoggingFilter
+
+    target = logging.Handler()
+    target.addFilter(CloudLoggingFilter(project="p"))
+    handler = main.LogQueueHandler(queue.Queue())
+    handler.context_handler = target
+    record = logging.LogRecord("test", logging.INFO, __file__, 1,
+                               "Run complete", (), None)
+    with flask.Flask(__name__).test_request_context(
+            "/", headers={"X-Cloud-Trace-Context": "abc123/1;o=1"}):
+        handler.handle(record)
+
+    # the listener thread filters again, outside the request
+    queued = handler.queue.get_nowait()
+    target.filter(queued)
+    assert queued._trace == "projects/p/traces/abc123"  # pylint: disable=W0212
+    assert queued._http_request["requestUrl"] == (  # pylint: disable=W0212
+        "http://localhost/")
+
+
+def test_log_queue_handler_drops_when_full(monkeypatch):
+    """A full log queue drops records instead of blocking the run."""
+    monkeypatch.setattr("main.log_dropped", {"count": 0})
+    handler = main.LogQueueHandler(queue.Queue(maxsize=1))
+    record = logging.LogRecord("test", logging.ERROR, __file__, 1,
+                               "message %s", ("arg",), None)
+    handler.handle(record)
+    handler.handle(record)
+    assert handler.queue.get_nowait() is record
+    assert record.msg == "message %s"
+    assert main.log_dropped["count"] == 1
+
+
+def test_json_formatter_writes_payload_fields():
+    """The stderr fallback writes one parseable JSON entry per record."""
+    record = logging.LogRecord("test", logging.INFO, __file__, 1,
+                               "Run complete", (), None)
+    record.json_fields = {"event": "complete", "projects": 2}
+    entry = json.loads(main.JsonFormatter().format(record))
+    assert entry["severity"] == "INFO"
+    assert entry["message"] == "Run complete"
+    assert entry["projects"] == 2
@@ -16,4 +16,58 @@ resource "google_bigquery_table" "projects" {
     expiration_ms = 7776000000  # 90-days
   }
   clustering = ["project_id"]
-}
\ No newline at end of file
+}
+
+# one row per project, kept up to date by a MERGE at the end of each run
+resource "google_bigquery_table" "projects_current" {
+  dataset_id          = google_bigquery_dataset.projects.dataset_id
+  table_id            = "project_info_current"
+  deletion_protection = false
+  schema              = file("schema/project_info.json")
+  clustering          = ["project_id"]
+}
+
+# rows of recent runs waiting to be merged; MERGE selects them by run_id
+resource "google_bigquery_table" "projects_staging" {
+  dataset_id          = google_bigquery_dataset.projects.dataset_id
+  table_id            = "project_info_staging"
+  deletion_protection = false
+  schema              = file("schema/project_info.json")
+  time_partitioning {
+    type          = "DAY"
+    field         = "ingestion_time"
+    expiration_ms = 172800000 # 2-days
+  }
+  clustering = ["run_id"]
+}
+
+# one row per invocation of a run: whether it was complete or partial
+resource "google_bigquery_table" "project_runs" {
+  dataset_id          = google_bigquery_dataset.projects.dataset_id
+  table_id            = "project_info_runs"
+  deletion_protection = false
+  schema              = file("schema/project_info_runs.json")
+  time_partitioning {
+    type  = "DAY"
+    field = "finished"
+  }
+  clustering = ["run_id"]
+}
+
+# project_info with one row per run and project; insert IDs only drop
+# rows resent within about a minute, and a resumed run can resend pages
+resource "google_bigquery_table" "projects_dedup" {
+  dataset_id          = google_bigquery_dataset.projects.dataset_id
+  table_id            = "project_info_dedup"
+  deletion_protection = false
+  view {
+    query          = <<-EOT
+      SELECT * FROM `${var.project_id}.${google_bigquery_dataset.projects.dataset_id}.${google_bigquery_table.projects.table_id}`
+      WHERE TRUE
+      QUALIFY run_id IS NULL
+        OR ROW_NUMBER() OVER (PARTITION BY run_id, project_id
+                              ORDER BY ingestion_time) = 1
+    EOT
+    use_legacy_sql = false
+  }
+}
@@ -0,0 +1,23 @@
+// project change events: a Cloud Asset feed on the folder publishes
+// every project change to Pub/Sub, which triggers project-info-events
+resource "google_pubsub_topic" "project_changes" {
+  name = "${var.application}-project-changes"
+}
+
+resource "google_cloud_asset_folder_feed" "project_changes" {
+  billing_project = var.project_id
+  folder          = var.folder
+  feed_id         = "${var.application}-project-changes"
+  content_type    = "RESOURCE"
+  asset_types     = ["cloudresourcemanager.googleapis.com/Project"]
+
+  feed_output_config {
+    pubsub_destination {
+      topic = google_pubsub_topic.project_changes.id
+    }
+  }
+
+  depends_on = [
+    google_pubsub_topic_iam_member.asset_feed_publisher,
+  ]
+}
@@ -15,6 +15,7 @@ data "archive_file" "project_info" {
     "**/__pycache__",
     "**/*.pyc",
     "**/test_*.py",
+    "**/bench_*.py",
     "**/*.log",
     "**/*.pytest_cache",
     "**/*.coverage"
@@ -28,6 +29,10 @@ resource "google_storage_bucket_object" "project_info" {
   content_type = "application/zip"
 }
 
+locals {
+  project_info_timeout_seconds = 120
+}
+
 resource "google_cloudfunctions2_function" "project_info" {
   name     = "project-info"
   location = var.region
@@ -45,9 +50,10 @@ resource "google_cloudfunctions2_function" "project_info" {
   }
 
   service_config {
-    max_instance_count = 1
+    # one coordinator plus one instance per shard
+    max_instance_count = var.shard_count > 1 ? var.shard_count + 1 : 1
     available_memory   = "256M"
-    timeout_seconds    = 120
+    timeout_seconds    = local.project_info_timeout_seconds
 
     # environment_variables = {
     #   LANDING_BUCKET = google_storage_bucket.landing.name
@@ -55,9 +61,19 @@ resource "google_cloudfunctions2_function" "project_info" {
 
     environment_variables = {
       # BQ_TABLE   = google_bigquery_table.projects.friendly_name
-      BQ_TABLE    = "${var.project_id}.${google_bigquery_dataset.projects.dataset_id}.${google_bigquery_table.projects.table_id}"
-      FOLDER_ID   = var.folder
-      GCP_PROJECT = var.project_id
+      BQ_TABLE       = "${var.project_id}.${google_bigquery_dataset.projects.dataset_id}.${google_bigquery_table.projects.table_id}"
+      FOLDER_ID      = var.folder
+      GCP_PROJECT    = var.project_id
+      STATE_URI      = "gs://${google_storage_bucket.project_info.name}/state/project_info.json"
+      CHECKPOINT_URI = "gs://${google_storage_bucket.project_info.name}/state/checkpoint.json"
+      RUN_LOCK_URI   = "gs://${google_storage_bucket.project_info.name}/state/run.lock"
+      CURRENT_TABLE  = "${var.project_id}.${google_bigquery_dataset.projects.dataset_id}.${google_bigquery_table.projects_current.table_id}"
+      STAGING_TABLE  = "${var.project_id}.${google_bigquery_dataset.projects.dataset_id}.${google_bigquery_table.projects_staging.table_id}"
+      RUNS_TABLE     = "${var.project_id}.${google_bigquery_dataset.projects.dataset_id}.${google_bigquery_table.project_runs.table_id}"
+      # the collector stops fetching before this deadline to store its work
+      FUNCTION_TIMEOUT_SECONDS = local.project_info_timeout_seconds
+      # requests asking for more shards than instances are rejected
+      SHARD_MAX_COUNT = var.shard_count
     }
 
     vpc_connector                 = google_vpc_access_connector.connector.id
@@ -75,6 +91,64 @@ resource "google_cloudfunctions2_function" "project_info" {
   ]
 }
 
+# ingests only the projects named by change events; the scheduled full
+# scan of project-info reconciles whatever events missed
+resource "google_cloudfunctions2_function" "project_info_events" {
+  name     = "project-info-events"
+  location = var.region
+
+  build_config {
+    runtime         = "python312"
+    entry_point     = "main_event"
+    service_account = google_service_account.builder.name
+    source {
+      storage_source {
+        bucket = google_storage_bucket.project_info.name
+        object = google_storage_bucket_object.project_info.name
+      }
+    }
+  }
+
+  service_config {
+    max_instance_count = 1
+    # events of a burst share one batch on the same instance
+    max_instance_request_concurrency = 80
+    available_cpu                    = "1"
+    available_memory                 = "256M"
+    timeout_seconds                  = local.project_info_timeout_seconds
+
+    environment_variables = {
+      BQ_TABLE                 = "${var.project_id}.${google_bigquery_dataset.projects.dataset_id}.${google_bigquery_table.projects.table_id}"
+      FOLDER_ID                = var.folder
+      GCP_PROJECT              = var.project_id
+      CURRENT_TABLE            = "${var.project_id}.${google_bigquery_dataset.projects.dataset_id}.${google_bigquery_table.projects_current.table_id}"
+      STAGING_TABLE            = "${var.project_id}.${google_bigquery_dataset.projects.dataset_id}.${google_bigquery_table.projects_staging.table_id}"
+      EVENT_BATCH_SECONDS      = 5
+      FUNCTION_TIMEOUT_SECONDS = local.project_info_timeout_seconds
+    }
+
+    vpc_connector                 = google_vpc_access_connector.connector.id
+    vpc_connector_egress_settings = "ALL_TRAFFIC"
+    service_account_email         = google_service_account.project_info.email
+  }
+
+  event_trigger {
+    trigger_region        = var.region
+    event_type            = "google.cloud.pubsub.topic.v1.messagePublished"
+    pubsub_topic          = google_pubsub_topic.project_changes.id
+    retry_policy          = "RETRY_POLICY_RETRY"
+    service_account_email = google_service_account.project_info.email
+  }
+
+  depends_on = [
+    google_storage_bucket.project_info,
+    google_service_account.project_info,
+    google_vpc_access_connector.connector,
+    google_bigquery_table.projects_current,
+    google_bigquery_table.projects_staging
+  ]
+}
+
 
 resource "google_cloud_run_service_iam_binding" "project_info_invokers" {
   location = google_cloudfunctions2_function.project_info.location
@@ -46,6 +46,19 @@ resource "google_project_iam_member" "project_info_bq_editor_permissions" {
   member  = "serviceAccount:${google_service_account.project_info.email}"
 }
 
+# load jobs and the MERGE into the current table run as query jobs
+resource "google_project_iam_member" "project_info_bq_job_permissions" {
+  project = var.project_id
+  role    = "roles/bigquery.jobUser"
+  member  = "serviceAccount:${google_service_account.project_info.email}"
+}
+
+resource "google_storage_bucket_iam_member" "project_info_state_permissions" {
+  bucket = google_storage_bucket.project_info.name
+  role   = "roles/storage.objectUser"
+  member = "serviceAccount:${google_service_account.project_info.email}"
+}
+
 # resource "google_project_iam_member" "project_info_resource_manager_permissions" {
 #   project = var.project_id
 #   role    = "roles/resourcemanager.projectViewer"
@@ -58,6 +71,23 @@ resource "google_folder_iam_member" "project_info_folder_viewer_permissions" {
   member  = "serviceAccount:${google_service_account.project_info.email}"
 }
 
+# the event trigger pushes to project-info-events as project-info
+resource "google_cloud_run_service_iam_member" "project_info_events_invoker" {
+  location = google_cloudfunctions2_function.project_info_events.location
+  project  = google_cloudfunctions2_function.project_info_events.project
+  service  = google_cloudfunctions2_function.project_info_events.name
+  role     = "roles/run.invoker"
+  member   = "serviceAccount:${google_service_account.project_info.email}"
+}
 
+resource "google_project_service_identity" "cloud_asset" {
+  provider = google-beta
+  project  = var.project_id
+  service  = "cloudasset.googleapis.com"
+}
 
-
+resource "google_pubsub_topic_iam_member" "asset_feed_publisher" {
+  topic  = google_pubsub_topic.project_changes.id
+  role   = "roles/pubsub.publisher"
+  member = "serviceAccount:${google_project_service_identity.cloud_asset.email}"
+}
@@ -1,12 +1,13 @@
 resource "google_cloud_scheduler_job" "daily_trigger" {
   name        = "${var.application}-daily"
   description = "dfc scheduler trigger project data load"
-  schedule    = "*/10 * * * *"
+  # change events keep the tables current; the full scan reconciles
+  schedule    = var.reconcile_schedule
   project     = google_cloudfunctions2_function.project_info.project
   region      = google_cloudfunctions2_function.project_info.location
 
   http_target {
-    uri         = google_cloudfunctions2_function.project_info.service_config[0].uri
+    uri         = var.shard_count > 1 ? "${google_cloudfunctions2_function.project_info.service_config[0].uri}/?shards=${var.shard_count}" : google_cloudfunctions2_function.project_info.service_config[0].uri
     http_method = "POST"
     oidc_token {
       audience              = "${google_cloudfunctions2_function.project_info.service_config[0].uri}/"
@@ -12,7 +12,8 @@ CREATE TABLE `dev2-ea8f.observability.project_info`
     labels ARRAY<STRUCT<
         key STRING,
         value STRING
-    >> OPTIONS(description="Custom labels")
+    >> OPTIONS(description="Custom labels"),
+    run_id STRING OPTIONS(description="Collection run the row belongs to")
 )
 PARTITION BY DATE(ingestion_time)  
 CLUSTER BY project_id, state, folder_id 
@@ -30,3 +30,15 @@ variable "project_number" {
 
 
 
+
+variable "shard_count" {
+  description = "Number of parallel instances a scheduled run fans out to"
+  type        = number
+  default     = 1
+}
+
+variable "reconcile_schedule" {
+  description = "Cron schedule of the full scan that reconciles change events"
+  type        = string
+  default     = "0 */6 * * *"
+}